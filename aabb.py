@@ -1,35 +1,57 @@
-import numpy as np
-
-class AABB:
-    def __init__(self, min_corner, max_corner):
-        self.min_corner = np.array(min_corner, dtype=np.float32)
-        self.max_corner = np.array(max_corner, dtype=np.float32)
-
-    def ray_hit(self, ray_origin, ray_direction, model_matrix):
-        """
-        Check if a ray intersects with the AABB.
-        """
-        # Transform the ray into model space
-        inv_model_matrix = np.linalg.inv(model_matrix)
-        ray_origin = np.dot(inv_model_matrix, np.append(ray_origin, 1.0))[:3]
-        ray_direction = np.dot(inv_model_matrix, np.append(ray_direction, 0.0))[:3]
-
-        # Calculate intersections with the AABB
-        tmin = (self.min_corner - ray_origin) / ray_direction
-        tmax = (self.max_corner - ray_origin) / ray_direction
-
-        tmin, tmax = np.minimum(tmin, tmax), np.maximum(tmin, tmax)
-        tmin_max = np.max(tmin)
-        tmax_min = np.min(tmax)
-
-        if tmax_min >= tmin_max and tmax_min >= 0:
-            return True, tmin_max
-        return False, float('inf')
-
-    def scale(self, factor):
-        """
-        Scale the AABB by a factor.
-        """
-        center = (self.min_corner + self.max_corner) / 2
-        self.min_corner = center + (self.min_corner - center) * factor
-        self.max_corner = center + (self.max_corner - center) * factor
\ No newline at end of file
+import numpy as np
+
+class AABB:
+    def __init__(self, min_corner, max_corner):
+        self.min_corner = np.array(min_corner, dtype=np.float32)
+        self.max_corner = np.array(max_corner, dtype=np.float32)
+
+    def ray_hit(self, ray_origin, ray_direction, model_matrix, inv_model_matrix=None):
+        """
+        Check if a ray intersects with the AABB.
+        Pass inv_model_matrix when the caller already knows the inverse.
+        """
+        # Transform the ray into model space
+        if inv_model_matrix is None:
+            inv_model_matrix = np.linalg.inv(model_matrix)
+        ray_origin = np.dot(inv_model_matrix, np.append(ray_origin, 1.0))[:3]
+        ray_direction = np.dot(inv_model_matrix, np.append(ray_direction, 0.0))[:3]
+
+        # Calculate intersections with the AABB
+        tmin = (self.min_corner - ray_origin) / ray_direction
+        tmax = (self.max_corner - ray_origin) / ray_direction
+
+        tmin, tmax = np.minimum(tmin, tmax), np.maximum(tmin, tmax)
+        tmin_max = np.max(tmin)
+        tmax_min = np.min(tmax)
+
+        if tmax_min >= tmin_max and tmax_min >= 0:
+            return True, tmin_max
+        return False, float('inf')
+
+    def scale(self, factor):
+        """
+        Scale the AABB by a factor.
+        """
+        center = (self.min_corner + self.max_corner) / 2
+        self.min_corner = center + (self.min_corner - center) * factor
+        self.max_corner = center + (self.max_corner - center) * factor
+
+    def transform(self, matrix):
+        """
+        Return the AABB enclosing this box after an affine transform.
+        """
+        # Each output extent is |A| times the half size, around the moved centre
+        center = (self.min_corner + self.max_corner) / 2
+        half = (self.max_corner - self.min_corner) / 2
+        new_center = np.dot(matrix[:3, :3], center) + matrix[:3, 3]
+        new_half = np.dot(np.abs(matrix[:3, :3]), half)
+        return AABB(new_center - new_half, new_center + new_half)
+
+    def union(self, other):
+        return AABB(np.minimum(self.min_corner, other.min_corner), np.maximum(self.max_corner, other.max_corner))
+
+    def overlaps(self, other):
+        """
+        Check if two AABBs overlap; boxes that only touch do not.
+        """
+        return bool(np.all(self.min_corner < other.max_corner) and np.all(other.min_corner < self.max_corner))
@@ -0,0 +1,266 @@
+# Headless benchmarks of the scene hot paths
+"""
+Runs the scene operations behind user interaction against the recording
+GL stub in glstub.py, so it works on machines without a display or GPU:
+
+    python benchmark.py --sizes 10 1000 100000 --output bench.json
+    python benchmark.py --sizes 10 1000 --compare bench.json
+
+Results are JSON: per scene size, throughput and latency percentiles of
+Scene.place, Scene.place_on_rays, Scene.pick, Scene.pick_many,
+Scene.select_rectangle, Scene.move_selected (with collision reports),
+Scene.overlapping_pairs, Node.scale and Scene.render, plus GL calls
+submitted per frame, a software rendered frame, per-step times of
+streaming generated nodes in, and scene file save and load times.
+
+Nodes are placed along random rays through the window, at depths that
+spread them evenly through the view from PLACE_DEPTH back, with the room
+per node SceneStreamer gives. Overlaps then grow with the node count
+rather than its square, and the larger sizes finish.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import glstub
+RECORDER = glstub.install()
+
+import numpy as np
+import scenefile
+from camera import Camera
+from profiling import latency
+from rasterizer import SoftwareRenderer
+from scene import Scene
+from streaming import SceneStreamer
+from trackball import Trackball
+
+DEFAULT_SIZES = (10, 100, 1000, 10000, 100000)
+SHAPES = ('sphere', 'cube', 'figure')
+# The software renderer is timed up to this many nodes, at this size
+SOFTWARE_RENDER_LIMIT = 10000
+SOFTWARE_RENDER_SIZE = (160, 120)
+# Main thread time per step when streaming generated nodes
+STREAM_BUDGET = 0.008
+# Cubic units of the view per placed node
+NODE_VOLUME = SceneStreamer.SPACING ** 3
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def random_ray(camera, rng):
+    return camera.get_ray(rng.uniform(0, camera.width), rng.uniform(0, camera.height))
+
+
+def depth_range(camera, n):
+    """
+    Cubed near and far depth of the part of the view, from PLACE_DEPTH
+    back, that holds n nodes at NODE_VOLUME each.
+    """
+    tan = np.tan(np.radians(camera.FOVY) / 2.0)
+    # Volume of the view pyramid up to depth d is per_cube * d ** 3
+    per_cube = 4.0 / 3.0 * tan * tan * camera.width / camera.height
+    near = Scene.PLACE_DEPTH ** 3
+    return near, near + n * NODE_VOLUME / per_cube
+
+
+def random_depth(depths, rng):
+    # Uniform in the cubed depth puts nodes evenly through the volume
+    near, far = depths
+    return (near + rng.random() * (far - near)) ** (1.0 / 3.0)
+
+
+def bench_size(n, samples, frames, seed):
+    rng = random.Random(seed)
+    random.seed(seed)
+    camera = Camera()
+    width, height = RECORDER.window_size
+    camera.update(width, height, Trackball(Trackball.DISTANCE + n ** (1.0 / 3.0)))
+    scene = Scene()
+    result = {'nodes': n}
+    depths = depth_range(camera, n)
+
+    place = []
+    for _ in range(n):
+        start, direction = random_ray(camera, rng)
+        place.append(timed(scene.place, rng.choice(SHAPES), start, direction, camera.inverse_model_view,
+                           random_depth(depths, rng)))
+    result['place'] = latency(place)
+    result['place']['nodes_per_s'] = n / sum(place)
+
+    # The same number of nodes again, placed as one batch in a second scene
+    rays = [random_ray(camera, rng) for _ in range(n)]
+    starts, directions = np.array([r[0] for r in rays]), np.array([r[1] for r in rays])
+    shapes = [rng.choice(SHAPES) for _ in range(n)]
+    depth = [random_depth(depths, rng) for _ in range(n)]
+    batch = Scene()
+    seconds = timed(batch.place_on_rays, shapes, starts, directions, camera.inverse_model_view, depth)
+    result['place_many'] = {'seconds': seconds, 'nodes_per_s': n / seconds}
+    batch.clear()
+
+    picks = []
+    for _ in range(samples):
+        start, direction = random_ray(camera, rng)
+        picks.append(timed(scene.pick, start, direction, camera.model_view))
+    result['pick'] = latency(picks)
+    result['pick']['picks_per_s'] = samples / sum(picks)
+
+    # One ray per cell of a 32 x 24 grid over the window, cast as a batch
+    rays = [camera.get_ray((i + 0.5) * width / 32.0, (j + 0.5) * height / 24.0) for j in range(24) for i in range(32)]
+    starts, directions = np.array([r[0] for r in rays]), np.array([r[1] for r in rays])
+    seconds = timed(scene.pick_many, starts, directions, camera.model_view)
+    result['pick_many'] = {'rays': len(rays), 'seconds': seconds, 'rays_per_s': len(rays) / seconds}
+
+    selects = []
+    for _ in range(samples):
+        x0, x1 = sorted(rng.uniform(0, width) for _ in range(2))
+        y0, y1 = sorted(rng.uniform(0, height) for _ in range(2))
+        selects.append(timed(scene.select_rectangle, x0, y0, x1, y1,
+                             camera.projection, camera.model_view, (width, height)))
+    result['select_rectangle'] = latency(selects)
+    scene.clear_selection()
+
+    # Drag whatever is under the centre of the window, or any node
+    start, direction = camera.get_ray(width / 2.0, height / 2.0)
+    node, _ = scene.pick(start, direction, camera.model_view)
+    if node is None:
+        node = scene.node_list[0]
+        scene.set_selection([node])
+        scene.selected_node = node
+        scene.drag_depth, scene.drag_loc = scene.PLACE_DEPTH, start + direction * scene.PLACE_DEPTH
+    moves = []
+    for i in range(samples):
+        x = width / 2.0 + 100.0 * np.sin(i / 10.0)
+        start, direction = camera.get_ray(x, height / 2.0)
+        moves.append(timed(scene.move_selected, start, direction, camera.inverse_model_view))
+    result['move_selected'] = latency(moves)
+    result['move_selected']['contacts'] = len(scene.contacts)
+
+    start = time.perf_counter()
+    pairs = scene.overlapping_pairs()
+    result['overlap_pairs'] = {'seconds': time.perf_counter() - start, 'pairs': len(pairs)}
+
+    scales = []
+    for i in range(samples):
+        scales.append(timed(rng.choice(scene.node_list).scale, i % 2 == 0))
+    result['scale'] = latency(scales)
+
+    for mode in scene.RENDER_MODES:
+        scene.set_render_mode(mode)
+        frame_times, calls = [], []
+        for _ in range(frames):
+            RECORDER.reset()
+            frame_times.append(timed(scene.render, camera.projection, camera.model_view, camera.height))
+            calls.append(RECORDER.total())
+        stats = latency(frame_times)
+        stats['gl_calls_per_frame'] = float(np.mean(calls))
+        stats['visible'] = scene.cull_stats['visible']
+        stats['culled'] = scene.cull_stats['culled']
+        result['render_' + mode] = stats
+
+    if n <= SOFTWARE_RENDER_LIMIT:
+        renderer = SoftwareRenderer(*SOFTWARE_RENDER_SIZE)
+        camera.update(SOFTWARE_RENDER_SIZE[0], SOFTWARE_RENDER_SIZE[1], camera.trackball)
+        seconds = timed(renderer.render, scene, camera.projection, camera.model_view)
+        result['render_software'] = {'seconds': seconds, 'triangles': renderer.stats['triangles']}
+
+    # Streaming the same number of nodes into another scene, a frame
+    # budget at a time, as the viewer does while generating content
+    streamed = Scene()
+    streamer = SceneStreamer(streamed, n, seed=seed)
+    steps = []
+    start = time.perf_counter()
+    while not streamer.done:
+        steps.append(timed(streamer.step, STREAM_BUDGET))
+        time.sleep(0.001)
+    stats = latency(steps)
+    stats['seconds'] = time.perf_counter() - start
+    stats['rows_per_s'] = streamer.progress()['rows_per_s']
+    streamer.close()
+    streamed.clear()
+    result['stream'] = stats
+
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'bench.scene')
+        result['save'] = {'seconds': timed(scenefile.save, scene, path)}
+        scene.node_list[0].translate(0.1, 0.0, 0.0)
+        result['save_incremental'] = {'seconds': timed(scenefile.save, scene, path)}
+        start = time.perf_counter()
+        loaded = scenefile.load(path)
+        result['load'] = {'seconds': time.perf_counter() - start}
+        loaded.clear()
+    finally:
+        shutil.rmtree(directory)
+    # Give the rows back, so the next size starts from an empty store
+    scene.clear()
+    return result
+
+
+def compare(current, baseline):
+    """
+    Ratio current / baseline for every numeric metric of matching sizes.
+    """
+    by_size = dict((entry['nodes'], entry) for entry in baseline['results'])
+    ratios = []
+    for entry in current['results']:
+        old = by_size.get(entry['nodes'])
+        if old is None:
+            continue
+        row = {'nodes': entry['nodes']}
+        for bench, metrics in entry.items():
+            if not isinstance(metrics, dict) or bench not in old:
+                continue
+            for metric, value in metrics.items():
+                previous = old[bench].get(metric)
+                if previous:
+                    row['%s.%s' % (bench, metric)] = value / previous
+        ratios.append(row)
+    return ratios
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES)
+    parser.add_argument('--samples', type=int, default=200, help="picks, moves and scales per size")
+    parser.add_argument('--frames', type=int, default=20, help="frames rendered per size and mode")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="write the results here instead of stdout")
+    parser.add_argument('--compare', help="earlier results to report ratios against")
+    args = parser.parse_args(argv)
+
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'samples': args.samples,
+            'frames': args.frames,
+            'seed': args.seed,
+        },
+        'results': [bench_size(n, args.samples, args.frames, args.seed) for n in args.sizes],
+    }
+    if args.compare:
+        with open(args.compare) as f:
+            report['ratios'] = compare(report, json.load(f))
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        sys.stdout.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+# Bounding volume hierarchy over world-space node bounds
+import numpy as np
+
+
+class BVH(object):
+    """
+    Flat-array bounding volume hierarchy over a set of primitive boxes.
+
+    Primitives are referred to by integer index; their bounds are passed in
+    by the owner, which keeps them in stacked (N, 3) arrays. Moved
+    primitives are refitted in place, newly inserted ones are tested by
+    brute force until enough have accumulated to justify a rebuild.
+    """
+    LEAF_SIZE = 8
+    # Rebuild once refits have inflated the summed node area by this factor
+    REBUILD_GROWTH = 2.0
+    # ... or once this fraction of primitives is waiting outside the tree
+    REBUILD_PENDING = 0.1
+    EPSILON = 1e-4
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.node_min = np.zeros((0, 3))
+        self.node_max = np.zeros((0, 3))
+        self.left = np.zeros(0, dtype=np.int64)
+        self.right = np.zeros(0, dtype=np.int64)
+        self.parent = np.zeros(0, dtype=np.int64)
+        self.start = np.zeros(0, dtype=np.int64)
+        self.count = np.zeros(0, dtype=np.int64)
+        self.order = np.zeros(0, dtype=np.int64)
+        self.leaf_of = np.zeros(0, dtype=np.int64)
+        self.pending = []
+        self.built_area = 0.0
+        self.total_area = 0.0
+        self.needs_rebuild = False
+        self.rebuilds = 0
+        self.refits = 0
+
+    def __len__(self):
+        return len(self.order) + len(self.pending)
+
+    def build(self, min_corners, max_corners):
+        """
+        Build the tree over all primitives, splitting at the centroid median
+        of the widest axis.
+        """
+        n = len(min_corners)
+        self.clear()
+        self.rebuilds += 1
+        if n == 0:
+            return
+        min_corners = np.asarray(min_corners, dtype=np.float64)
+        max_corners = np.asarray(max_corners, dtype=np.float64)
+        centroids = (min_corners + max_corners) * 0.5
+        order = np.arange(n)
+
+        node_min, node_max, left, right, parent, start, count = [], [], [], [], [], [], []
+        stack = [(0, n, -1, False)]
+        while stack:
+            lo, hi, up, is_right = stack.pop()
+            index = len(start)
+            prims = order[lo:hi]
+            node_min.append(min_corners[prims].min(axis=0) - self.EPSILON)
+            node_max.append(max_corners[prims].max(axis=0) + self.EPSILON)
+            left.append(-1)
+            right.append(-1)
+            parent.append(up)
+            start.append(lo)
+            count.append(hi - lo)
+            if up >= 0:
+                if is_right:
+                    right[up] = index
+                else:
+                    left[up] = index
+            if hi - lo <= self.LEAF_SIZE:
+                continue
+            c = centroids[prims]
+            axis = int(np.argmax(c.max(axis=0) - c.min(axis=0)))
+            mid = (hi - lo) // 2
+            order[lo:hi] = prims[np.argpartition(c[:, axis], mid)]
+            count[index] = 0
+            stack.append((lo + mid, hi, index, True))
+            stack.append((lo, lo + mid, index, False))
+
+        self.node_min = np.array(node_min)
+        self.node_max = np.array(node_max)
+        self.left = np.array(left, dtype=np.int64)
+        self.right = np.array(right, dtype=np.int64)
+        self.parent = np.array(parent, dtype=np.int64)
+        self.start = np.array(start, dtype=np.int64)
+        self.count = np.array(count, dtype=np.int64)
+        self.order = order
+        self.leaf_of = np.zeros(n, dtype=np.int64)
+        for leaf in np.nonzero(self.count)[0]:
+            self.leaf_of[order[self.start[leaf]:self.start[leaf] + self.count[leaf]]] = leaf
+        self.total_area = self.built_area = float(_area(self.node_min, self.node_max).sum())
+
+    def insert(self, prim):
+        """
+        Queue a new primitive. It is found by queries straight away and
+        merged into the tree on the next rebuild.
+        """
+        self.pending.append(prim)
+        if len(self.pending) > max(self.LEAF_SIZE, self.REBUILD_PENDING * len(self.order)):
+            self.needs_rebuild = True
+
+    def refit(self, prim, min_corners, max_corners):
+        """
+        Grow or shrink the boxes on the path from a moved primitive's leaf
+        to the root. Skipped when a rebuild is already due.
+        """
+        if self.needs_rebuild or prim >= len(self.leaf_of):
+            return
+        self.refits += 1
+        node = self.leaf_of[prim]
+        prims = self.order[self.start[node]:self.start[node] + self.count[node]]
+        new_min = np.asarray(min_corners)[prims].min(axis=0) - self.EPSILON
+        new_max = np.asarray(max_corners)[prims].max(axis=0) + self.EPSILON
+        while node >= 0:
+            if self.left[node] >= 0:
+                children = [self.left[node], self.right[node]]
+                new_min = self.node_min[children].min(axis=0)
+                new_max = self.node_max[children].max(axis=0)
+            if (new_min == self.node_min[node]).all() and (new_max == self.node_max[node]).all():
+                break
+            self.total_area += _area(new_min, new_max) - _area(self.node_min[node], self.node_max[node])
+            self.node_min[node] = new_min
+            self.node_max[node] = new_max
+            node = self.parent[node]
+        if self.total_area > self.REBUILD_GROWTH * self.built_area:
+            self.needs_rebuild = True
+
+    def ray_query(self, origin, direction, test):
+        """
+        Closest-hit traversal. test(indices) returns the best (index, distance)
+        among the given primitives, or (None, inf), breaking ties towards the
+        lowest index; subtrees whose boxes are entered further away than the
+        best hit so far are skipped.
+        """
+        best_index, best = None, float('inf')
+        if self.pending:
+            best_index, best = test(np.array(self.pending, dtype=np.int64))
+        if not len(self.order):
+            return best_index, best
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inv_direction = 1.0 / np.asarray(direction, dtype=np.float64)
+        origin = np.asarray(origin, dtype=np.float64)
+        stack = [(0, _box_entry(self.node_min[[0]], self.node_max[[0]], origin, inv_direction)[0])]
+        while stack:
+            node, entry = stack.pop()
+            if entry > best or entry == np.inf:
+                continue
+            if self.left[node] < 0:
+                lo = self.start[node]
+                index, distance = test(self.order[lo:lo + self.count[node]])
+                # Ties go to the lowest index, i.e. the node added first
+                if distance < best or (distance == best and index is not None and index < best_index):
+                    best_index, best = index, distance
+                continue
+            children = [self.left[node], self.right[node]]
+            entries = _box_entry(self.node_min[children], self.node_max[children], origin, inv_direction)
+            near, far = (0, 1) if entries[0] <= entries[1] else (1, 0)
+            if entries[far] <= best and entries[far] != np.inf:
+                stack.append((children[far], entries[far]))
+            if entries[near] <= best and entries[near] != np.inf:
+                stack.append((children[near], entries[near]))
+        return best_index, best
+
+    def ray_candidates(self, origins, directions):
+        """
+        Every (ray, primitive) pair whose leaf box the ray enters, for many
+        rays at once, as two index arrays. The tree is walked one level at a
+        time for all rays together; queued primitives pair with every ray.
+        """
+        origins = np.asarray(origins, dtype=np.float64)
+        n_rays = len(origins)
+        rays_out, prims_out = [], []
+        if self.pending:
+            pending = np.array(self.pending, dtype=np.int64)
+            rays_out.append(np.repeat(np.arange(n_rays), len(pending)))
+            prims_out.append(np.tile(pending, n_rays))
+        if len(self.order) and n_rays:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                inv_directions = 1.0 / np.asarray(directions, dtype=np.float64)
+            rays, nodes = np.arange(n_rays), np.zeros(n_rays, dtype=np.int64)
+            while len(rays):
+                entries = _box_entry(self.node_min[nodes], self.node_max[nodes], origins[rays], inv_directions[rays])
+                entered = entries != np.inf
+                rays, nodes = rays[entered], nodes[entered]
+                leaf = self.left[nodes] < 0
+                counts = self.count[nodes[leaf]]
+                if counts.sum():
+                    # start, start + 1, ... start + count - 1 for each leaf
+                    offsets = np.repeat(self.start[nodes[leaf]] - np.cumsum(counts) + counts, counts)
+                    rays_out.append(np.repeat(rays[leaf], counts))
+                    prims_out.append(self.order[offsets + np.arange(counts.sum())])
+                rays, nodes = rays[~leaf], nodes[~leaf]
+                rays = np.concatenate([rays, rays])
+                nodes = np.concatenate([self.left[nodes], self.right[nodes]])
+        if not rays_out:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.concatenate(rays_out), np.concatenate(prims_out)
+
+
+def _area(min_corners, max_corners):
+    d = np.maximum(max_corners - min_corners, 0.0)
+    return 2.0 * (d[..., 0] * d[..., 1] + d[..., 1] * d[..., 2] + d[..., 2] * d[..., 0])
+
+
+def _box_entry(min_corners, max_corners, origin, inv_direction):
+    """
+    Entry distance of a ray into each box, or inf for boxes it misses.
+    The distance is negative when the ray starts inside the box, matching
+    the distances reported by the exact per-node test.
+    """
+    with np.errstate(invalid='ignore'):
+        t1 = (min_corners - origin) * inv_direction
+        t2 = (max_corners - origin) * inv_direction
+    # A zero direction component yields nan for origins on the slab plane;
+    # fmax/fmin skip those slabs so the test stays conservative.
+    near = np.fmax.reduce(np.minimum(t1, t2), axis=1)
+    far = np.fmin.reduce(np.maximum(t1, t2), axis=1)
+    hit = (far >= near) & (far >= 0)
+    return np.where(hit, near, np.inf)
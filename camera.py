@@ -0,0 +1,66 @@
+# CPU-side camera matrices and unprojection
+import numpy as np
+from utils import perspective
+
+
+class Camera(object):
+    """
+    Projection and model-view matrices computed on the CPU from the viewer
+    inputs (window size and the trackball), so rendering and picking never
+    read matrices back from GL.
+
+    Matrices are only recomputed when an input changes, into arrays
+    allocated once; version counts the changes, for anyone deciding
+    whether a new frame is needed.
+    """
+    FOVY = 70
+    NEAR, FAR = 0.1, 1000.0
+
+    def __init__(self):
+        self.width, self.height = None, None
+        self.trackball = None
+        self.trackball_version = None
+        self.model_view = np.identity(4)
+        self.inverse_model_view = np.identity(4)
+        self.gl_model_view = np.identity(4, dtype=np.float32)
+        self.version = 0
+
+    def update(self, width, height, trackball):
+        """
+        Bring the matrices up to date. Returns True if anything changed.
+        """
+        changed = False
+        if (width, height) != (self.width, self.height):
+            self.width, self.height = width, height
+            self.projection = perspective(self.FOVY, float(width) / float(height), self.NEAR, self.FAR)
+            self.inverse_projection = np.linalg.inv(self.projection)
+            self.gl_projection = np.ascontiguousarray(self.projection.T, dtype=np.float32)
+            changed = True
+
+        if trackball is not self.trackball or trackball.version != self.trackball_version:
+            self.trackball, self.trackball_version = trackball, trackball.version
+            np.copyto(self.model_view, trackball.matrix)
+            np.copyto(self.inverse_model_view, trackball.inverse)
+            # GL takes matrices column-major
+            np.copyto(self.gl_model_view, self.model_view.T)
+            changed = True
+
+        if changed:
+            self.version += 1
+        return changed
+
+    def unproject(self, x, y, depth):
+        """
+        Window coordinates to eye space, like gluUnProject with an
+        identity model-view.
+        """
+        ndc = np.array([2.0 * x / self.width - 1.0, 2.0 * y / self.height - 1.0, 2.0 * depth - 1.0, 1.0])
+        point = np.dot(self.inverse_projection, ndc)
+        return point[:3] / point[3]
+
+    def get_ray(self, x, y):
+        start = self.unproject(x, y, 0.001)
+        end = self.unproject(x, y, 0.999)
+        direction = end - start
+        direction = direction / np.linalg.norm(direction)
+        return start, direction
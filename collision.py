@@ -0,0 +1,329 @@
+# Broad-phase collision detection between top-level scene nodes
+import collections
+import itertools
+import time
+import numpy as np
+from profiling import PROFILER
+
+
+def boxes_overlap(min_a, max_a, min_b, max_b):
+    """
+    Row-wise overlap test of boxes a against boxes b. Boxes that only
+    touch do not overlap.
+    """
+    return ((min_a < max_b) & (min_b < max_a)).all(axis=-1)
+
+
+# Cell coordinates are clamped to 21 bits each and packed into one int,
+# which keeps far away boxes correct, only sharing the outermost cells
+CELL_BITS = 21
+CELL_LIMIT = 1 << (CELL_BITS - 1)
+
+
+def _pack(x, y, z):
+    return ((x + CELL_LIMIT) << (2 * CELL_BITS)) | ((y + CELL_LIMIT) << CELL_BITS) | (z + CELL_LIMIT)
+
+
+def _cell_ranges(min_corners, max_corners, size, max_cells):
+    # Low and high cell of each box, and which boxes touch too many cells
+    low = np.clip(np.floor(min_corners / size), -CELL_LIMIT, CELL_LIMIT - 1).astype(np.int64)
+    high = np.clip(np.floor(max_corners / size), -CELL_LIMIT, CELL_LIMIT - 1).astype(np.int64)
+    return low, high, (high - low + 1).prod(axis=-1) > max_cells
+
+
+def _expand(low, high, rows):
+    """
+    One (row, packed cell) entry for every cell each of the given boxes
+    touches, sorted by cell.
+    """
+    span = high[rows] - low[rows] + 1
+    counts = span.prod(axis=1)
+    total = int(counts.sum())
+    # k-th cell of each box, counted x fastest
+    k = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    sx, sy = np.repeat(span[:, 0], counts), np.repeat(span[:, 1], counts)
+    rows = np.repeat(rows, counts)
+    cells = low[rows] + np.stack([k % sx, (k // sx) % sy, k // (sx * sy)], axis=1)
+    keys = _pack(cells[:, 0], cells[:, 1], cells[:, 2])
+    order = np.argsort(keys, kind='stable')
+    return rows[order], keys[order]
+
+
+def _id_pairs(first, second):
+    # (M, 2) rows of id pairs, smaller id first
+    return np.stack([np.minimum(first, second), np.maximum(first, second)], axis=1)
+
+
+class HashGrid(object):
+    """
+    Uniform grid of cubic cells over the world bounds of the rows of a
+    PickBuffer, hashed so that only occupied cells take memory.
+
+    Each node is filed under every cell its box touches, by node id, so a
+    query only looks at the nodes sharing a cell with the box asked about.
+    The grid is built in one vectorized pass into (cell, id) entries
+    sorted by cell, which queries find by binary search. Nodes refiled
+    after that, e.g. while dragged, are masked out of the entries and kept
+    in a dict of cells instead, so moving a node only refiles that node.
+    Once a single update or all of them together come to more than
+    REBUILD_SHARE of the grid, it is rebuilt on next use instead.
+
+    Nodes too big for the cell size would fill many cells, so they are
+    kept aside and tested box against box by every query.
+
+    The cells are filled on first use; until then updates cost nothing.
+    """
+    # Cell edge as a multiple of the median node extent
+    CELL_FACTOR = 2.0
+    # Nodes touching more cells than this are kept aside as oversized
+    MAX_CELLS = 64
+    # Candidate pairs all_pairs holds in memory at once
+    PAIR_BATCH = 1 << 20
+    # Share of the built nodes refiled one by one before a rebuild
+    REBUILD_SHARE = 0.25
+
+    def __init__(self, pick_buffer, cell_size=None):
+        self.pick_buffer = pick_buffer
+        self.fixed_cell_size = cell_size
+        self.clear()
+        # Candidates tested, overlaps found and time taken by the last query
+        self.stats = {'candidates': 0, 'contacts': 0, 'ms': 0.0}
+
+    def clear(self):
+        self.built = False
+        self.cell_size = self.fixed_cell_size
+        # What build() filed: packed cells sorted, the node id of each, the
+        # oversized node ids, and how many nodes that was
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.members = np.zeros(0, dtype=np.int64)
+        self.built_oversized = np.zeros(0, dtype=np.int64)
+        self.built_count = 0
+        # True for node ids whose built entries no longer count
+        self.moved = np.zeros(0, dtype=bool)
+        # Nodes refiled since: packed cell -> ids, node id ->
+        # (x0, y0, z0, x1, y1, z1) cell range or None when oversized
+        self.cells = collections.defaultdict(set)
+        self.node_cells = {}
+        self.oversized = set()
+
+    def _choose_cell_size(self, min_corners, max_corners):
+        if self.fixed_cell_size is not None:
+            return self.fixed_cell_size
+        if not len(min_corners):
+            return 1.0
+        extent = (max_corners - min_corners).max(axis=1)
+        return max(float(np.median(extent)) * self.CELL_FACTOR, 1e-3)
+
+    def _cell_range(self, min_corner, max_corner):
+        low, high, big = _cell_ranges(np.asarray(min_corner), np.asarray(max_corner), self.cell_size, self.MAX_CELLS)
+        if big:
+            return None
+        return tuple(low.tolist() + high.tolist())
+
+    def _keys(self, cells):
+        x0, y0, z0, x1, y1, z1 = cells
+        return [_pack(x, y, z) for x, y, z in
+                itertools.product(range(x0, x1 + 1), range(y0, y1 + 1), range(z0, z1 + 1))]
+
+    def build(self):
+        buffer = self.pick_buffer
+        n = len(buffer)
+        self.clear()
+        min_corners, max_corners = buffer.world_min[:n], buffer.world_max[:n]
+        self.cell_size = self._choose_cell_size(min_corners, max_corners)
+        self.built = True
+        low, high, big = _cell_ranges(min_corners, max_corners, self.cell_size, self.MAX_CELLS)
+        ids = buffer.ids[:n]
+        self.built_oversized = ids[big]
+        rows, self.keys = _expand(low, high, np.flatnonzero(~big))
+        self.members = ids[rows]
+        self.built_count = n
+        self.moved = np.zeros(int(ids.max()) + 1 if n else 0, dtype=bool)
+
+    def _mark_moved(self, ids):
+        n = int(ids.max()) + 1
+        if n > len(self.moved):
+            moved = np.zeros(max(n, 2 * len(self.moved)), dtype=bool)
+            moved[:len(self.moved)] = self.moved
+            self.moved = moved
+        self.moved[ids] = True
+
+    def _file(self, node_id, cells):
+        if node_id in self.node_cells:
+            if self.node_cells[node_id] == cells:
+                return
+            self._unfile(node_id)
+        self.node_cells[node_id] = cells
+        if cells is None:
+            self.oversized.add(node_id)
+            return
+        for key in self._keys(cells):
+            self.cells[key].add(node_id)
+
+    def _unfile(self, node_id):
+        cells = self.node_cells.pop(node_id)
+        if cells is None:
+            self.oversized.discard(node_id)
+            return
+        for key in self._keys(cells):
+            members = self.cells[key]
+            members.discard(node_id)
+            if not members:
+                del self.cells[key]
+
+    def update(self, ids):
+        """
+        Refile the given nodes after they were added, moved, resized or
+        removed. Does nothing before the grid is first used, and only
+        drops the grid for a rebuild when the batch is large.
+        """
+        if not self.built:
+            return
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        if not len(ids):
+            return
+        if len(ids) + len(self.node_cells) > self.REBUILD_SHARE * self.built_count:
+            self.clear()
+            return
+        self._mark_moved(ids)
+        buffer = self.pick_buffer
+        rows = np.full(len(ids), -1, dtype=np.int64)
+        known = ids < len(buffer.id_rows)
+        rows[known] = buffer.id_rows[ids[known]]
+        for node_id in ids[rows < 0].tolist():
+            if node_id in self.node_cells:
+                self._unfile(node_id)
+        present = rows >= 0
+        rows = rows[present]
+        low, high, big = _cell_ranges(buffer.world_min[rows], buffer.world_max[rows], self.cell_size, self.MAX_CELLS)
+        for node_id, cells, oversized in zip(ids[present].tolist(), np.hstack([low, high]).tolist(), big.tolist()):
+            self._file(node_id, None if oversized else tuple(cells))
+
+    def _overlapping(self, ids, min_corner, max_corner):
+        # The given node ids whose boxes overlap a world box
+        buffer = self.pick_buffer
+        rows = buffer.id_rows[ids]
+        return ids[boxes_overlap(min_corner, max_corner, buffer.world_min[rows], buffer.world_max[rows])]
+
+    def neighbors(self, min_corner, max_corner):
+        """
+        Ids of the nodes sharing a cell with a world box: every node that
+        could overlap it, and some that do not. Oversized nodes, and every
+        node when the box is oversized itself, are only included when
+        their boxes overlap.
+        """
+        if not self.built:
+            self.build()
+        buffer = self.pick_buffer
+        cells = self._cell_range(min_corner, max_corner)
+        if cells is None:
+            return set(self._overlapping(buffer.ids[:len(buffer)], min_corner, max_corner).tolist())
+        oversized = self.built_oversized[~self.moved[self.built_oversized]]
+        if self.oversized:
+            oversized = np.concatenate([oversized, np.fromiter(self.oversized, dtype=np.int64)])
+        found = set(self._overlapping(oversized, min_corner, max_corner).tolist())
+        keys = self._keys(cells)
+        starts = np.searchsorted(self.keys, keys, side='left')
+        counts = np.searchsorted(self.keys, keys, side='right') - starts
+        entries = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(int(counts.sum()))
+        members = self.members[entries]
+        found.update(members[~self.moved[members]].tolist())
+        for key in keys:
+            found.update(self.cells.get(key, ()))
+        return found
+
+    def contacts(self, ids, offset=None):
+        """
+        (id, other id) pairs of the given nodes overlapping a node not among
+        them, with the given nodes' boxes moved by offset if there is one.
+        Only their neighbors in the grid are tested.
+        """
+        began = time.perf_counter()
+        buffer = self.pick_buffer
+        ids = [int(i) for i in ids]
+        moving = set(ids)
+        pairs, tested = [], 0
+        for node_id in ids:
+            row = buffer.row(node_id)
+            if row is None:
+                continue
+            min_corner, max_corner = buffer.world_min[row], buffer.world_max[row]
+            if offset is not None:
+                min_corner, max_corner = min_corner + offset, max_corner + offset
+            others = [other for other in self.neighbors(min_corner, max_corner) if other not in moving]
+            if not others:
+                continue
+            rows = buffer.id_rows[others]
+            overlap = boxes_overlap(min_corner, max_corner, buffer.world_min[rows], buffer.world_max[rows])
+            tested += len(others)
+            pairs.extend((node_id, other) for other, hit in zip(others, overlap.tolist()) if hit)
+        self._record(began, tested, len(pairs))
+        return pairs
+
+    def all_pairs(self):
+        """
+        Every overlapping pair of nodes as an (M, 2) array of node ids,
+        smaller id first. Runs on the bounds arrays rather than the cells:
+        each box is expanded into the cells it touches and the entries are
+        sorted by cell. Boxes sharing a cell are then paired off and tested
+        a bounded batch of pairs at a time. A pair sharing several cells is
+        only kept in the lowest of them, so no pair is made twice.
+
+        Time and output grow with the overlaps: 100k nodes spread as
+        SceneStreamer spreads them, about one node per 8 cubic units and
+        half an overlap per node, take around 0.2 s, while nodes crowded
+        onto one shell overlap by the million.
+        """
+        began = time.perf_counter()
+        buffer = self.pick_buffer
+        n = len(buffer)
+        min_corners, max_corners = buffer.world_min[:n], buffer.world_max[:n]
+        ids = buffer.ids[:n]
+        size = self.cell_size if self.built else self._choose_cell_size(min_corners, max_corners)
+        low, high, big = _cell_ranges(min_corners, max_corners, size, self.MAX_CELLS)
+        rows, keys = _expand(low, high, np.flatnonzero(~big))
+        found, tested = [], 0
+
+        # Each entry pairs with the entries after it in the same cell
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]) if len(keys) else np.zeros(0, dtype=np.int64)
+        sizes = np.diff(np.r_[starts, len(keys)])
+        local = np.arange(len(keys)) - np.repeat(starts, sizes)
+        later = np.repeat(sizes, sizes) - 1 - local
+        bounds = np.cumsum(later)
+        entry = 0
+        while entry < len(keys):
+            # As many entries as keep the batch within PAIR_BATCH pairs
+            done = bounds[entry - 1] if entry else 0
+            stop = max(int(np.searchsorted(bounds, done + self.PAIR_BATCH, side='right')), entry + 1)
+            counts = later[entry:stop]
+            a = np.repeat(np.arange(entry, stop), counts)
+            b = a + 1 + np.arange(len(a)) - np.repeat(np.cumsum(counts) - counts, counts)
+            entry = stop
+            ra, rb = rows[a], rows[b]
+            shared = np.maximum(low[ra], low[rb])
+            lowest = _pack(shared[:, 0], shared[:, 1], shared[:, 2]) == keys[a]
+            ra, rb = ra[lowest], rb[lowest]
+            tested += len(ra)
+            overlap = boxes_overlap(min_corners[ra], max_corners[ra], min_corners[rb], max_corners[rb])
+            found.append(_id_pairs(ids[ra[overlap]], ids[rb[overlap]]))
+
+        # Oversized boxes are in no cell: test each against every box,
+        # pairing two oversized boxes only once
+        every = np.arange(n)
+        for row in np.flatnonzero(big).tolist():
+            candidates = (every != row) & (~big | (every > row))
+            tested += int(candidates.sum())
+            overlap = candidates & boxes_overlap(min_corners[row], max_corners[row], min_corners, max_corners)
+            found.append(_id_pairs(np.full(int(overlap.sum()), ids[row]), ids[overlap]))
+
+        pairs = np.concatenate(found) if found else np.zeros((0, 2), dtype=np.int64)
+        self._record(began, tested, len(pairs))
+        return pairs
+
+    def _record(self, began, tested, found):
+        seconds = time.perf_counter() - began
+        self.stats = {'candidates': tested, 'contacts': found, 'ms': 1000.0 * seconds}
+        if PROFILER.enabled:
+            PROFILER.add_time('collision', seconds)
+            PROFILER.count('collision_candidates', tested)
+            PROFILER.count('contacts', found)
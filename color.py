@@ -1,16 +1,16 @@
-#Contains Color Definitions
-COLORS = [
-    (0.8, 0.0, 0.0),  # Red
-    (0.0, 0.8, 0.0),  # Green
-    (0.0, 0.0, 0.8),  # Blue
-    (0.8, 0.8, 0.0),  # Yellow
-    (0.8, 0.0, 0.8),  # Magenta
-    (0.0, 0.8, 0.8),  # Cyan
-    (0.5, 0.5, 0.5),  # Gray
-    (0.8, 0.5, 0.0),  # Orange
-    (0.0, 0.5, 0.8),  # Light Blue
-    (0.8, 0.0, 0.5),  # Pink
-]
-
-MIN_COLOR = 0
+#Contains Color Definitions
+COLORS = [
+    (0.8, 0.0, 0.0),  # Red
+    (0.0, 0.8, 0.0),  # Green
+    (0.0, 0.0, 0.8),  # Blue
+    (0.8, 0.8, 0.0),  # Yellow
+    (0.8, 0.0, 0.8),  # Magenta
+    (0.0, 0.8, 0.8),  # Cyan
+    (0.5, 0.5, 0.5),  # Gray
+    (0.8, 0.5, 0.0),  # Orange
+    (0.0, 0.5, 0.8),  # Light Blue
+    (0.8, 0.0, 0.5),  # Pink
+]
+
+MIN_COLOR = 0
 MAX_COLOR = len(COLORS) - 1
\ No newline at end of file
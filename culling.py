@@ -0,0 +1,77 @@
+# View frustum culling against world-space node bounds
+import numpy as np
+
+
+def frustum_planes(matrix):
+    """
+    The six clip planes (left, right, bottom, top, near, far) of a combined
+    projection . model-view matrix, as rows (a, b, c, d) with the inside
+    where a*x + b*y + c*z + d >= 0.
+    """
+    w = matrix[3]
+    planes = np.array([w + matrix[0], w - matrix[0],
+                       w + matrix[1], w - matrix[1],
+                       w + matrix[2], w - matrix[2]])
+    return planes / np.linalg.norm(planes[:, :3], axis=1)[:, None]
+
+
+def boxes_in_frustum(planes, min_corners, max_corners):
+    """
+    Boolean mask of the boxes that are at least partly inside all planes.
+
+    For every plane only the box corner furthest along its normal is
+    tested; if even that one is outside, so is the whole box.
+    """
+    normals = planes[:, :3]
+    positive = normals > 0
+    # (N, 6, 3): per box and plane, the corner furthest along the normal
+    corners = np.where(positive[None, :, :], max_corners[:, None, :], min_corners[:, None, :])
+    distances = np.einsum('npk,pk->np', corners, normals) + planes[:, 3]
+    return (distances >= 0).all(axis=1)
+
+
+def signed_area(polygon):
+    x, y = polygon[:, 0], polygon[:, 1]
+    return 0.5 * np.sum(x * np.roll(y, -1) - np.roll(x, -1) * y)
+
+
+def is_convex(polygon):
+    edges = np.roll(polygon, -1, axis=0) - polygon
+    turns = edges[:, 0] * np.roll(edges[:, 1], -1) - edges[:, 1] * np.roll(edges[:, 0], -1)
+    return bool((turns >= 0).all() or (turns <= 0).all())
+
+
+def region_planes(matrix, polygon):
+    """
+    Clip planes of the part of the view frustum of a combined matrix that
+    projects into a convex polygon of normalized device coordinates: one
+    plane through the eye per polygon edge, then the near and far planes.
+    Rows are laid out as in frustum_planes.
+    """
+    polygon = np.asarray(polygon, dtype=np.float64)
+    if signed_area(polygon) < 0:
+        polygon = polygon[::-1]
+    a, b = polygon, np.roll(polygon, -1, axis=0)
+    edge = b - a
+    x, y, w = matrix[0], matrix[1], matrix[3]
+    # Inside is left of each counter-clockwise edge a -> b,
+    # edge x (p - a) >= 0, multiplied through by the clip w
+    planes = (edge[:, 0, None] * (y[None, :] - a[:, 1, None] * w[None, :]) -
+              edge[:, 1, None] * (x[None, :] - a[:, 0, None] * w[None, :]))
+    planes = np.vstack([planes, w + matrix[2], w - matrix[2]])
+    return planes / np.linalg.norm(planes[:, :3], axis=1)[:, None]
+
+
+def points_in_polygon(points, polygon):
+    """
+    Boolean mask of the 2D points inside a polygon, which may be concave,
+    by the even-odd rule.
+    """
+    x, y = points[:, 0], points[:, 1]
+    inside = np.zeros(len(points), dtype=bool)
+    for (ax, ay), (bx, by) in zip(polygon, np.roll(polygon, -1, axis=0)):
+        crosses = (ay > y) != (by > y)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            at = ax + (y - ay) * (bx - ax) / (by - ay)
+        inside ^= crosses & (x < at)
+    return inside
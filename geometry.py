@@ -0,0 +1,124 @@
+# Shared, reference-counted display lists for primitive geometry
+from collections import OrderedDict
+import numpy as np
+from OpenGL.GL import glDeleteLists
+
+
+class GeometryCache(object):
+    """
+    Display lists shared by every node with the same geometry key, e.g.
+    ('sphere', radius, slices, stacks).
+
+    Each node acquires an entry the first time it renders and releases it
+    when it is removed from the scene. Entries nobody references are kept
+    in an LRU of up to keep_unused lists, so a node that is removed and
+    re-added does not recompile; anything beyond that is deleted from GL.
+    """
+    def __init__(self, keep_unused=0):
+        self.keep_unused = keep_unused
+        self.entries = {}
+        self.refcounts = {}
+        self.unused = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def acquire(self, key, factory):
+        """
+        Return the display list for key, compiling it with factory() on a miss.
+        """
+        display_list = self.entries.get(key)
+        if display_list is None:
+            self.misses += 1
+            display_list = self.entries[key] = factory()
+            self.refcounts[key] = 0
+        else:
+            self.hits += 1
+            self.unused.pop(key, None)
+        self.refcounts[key] += 1
+        return display_list
+
+    def release(self, key):
+        if key not in self.refcounts:
+            return
+        self.refcounts[key] -= 1
+        if self.refcounts[key] > 0:
+            return
+        self.unused[key] = True
+        while len(self.unused) > self.keep_unused:
+            oldest, _ = self.unused.popitem(last=False)
+            self.evict(oldest)
+
+    def evict(self, key):
+        glDeleteLists(self.entries.pop(key), 1)
+        del self.refcounts[key]
+        self.unused.pop(key, None)
+        self.evictions += 1
+
+    def clear(self):
+        for key in list(self.entries):
+            self.evict(key)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self.entries),
+            'unused': len(self.unused),
+            'references': sum(self.refcounts.values()),
+        }
+
+
+GEOMETRY_CACHE = GeometryCache()
+
+
+def cube_mesh(size=1.0):
+    """
+    Interleaved position/normal triangle list of an axis-aligned cube
+    centred on the origin, wound counter-clockwise seen from outside.
+    """
+    h = size / 2.0
+    faces = [
+        # normal, and the two in-face axes whose cross product is the normal
+        ((0, 0, 1), (1, 0, 0), (0, 1, 0)),
+        ((0, 0, -1), (0, 1, 0), (1, 0, 0)),
+        ((0, 1, 0), (0, 0, 1), (1, 0, 0)),
+        ((0, -1, 0), (1, 0, 0), (0, 0, 1)),
+        ((-1, 0, 0), (0, 0, 1), (0, 1, 0)),
+        ((1, 0, 0), (0, 1, 0), (0, 0, 1)),
+    ]
+    data = []
+    for normal, u, v in faces:
+        n, u, v = np.array(normal), np.array(u), np.array(v)
+        quad = [h * (n - u - v), h * (n + u - v), h * (n + u + v), h * (n - u + v)]
+        for i in (0, 1, 2, 0, 2, 3):
+            data.append(np.concatenate([quad[i], n]))
+    return np.array(data, dtype=np.float32)
+
+
+def sphere_mesh(radius=0.5, slices=16, stacks=16):
+    """
+    Interleaved position/normal triangle list of a UV sphere around the z
+    axis, tessellated like gluSphere.
+    """
+    theta = np.linspace(0.0, np.pi, stacks + 1)
+    phi = np.linspace(0.0, 2.0 * np.pi, slices + 1)
+    st, sp = np.meshgrid(theta, phi, indexing='ij')
+    normals = np.stack([np.sin(st) * np.cos(sp), np.sin(st) * np.sin(sp), np.cos(st)], axis=-1)
+    i, j = np.meshgrid(np.arange(stacks), np.arange(slices), indexing='ij')
+    a, b = normals[i, j], normals[i + 1, j]
+    c, d = normals[i + 1, j + 1], normals[i, j + 1]
+    triangles = np.stack([a, b, c, a, c, d], axis=2).reshape(-1, 3)
+    return np.hstack([triangles * radius, triangles]).astype(np.float32)
+
+
+def mesh_for_key(key):
+    """
+    Triangle mesh for a GeometryCache key.
+    """
+    if key[0] == 'cube':
+        return cube_mesh()
+    if key[0] == 'sphere':
+        return sphere_mesh(*key[1:])
+    raise ValueError("No mesh for geometry %r" % (key,))
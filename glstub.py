@@ -0,0 +1,156 @@
+# Recording stand-in for the OpenGL, GLU and GLUT modules
+"""
+Headless replacement for PyOpenGL, for benchmarks and batch jobs on
+machines without a display or GPU.
+
+install() puts stub OpenGL.GL, OpenGL.GLU and OpenGL.GLUT modules into
+sys.modules; it must run before any module of this package is imported.
+Every stub entry point only counts its calls in RECORDER. The names the
+stubs export are collected from the sources next to this file, so new GL
+calls in the engine are picked up without editing a list here.
+"""
+import collections
+import glob
+import os
+import re
+import sys
+import types
+
+NAME_PATTERN = re.compile(r'\b(gl[A-Z]\w*|glu[A-Z]\w*|glut[A-Z]\w*|GL_\w+|GLU_\w+|GLUT_\w+)\b')
+
+# Constants whose values the engine compares against
+CONSTANTS = {
+    'GL_FALSE': 0, 'GL_TRUE': 1,
+    'GLUT_LEFT_BUTTON': 0, 'GLUT_MIDDLE_BUTTON': 1, 'GLUT_RIGHT_BUTTON': 2,
+    'GLUT_DOWN': 0, 'GLUT_UP': 1,
+    'GLUT_KEY_LEFT': 100, 'GLUT_KEY_UP': 101, 'GLUT_KEY_RIGHT': 102, 'GLUT_KEY_DOWN': 103,
+    'GLUT_WINDOW_WIDTH': 102, 'GLUT_WINDOW_HEIGHT': 103,
+    'GLUT_ACTIVE_SHIFT': 1, 'GLUT_ACTIVE_CTRL': 2, 'GLUT_ACTIVE_ALT': 4,
+    'GLUT_NORMAL_DAMAGED': 804,
+}
+
+
+class Recorder(object):
+    """
+    Counts calls per GL entry point.
+    """
+    def __init__(self):
+        self.calls = collections.Counter()
+        self.window_size = (640, 480)
+        # What glutLayerGet reports: set to act out an expose event
+        self.damaged = False
+        self.next_name = 1
+
+    def reset(self):
+        self.calls.clear()
+
+    def total(self):
+        return sum(self.calls.values())
+
+    def generate_name(self):
+        name = self.next_name
+        self.next_name += 1
+        return name
+
+
+RECORDER = Recorder()
+
+
+def _glut_get(what):
+    if what == CONSTANTS['GLUT_WINDOW_WIDTH']:
+        return RECORDER.window_size[0]
+    if what == CONSTANTS['GLUT_WINDOW_HEIGHT']:
+        return RECORDER.window_size[1]
+    return 0
+
+
+def _glut_layer_get(what):
+    if what == CONSTANTS['GLUT_NORMAL_DAMAGED']:
+        return int(RECORDER.damaged)
+    return 0
+
+
+def _identity(*args):
+    return [[float(i == j) for j in range(4)] for i in range(4)]
+
+
+RETURNS = {
+    'glGenLists': lambda n: RECORDER.generate_name(),
+    'glGenBuffers': lambda n: RECORDER.generate_name(),
+    'glCreateProgram': lambda: RECORDER.generate_name(),
+    'glGetProgramiv': lambda program, name: 1,
+    'glGetProgramInfoLog': lambda program: '',
+    'glGetFloatv': _identity,
+    'glutGet': _glut_get,
+    'glutGetModifiers': lambda: 0,
+    'glutLayerGet': _glut_layer_get,
+    'glutCreateWindow': lambda title: 1,
+    'gluNewQuadric': lambda: object(),
+    'gluUnProject': lambda x, y, z, *args: (0.0, 0.0, 0.0),
+    'compileShader': lambda source, kind: RECORDER.generate_name(),
+}
+
+
+class StubFunction(object):
+    def __init__(self, name):
+        self.name = name
+        self.result = RETURNS.get(name)
+
+    def __call__(self, *args):
+        RECORDER.calls[self.name] += 1
+        if self.result is not None:
+            return self.result(*args)
+        return None
+
+    def __bool__(self):
+        # PyOpenGL functions are falsy when the driver lacks them
+        return True
+
+
+def _module(name, names):
+    module = types.ModuleType(name)
+    for attr in names:
+        if attr[0].isupper():
+            value = CONSTANTS.get(attr)
+            setattr(module, attr, value if value is not None else 0x10000 + len(module.__dict__))
+        else:
+            setattr(module, attr, StubFunction(attr))
+    module.__all__ = sorted(names)
+    return module
+
+
+def collect_names(directory=None):
+    directory = directory or os.path.dirname(os.path.abspath(__file__))
+    names = set(CONSTANTS)
+    for path in glob.glob(os.path.join(directory, '*.py')):
+        with open(path) as source:
+            names.update(NAME_PATTERN.findall(source.read()))
+    return names
+
+
+def install(window_size=(640, 480)):
+    """
+    Replace the OpenGL modules with recording stubs. Returns the recorder.
+    """
+    RECORDER.window_size = window_size
+    names = collect_names()
+    glut = set(n for n in names if n.startswith(('glut', 'GLUT_')))
+    glu = set(n for n in names if n.startswith(('glu', 'GLU_'))) - glut
+    gl = names - glut - glu
+
+    package = types.ModuleType('OpenGL')
+    package.__path__ = []
+    gl_module = _module('OpenGL.GL', gl)
+    shaders = _module('OpenGL.GL.shaders', ['compileShader', 'compileProgram'])
+    gl_module.shaders = shaders
+    package.GL = gl_module
+    package.GLU = _module('OpenGL.GLU', glu)
+    package.GLUT = _module('OpenGL.GLUT', glut)
+    sys.modules.update({
+        'OpenGL': package,
+        'OpenGL.GL': gl_module,
+        'OpenGL.GL.shaders': shaders,
+        'OpenGL.GLU': package.GLU,
+        'OpenGL.GLUT': package.GLUT,
+    })
+    return RECORDER
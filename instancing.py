@@ -0,0 +1,340 @@
+# Instanced rendering of scene nodes grouped by primitive geometry
+import ctypes
+import numpy as np
+from OpenGL.GL import *
+from OpenGL.GL import shaders
+from color import COLORS
+from geometry import mesh_for_key
+from profiling import PROFILER
+
+VERTEX_SHADER = """
+#version 120
+attribute vec3 position;
+attribute vec3 normal;
+attribute mat4 instance_matrix;
+attribute vec4 instance_color;
+varying vec4 color;
+
+void main() {
+    gl_Position = gl_ModelViewProjectionMatrix * (instance_matrix * vec4(position, 1.0));
+    vec3 n = normalize(gl_NormalMatrix * (mat3(instance_matrix) * normal));
+    vec3 l = normalize(gl_LightSource[0].position.xyz);
+    vec3 light = gl_LightModel.ambient.rgb + gl_LightSource[0].diffuse.rgb * max(dot(n, l), 0.0);
+    // instance_color.a carries the selection emission
+    color = vec4(instance_color.rgb * light + vec3(instance_color.a), 1.0);
+}
+"""
+
+FRAGMENT_SHADER = """
+#version 120
+varying vec4 color;
+
+void main() {
+    gl_FragColor = color;
+}
+"""
+
+POSITION, NORMAL, INSTANCE_MATRIX, INSTANCE_COLOR = 0, 1, 2, 6
+SELECTED_EMISSION = 0.3
+FLOAT_SIZE = 4
+
+
+class InstanceGroup(object):
+    """
+    All primitives sharing one geometry key, with their model matrices and
+    colors in contiguous arrays mirrored into one GL buffer. Only the span
+    of rows touched since the last frame is uploaded.
+
+    owners holds the id of the top-level node each row belongs to. When
+    some of those are outside the view, only the visible rows are packed
+    into a second buffer and drawn.
+
+    Shapes with LOD tiers get one mesh per tier, and each frame the rows
+    are drawn with one call per tier in use.
+    """
+    def __init__(self, key, lod_keys=None, lod_triangles=None):
+        self.key = key
+        self.lod_keys = lod_keys
+        self.lod_triangles = lod_triangles
+        self.store = None
+        self.nodes = []
+        self.slots = {}
+        self.owners = np.zeros(0, dtype=np.int64)
+        self.leaf_ids = np.zeros(0, dtype=np.int64)
+        self.matrices = np.zeros((0, 4, 4), dtype=np.float32)
+        self.colors = np.zeros((0, 4), dtype=np.float32)
+        self.dirty_lo, self.dirty_hi = 0, 0
+        self.resized = True
+
+        self.mesh_buffers, self.vertex_counts = [], []
+        for mesh_key in lod_keys or (key,):
+            mesh = mesh_for_key(mesh_key)
+            buffer = glGenBuffers(1)
+            glBindBuffer(GL_ARRAY_BUFFER, buffer)
+            glBufferData(GL_ARRAY_BUFFER, mesh.nbytes, mesh, GL_STATIC_DRAW)
+            self.mesh_buffers.append(buffer)
+            self.vertex_counts.append(len(mesh))
+        self.instance_buffer = glGenBuffers(1)
+        self.visible_buffer = glGenBuffers(1)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def _reserve(self, n):
+        i = len(self.nodes)
+        if n <= len(self.matrices):
+            return
+        capacity = max(16, 2 * len(self.matrices), n)
+        owners = np.zeros(capacity, dtype=np.int64)
+        leaf_ids = np.zeros(capacity, dtype=np.int64)
+        matrices = np.zeros((capacity, 4, 4), dtype=np.float32)
+        colors = np.zeros((capacity, 4), dtype=np.float32)
+        owners[:i] = self.owners[:i]
+        leaf_ids[:i] = self.leaf_ids[:i]
+        matrices[:i] = self.matrices[:i]
+        colors[:i] = self.colors[:i]
+        self.owners, self.leaf_ids, self.matrices, self.colors = owners, leaf_ids, matrices, colors
+        self.resized = True
+
+    def add(self, node, owner, selected):
+        i = len(self.nodes)
+        self._reserve(i + 1)
+        self.nodes.append(node)
+        self.slots[node] = i
+        self.owners[i] = owner
+        self.leaf_ids[i] = node.id
+        self.store = node.store
+        self.update(node, selected)
+
+    def extend(self, nodes, owners, selected):
+        """
+        Append rows for many nodes, written as one block.
+        """
+        i = len(self.nodes)
+        n = i + len(nodes)
+        self._reserve(n)
+        self.nodes.extend(nodes)
+        self.slots.update((node, i + k) for k, node in enumerate(nodes))
+        self.owners[i:n] = owners
+        self.leaf_ids[i:n] = [node.id for node in nodes]
+        self.store = nodes[0].store
+        self.matrices[i:n] = np.array([node.world_matrix.T for node in nodes])
+        self.colors[i:n, :3] = [COLORS[node.color_index] for node in nodes]
+        self.colors[i:n, 3] = np.where(selected, SELECTED_EMISSION, 0.0)
+        self._touch(i)
+        self._touch(n - 1)
+
+    def remove(self, node):
+        i = self.slots.pop(node)
+        last = len(self.nodes) - 1
+        moved = self.nodes.pop()
+        if i != last:
+            self.nodes[i] = moved
+            self.slots[moved] = i
+            self.owners[i] = self.owners[last]
+            self.leaf_ids[i] = self.leaf_ids[last]
+            self.matrices[i] = self.matrices[last]
+            self.colors[i] = self.colors[last]
+            self._touch(i)
+
+    def update(self, node, selected):
+        i = self.slots[node]
+        # Stored transposed, so each row is one column of the attribute mat4
+        self.matrices[i] = node.world_matrix.T
+        self.colors[i, :3] = COLORS[node.color_index]
+        self.colors[i, 3] = SELECTED_EMISSION if selected else 0.0
+        self._touch(i)
+
+    def _touch(self, i):
+        if self.dirty_lo == self.dirty_hi:
+            self.dirty_lo, self.dirty_hi = i, i + 1
+        else:
+            self.dirty_lo, self.dirty_hi = min(self.dirty_lo, i), max(self.dirty_hi, i + 1)
+
+    def upload(self):
+        glBindBuffer(GL_ARRAY_BUFFER, self.instance_buffer)
+        capacity = len(self.matrices)
+        if self.resized:
+            glBufferData(GL_ARRAY_BUFFER, capacity * 20 * FLOAT_SIZE, None, GL_DYNAMIC_DRAW)
+            glBufferSubData(GL_ARRAY_BUFFER, 0, self.matrices.nbytes, self.matrices)
+            glBufferSubData(GL_ARRAY_BUFFER, self.matrices.nbytes, self.colors.nbytes, self.colors)
+            self.resized = False
+        elif self.dirty_lo < self.dirty_hi:
+            lo, hi = self.dirty_lo, self.dirty_hi
+            glBufferSubData(GL_ARRAY_BUFFER, lo * 16 * FLOAT_SIZE, (hi - lo) * 16 * FLOAT_SIZE, self.matrices[lo:hi])
+            glBufferSubData(GL_ARRAY_BUFFER, (capacity * 16 + lo * 4) * FLOAT_SIZE,
+                            (hi - lo) * 4 * FLOAT_SIZE, self.colors[lo:hi])
+        self.dirty_lo, self.dirty_hi = 0, 0
+
+    def _upload_visible(self, shown):
+        # The visible rows packed together, matrices then colors
+        count = int(shown.sum())
+        glBindBuffer(GL_ARRAY_BUFFER, self.visible_buffer)
+        glBufferData(GL_ARRAY_BUFFER, count * 20 * FLOAT_SIZE, None, GL_STREAM_DRAW)
+        glBufferSubData(GL_ARRAY_BUFFER, 0, count * 16 * FLOAT_SIZE, self.matrices[:len(shown)][shown])
+        glBufferSubData(GL_ARRAY_BUFFER, count * 16 * FLOAT_SIZE, count * 4 * FLOAT_SIZE, self.colors[:len(shown)][shown])
+        return count
+
+    def tiers(self, lod, view=None, shown=None):
+        """
+        The LOD tier of every row. With view, the projection, model-view
+        and viewport height of this frame, lod picks them again first for
+        the rows set in shown, or for all rows.
+        """
+        count = len(self.nodes)
+        ids = self.leaf_ids[:count]
+        tiers = self.store.lod_tiers[ids].astype(np.int64)
+        if view is not None:
+            rows = shown if shown is not None else slice(None)
+            matrices = self.matrices[:count][rows]
+            # Rows are transposed world matrices: row 3 is the center and
+            # row 0 the scaled x axis
+            radii = self.store.bounds_max[ids[rows], 0] * np.linalg.norm(matrices[:, 0, :3], axis=1)
+            tiers[rows] = lod.update_rows(self.store, ids[rows], matrices[:, 3].astype(np.float64), radii,
+                                          self.lod_triangles, *view)
+        return tiers
+
+    def draw(self, visible=None, lod=None, view=None):
+        """
+        Draw the group's instances, or only those whose owner is set in
+        visible, a mask over node ids. Shapes with LOD tiers draw each row
+        with the mesh of its tier, chosen by lod for view when given.
+        """
+        if not self.nodes:
+            return
+        self.upload()
+        count = len(self.nodes)
+        shown = None
+        if visible is not None:
+            shown = visible[self.owners[:count]]
+            if shown.all():
+                shown = None
+        if self.lod_keys is None or lod is None:
+            self._draw_rows(0, shown)
+            return
+        tiers = self.tiers(lod, view, shown)
+        for tier in np.unique(tiers if shown is None else tiers[shown]).tolist():
+            rows = tiers == tier
+            if shown is not None:
+                rows &= shown
+            self._draw_rows(tier, None if rows.all() else rows)
+
+    def _draw_rows(self, mesh, rows):
+        # All rows from the instance buffer, or the masked ones packed
+        buffer, count, capacity = self.instance_buffer, len(self.nodes), len(self.matrices)
+        if rows is not None:
+            count = capacity = self._upload_visible(rows)
+            if not count:
+                return
+            buffer = self.visible_buffer
+        glBindBuffer(GL_ARRAY_BUFFER, self.mesh_buffers[mesh])
+        glVertexAttribPointer(POSITION, 3, GL_FLOAT, GL_FALSE, 6 * FLOAT_SIZE, ctypes.c_void_p(0))
+        glVertexAttribPointer(NORMAL, 3, GL_FLOAT, GL_FALSE, 6 * FLOAT_SIZE, ctypes.c_void_p(3 * FLOAT_SIZE))
+
+        glBindBuffer(GL_ARRAY_BUFFER, buffer)
+        for column in range(4):
+            glVertexAttribPointer(INSTANCE_MATRIX + column, 4, GL_FLOAT, GL_FALSE, 16 * FLOAT_SIZE,
+                                  ctypes.c_void_p(column * 4 * FLOAT_SIZE))
+        glVertexAttribPointer(INSTANCE_COLOR, 4, GL_FLOAT, GL_FALSE, 4 * FLOAT_SIZE,
+                              ctypes.c_void_p(capacity * 16 * FLOAT_SIZE))
+        glDrawArraysInstanced(GL_TRIANGLES, 0, self.vertex_counts[mesh], count)
+        if PROFILER.enabled:
+            PROFILER.count('draw_calls')
+
+    def delete(self):
+        buffers = self.mesh_buffers + [self.instance_buffer, self.visible_buffer]
+        glDeleteBuffers(len(buffers), buffers)
+
+
+class InstancedRenderer(object):
+    """
+    Draws every primitive of a scene with one instanced call per geometry
+    key and LOD tier. The scene reports added, removed and changed nodes, and only
+    their rows are rewritten.
+    """
+    def __init__(self, scene):
+        self.groups = {}
+        self.program = None
+        self.supported = bool(glDrawArraysInstanced) and bool(glVertexAttribDivisor)
+        if not self.supported:
+            return
+        self.program = self._link_program()
+        for node in scene.node_list:
+            self.add(node)
+
+    def _link_program(self):
+        program = glCreateProgram()
+        glAttachShader(program, shaders.compileShader(VERTEX_SHADER, GL_VERTEX_SHADER))
+        glAttachShader(program, shaders.compileShader(FRAGMENT_SHADER, GL_FRAGMENT_SHADER))
+        for name, location in (('position', POSITION), ('normal', NORMAL),
+                               ('instance_matrix', INSTANCE_MATRIX), ('instance_color', INSTANCE_COLOR)):
+            glBindAttribLocation(program, location, name)
+        glLinkProgram(program)
+        if glGetProgramiv(program, GL_LINK_STATUS) != GL_TRUE:
+            raise RuntimeError(glGetProgramInfoLog(program))
+        return program
+
+    def _group(self, leaf):
+        group = self.groups.get(leaf.geometry_key)
+        if group is None:
+            group = self.groups[leaf.geometry_key] = InstanceGroup(leaf.geometry_key, leaf.lod_keys,
+                                                                   leaf.lod_triangles)
+        return group
+
+    def add(self, node):
+        for leaf in node.leaves():
+            self._group(leaf).add(leaf, node.id, node.selected)
+
+    def add_many(self, nodes):
+        batches = {}
+        for node in nodes:
+            for leaf in node.leaves():
+                leaves, owners, selected = batches.setdefault(leaf.geometry_key, ([], [], []))
+                leaves.append(leaf)
+                owners.append(node.id)
+                selected.append(node.selected)
+        for leaves, owners, selected in batches.values():
+            self._group(leaves[0]).extend(leaves, owners, selected)
+
+    def remove(self, node):
+        for leaf in node.leaves():
+            self.groups[leaf.geometry_key].remove(leaf)
+
+    def update(self, node):
+        for leaf in node.leaves():
+            self.groups[leaf.geometry_key].update(leaf, node.selected)
+
+    def render(self, visible=None, lod=None, view=None):
+        """
+        Draw every group; with visible, a boolean mask over node ids, only
+        the primitives of the top-level nodes it sets. With lod, a
+        LODSelector, shapes with tiers draw at their tier, picked again
+        for view, the projection, model-view and viewport height, if given.
+        """
+        if lod is not None and view is not None:
+            lod.reset_stats()
+        glUseProgram(self.program)
+        for location in (POSITION, NORMAL):
+            glEnableVertexAttribArray(location)
+        for location in range(INSTANCE_MATRIX, INSTANCE_COLOR + 1):
+            glEnableVertexAttribArray(location)
+            glVertexAttribDivisor(location, 1)
+
+        for group in self.groups.values():
+            group.draw(visible, lod, view)
+
+        for location in range(INSTANCE_MATRIX, INSTANCE_COLOR + 1):
+            glVertexAttribDivisor(location, 0)
+            glDisableVertexAttribArray(location)
+        for location in (POSITION, NORMAL):
+            glDisableVertexAttribArray(location)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        glUseProgram(0)
+
+    def delete(self):
+        for group in self.groups.values():
+            group.delete()
+        self.groups = {}
+        if self.program is not None:
+            glDeleteProgram(self.program)
+            self.program = None
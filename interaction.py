@@ -1,97 +1,188 @@
-from collections import defaultdict
-from OpenGL.GLUT import *
-
-# Trackball class to handle the matrix
-class Trackball:
-    def __init__(self):
-        self.matrix = self.create_identity_matrix()  # Store identity matrix by default
-
-    def create_identity_matrix(self):
-        # Return a 4x4 identity matrix (a list of lists)
-        return [
-            [1.0, 0.0, 0.0, 0.0],
-            [0.0, 1.0, 0.0, 0.0],
-            [0.0, 0.0, 1.0, 0.0],
-            [0.0, 0.0, 0.0, 1.0]
-        ]
-
-# Interaction class for handling user input
-class Interaction(object):
-    def __init__(self):
-        self.pressed = None
-        self.translation = [0, 0, 0]
-        self.mouse_loc = defaultdict(list)
-        self.callbacks = {}
-        self.trackball = Trackball()  # Use Trackball class to initialize trackball
-        self.register()
-
-    def register(self):
-        glutMouseFunc(self.handle_mouse_button)
-        glutMotionFunc(self.handle_mouse_move)
-        glutKeyboardFunc(self.handle_keystroke)
-        glutSpecialFunc(self.handle_keystroke)
-        
-    def translate(self, x, y, z):
-        self.translation[0] += x
-        self.translation[1] += y
-        self.translation[2] += z
-        
-    def handle_mouse_button(self, button, mode, x, y):
-        xSize, ySize = glutGet(GLUT_WINDOW_WIDTH), glutGet(GLUT_WINDOW_HEIGHT)
-        y = ySize - y
-        self.mouse_loc = (x, y)
-        
-        if mode == GLUT_DOWN:
-            self.pressed = button
-        if button == GLUT_RIGHT_BUTTON:
-            pass
-        elif button == GLUT_LEFT_BUTTON:
-            self.trigger('pick', x, y)
-        elif button == 3:
-            self.translate(0, 0, 1.0)
-        elif button == 4:
-            self.translate(0, 0, -1.0)
-        else:
-            self.pressed = None
-        glutPostRedisplay()
-        
-    def handle_mouse_move(self, x, screen_y):
-        xSize, ySize = glutGet(GLUT_WINDOW_WIDTH), glutGet(GLUT_WINDOW_HEIGHT)
-        y = ySize - screen_y
-        if self.pressed is not None:
-            dx = x - self.mouse_loc[0]
-            dy = y - self.mouse_loc[1]
-            if self.pressed == GLUT_RIGHT_BUTTON:
-                self.trigger('rotate', dx, dy)
-            elif self.pressed == GLUT_LEFT_BUTTON:
-                self.trigger('move', x, y)
-            elif self.pressed == GLUT_MIDDLE_BUTTON:
-                self.translate(dx / 60.0, dy / 60.0, 0)
-            glutPostRedisplay()
-        self.mouse_loc = (x, y)
-
-    def handle_keystroke(self, key, x, screen_y):
-        xSize, ySize = glutGet(GLUT_WINDOW_WIDTH), glutGet(GLUT_WINDOW_HEIGHT)
-        y = ySize - screen_y
-        if key == b's':
-            self.trigger('place', 'sphere', x, y)
-        elif key == b'c':
-            self.trigger('place', 'cube', x, y)
-        elif key == GLUT_KEY_UP:
-            self.trigger('scale', up=True)
-        elif key == GLUT_KEY_DOWN:
-            self.trigger('scale', up=False)
-        elif key == GLUT_KEY_LEFT:
-            self.trigger('rotate_color', forward=True)
-        elif key == GLUT_KEY_RIGHT:
-            self.trigger('rotate_color', forward=False)
-        glutPostRedisplay()
-
-    def register_callback(self, name, func):
-        if name not in self.callbacks:
-            self.callbacks[name] = []  # Initialize the list if it doesn't exist
-        self.callbacks[name].append(func)  # Now we can safely append the function
-
-    def trigger(self, name, *args, **kwargs):
-        for func in self.callbacks[name]:
-            func(*args, **kwargs)
+from collections import defaultdict
+from OpenGL.GLUT import *
+from profiling import PROFILER
+from trackball import Trackball
+import time
+
+# Interaction class for handling user input
+class Interaction(object):
+    # How queued motion callbacks are merged until the next flush:
+    # 'latest' keeps only the newest arguments, 'sum' adds them up.
+    # Callbacks without a policy are dispatched straight away.
+    COALESCE = {'move': 'latest', 'rotate': 'sum'}
+
+    def __init__(self):
+        self.coalesce = dict(self.COALESCE)
+        self.pending = {}
+        self.events_received = 0
+        self.events_dispatched = 0
+        self.window_size = (glutGet(GLUT_WINDOW_WIDTH), glutGet(GLUT_WINDOW_HEIGHT))
+        self.pressed = None
+        # Window points of the marquee or lasso being dragged out, or None
+        self.region = None
+        self.region_mode = None
+        self.mouse_loc = defaultdict(list)
+        self.callbacks = {}
+        # EventRecorder writing every dispatched callback, or None
+        self.recorder = None
+        # Camera orientation, distance and pan; right drags turn it
+        # through the 'rotate' callback
+        self.trackball = Trackball()
+        self.register()
+
+    def register(self):
+        glutMouseFunc(self.handle_mouse_button)
+        glutMotionFunc(self.handle_mouse_move)
+        glutKeyboardFunc(self.handle_keystroke)
+        glutSpecialFunc(self.handle_keystroke)
+        glutReshapeFunc(self.handle_reshape)
+        
+    def translate(self, x, y, z):
+        # Pan across the screen by x and y, move closer by z
+        if x or y:
+            self.trackball.pan(x, y)
+        if z:
+            self.trackball.zoom(z)
+        
+    def handle_reshape(self, width, height):
+        self.events_received += 1
+        self.window_size = (width, max(height, 1))
+        self.trigger('reshape', width, self.window_size[1])
+
+    def handle_mouse_button(self, button, mode, x, y):
+        self.events_received += 1
+        y = self.window_size[1] - y
+        self.mouse_loc = (x, y)
+        
+        if mode == GLUT_DOWN:
+            self.pressed = button
+        if button == GLUT_RIGHT_BUTTON:
+            pass
+        elif button == GLUT_LEFT_BUTTON:
+            modifiers = glutGetModifiers() if mode == GLUT_DOWN else 0
+            if modifiers & (GLUT_ACTIVE_SHIFT | GLUT_ACTIVE_CTRL):
+                # Shift drags out a selection rectangle, Ctrl a lasso
+                self.region_mode = 'rectangle' if modifiers & GLUT_ACTIVE_SHIFT else 'lasso'
+                self.region = [(x, y)]
+            elif self.region is not None:
+                region, self.region = self.region, None
+                if self.region_mode == 'rectangle':
+                    self.trigger('select_rectangle', region[0][0], region[0][1], x, y)
+                else:
+                    self.trigger('select_lasso', region + [(x, y)])
+            else:
+                self.trigger('pick', x, y)
+        elif button == 3:
+            self.translate(0, 0, 1.0)
+        elif button == 4:
+            self.translate(0, 0, -1.0)
+        else:
+            self.pressed = None
+        glutPostRedisplay()
+        
+    def handle_mouse_move(self, x, screen_y):
+        self.events_received += 1
+        y = self.window_size[1] - screen_y
+        if self.region is not None:
+            if self.region_mode == 'rectangle':
+                self.region = [self.region[0], (x, y)]
+            else:
+                self.region.append((x, y))
+            self.trigger('region_changed')
+            glutPostRedisplay()
+        elif self.pressed is not None:
+            dx = x - self.mouse_loc[0]
+            dy = y - self.mouse_loc[1]
+            if self.pressed == GLUT_RIGHT_BUTTON:
+                self.queue('rotate', dx, dy)
+            elif self.pressed == GLUT_LEFT_BUTTON:
+                self.queue('move', x, y)
+            elif self.pressed == GLUT_MIDDLE_BUTTON:
+                self.translate(dx / 60.0, dy / 60.0, 0)
+            glutPostRedisplay()
+        self.mouse_loc = (x, y)
+
+    def handle_keystroke(self, key, x, screen_y):
+        self.events_received += 1
+        y = self.window_size[1] - screen_y
+        if key == b's':
+            self.trigger('place', 'sphere', x, y)
+        elif key == b'c':
+            self.trigger('place', 'cube', x, y)
+        elif key in (b'\x7f', b'\x08'):
+            self.trigger('remove')
+        elif key == b'i':
+            self.trigger('toggle_instancing')
+        elif key == b'p':
+            self.trigger('toggle_profiling')
+        elif key == b'w':
+            self.trigger('save')
+        elif key == b'k':
+            self.trigger('toggle_collisions')
+        elif key == b'v':
+            self.trigger('reset_view')
+        elif key == GLUT_KEY_UP:
+            self.trigger('scale', up=True)
+        elif key == GLUT_KEY_DOWN:
+            self.trigger('scale', up=False)
+        elif key == GLUT_KEY_LEFT:
+            self.trigger('rotate_color', forward=True)
+        elif key == GLUT_KEY_RIGHT:
+            self.trigger('rotate_color', forward=False)
+        glutPostRedisplay()
+
+    def register_callback(self, name, func):
+        if name not in self.callbacks:
+            self.callbacks[name] = []  # Initialize the list if it doesn't exist
+        self.callbacks[name].append(func)  # Now we can safely append the function
+
+    def queue(self, name, *args):
+        """
+        Hold a motion callback until the next flush, merged with any queued
+        call of the same name according to its coalescing policy.
+        """
+        policy = self.coalesce.get(name)
+        if policy is None:
+            self.trigger(name, *args)
+            return
+        queued = self.pending.get(name)
+        if queued is not None and policy == 'sum':
+            args = tuple(a + b for a, b in zip(queued, args))
+        self.pending[name] = args
+
+    def flush(self):
+        """
+        Dispatch the queued motion callbacks, once per frame.
+        """
+        pending, self.pending = self.pending, {}
+        for name, args in pending.items():
+            self.dispatch(name, *args)
+
+    def trigger(self, name, *args, **kwargs):
+        # Anything queued happened first, so it must be delivered first
+        if self.pending:
+            self.flush()
+        self.dispatch(name, *args, **kwargs)
+
+    def dispatch(self, name, *args, **kwargs):
+        if self.recorder is not None:
+            self.recorder.record(name, args, kwargs)
+        funcs = self.callbacks.get(name, ())
+        if funcs:
+            self.events_dispatched += 1
+        if not PROFILER.enabled:
+            for func in funcs:
+                func(*args, **kwargs)
+            return
+        start = time.perf_counter()
+        for func in funcs:
+            func(*args, **kwargs)
+        PROFILER.record_callback(name, time.perf_counter() - start)
+        PROFILER.count('callbacks')
+
+    def stats(self):
+        return {
+            'received': self.events_received,
+            'dispatched': self.events_dispatched,
+            'pending': len(self.pending),
+        }
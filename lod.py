@@ -0,0 +1,98 @@
+# Screen-space level of detail for curved primitives
+import numpy as np
+
+
+class LODSelector(object):
+    """
+    Picks a tessellation tier for each primitive from the size it covers
+    on screen, measured as its projected diameter in pixels.
+
+    thresholds[i] is the size at which tier i + 1 takes over from tier i.
+    A node only moves up past a threshold once it is hysteresis above it,
+    and only drops back once it is hysteresis below it, so a node sitting
+    on a boundary does not pop between tiers every frame.
+    """
+    def __init__(self, thresholds=(8.0, 32.0, 128.0), hysteresis=0.2):
+        self.enabled = True
+        self.set_thresholds(thresholds, hysteresis)
+        self.reset_stats()
+
+    def set_thresholds(self, thresholds, hysteresis=None):
+        thresholds = np.asarray(thresholds, dtype=np.float64)
+        if np.any(np.diff(thresholds) <= 0):
+            raise ValueError("LOD thresholds must be increasing")
+        self.thresholds = thresholds
+        if hysteresis is not None:
+            self.hysteresis = hysteresis
+
+    def choose(self, current, sizes):
+        """
+        New tiers for nodes of the given current tiers and screen sizes.
+        """
+        # Lowest tier the size has clearly outgrown, and highest it still fits
+        lowest = np.searchsorted(self.thresholds * (1.0 + self.hysteresis), sizes)
+        highest = np.searchsorted(self.thresholds * (1.0 - self.hysteresis), sizes)
+        return np.clip(current, lowest, highest)
+
+    def reset_stats(self):
+        tiers = len(self.thresholds) + 1
+        self.triangles = np.zeros(tiers, dtype=np.int64)
+        self.nodes = np.zeros(tiers, dtype=np.int64)
+
+    def screen_sizes(self, centers, radii, projection, model_view, viewport_height):
+        """
+        Projected diameters in pixels of spheres given by homogeneous world
+        centers and radii.
+        """
+        # Clip w is the distance in front of the eye
+        w = np.maximum(np.dot(centers, np.dot(projection, model_view)[3]), 1e-6)
+        # projection[1, 1] is the vertical focal length
+        return 2.0 * radii * projection[1, 1] / w * (viewport_height / 2.0)
+
+    def update(self, nodes, projection, model_view, viewport_height):
+        """
+        Assign lod_tier to every primitive in nodes that has tiers, as seen
+        through the given camera matrices and viewport height. Also
+        refreshes the per-tier node and triangle counts of this frame.
+        """
+        self.reset_stats()
+        nodes = [node for node in nodes if getattr(node, 'lod_keys', None) is not None]
+        if not self.enabled or not nodes:
+            return
+        store = nodes[0].store
+        ids = np.array([node.id for node in nodes])
+        worlds = np.array([node.world_matrix for node in nodes])
+        # Nodes are scaled uniformly, so any column gives the scale
+        radii = store.bounds_max[ids, 0] * np.linalg.norm(worlds[:, :3, 0], axis=1)
+        sizes = self.screen_sizes(worlds[:, :, 3], radii, projection, model_view, viewport_height)
+        # Shapes may have fewer tiers than there are thresholds
+        limits = np.array([len(node.lod_keys) - 1 for node in nodes])
+        current = store.lod_tiers[ids].astype(np.int64)
+        chosen = np.minimum(self.choose(current, sizes), limits)
+        triangles = np.array([node.lod_triangles[tier] for node, tier in zip(nodes, chosen)])
+        store.lod_tiers[ids] = chosen
+        self._count(chosen, triangles)
+
+    def update_rows(self, store, ids, centers, radii, lod_triangles, projection, model_view, viewport_height):
+        """
+        Like update, for primitives of one shape given as arrays of store
+        ids, world centers and radii, the way the instanced renderer holds
+        them. Adds to this frame's counts instead of resetting them, and
+        returns the tiers.
+        """
+        if not self.enabled or not len(ids):
+            return store.lod_tiers[ids].astype(np.int64)
+        sizes = self.screen_sizes(centers, radii, projection, model_view, viewport_height)
+        current = store.lod_tiers[ids].astype(np.int64)
+        chosen = np.minimum(self.choose(current, sizes), len(lod_triangles) - 1)
+        store.lod_tiers[ids] = chosen
+        self._count(chosen, np.asarray(lod_triangles)[chosen])
+        return chosen
+
+    def _count(self, chosen, triangles):
+        tiers = len(self.thresholds) + 1
+        self.nodes += np.bincount(chosen, minlength=tiers)
+        self.triangles += np.bincount(chosen, weights=triangles, minlength=tiers).astype(np.int64)
+
+    def stats(self):
+        return {'nodes': self.nodes.tolist(), 'triangles': self.triangles.tolist()}
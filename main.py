@@ -1,6 +1,36 @@
-#Entry Point for the Application
-from viewer import Viewer
-
-if __name__ == "__main__":
-    viewer = Viewer()
-    viewer.main_loop()
\ No newline at end of file
+#Entry Point for the Application
+import argparse
+import atexit
+from profiling import PROFILER
+from viewer import Viewer
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="3D Render viewer")
+    parser.add_argument('scene', nargs='?', help="scene file to open, and to save to with the W key")
+    parser.add_argument('--record', metavar='PATH', help="record the session's input events to PATH, for recording.py to replay")
+    parser.add_argument('--generate', type=int, metavar='N', help="stream N generated nodes into the scene in the background")
+    parser.add_argument('--profile-dump', metavar='PATH', help="profile from the first frame and write the results to PATH")
+    parser.add_argument('--profile-format', choices=('json', 'csv'), default='json',
+                        help="JSON summary, overwritten, or CSV rows per frame, appended")
+    parser.add_argument('--profile-interval', type=float, default=5.0, metavar='N',
+                        help="seconds between profile dumps")
+    return parser.parse_args(argv)
+
+
+def configure_profiler(args):
+    if args.profile_dump:
+        PROFILER.enable()
+        PROFILER.configure_dump(args.profile_dump, args.profile_interval, args.profile_format)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    configure_profiler(args)
+    if args.profile_dump:
+        # Also write what the last interval collected when the window closes
+        atexit.register(PROFILER.dump, args.profile_dump, args.profile_format)
+    viewer = Viewer(args.scene, args.record)
+    if args.generate:
+        viewer.stream(args.generate)
+    viewer.main_loop()
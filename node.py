@@ -1,174 +1,725 @@
-#Node, Primitive, Sphere, Cube, and HierarchicalNode classes
-from OpenGL.GL import *
-from OpenGL.GLU import *
-import numpy as np
-import random
-from aabb import AABB
-from color import COLORS, MIN_COLOR, MAX_COLOR
-
-def create_cube_display_list():
-    """
-    Create a display list for a cube.
-    """
-    vertices = [
-        # Front face
-        [-0.5, -0.5,  0.5], [0.5, -0.5,  0.5], [0.5,  0.5,  0.5], [-0.5,  0.5,  0.5],
-        # Back face
-        [-0.5, -0.5, -0.5], [0.5, -0.5, -0.5], [0.5,  0.5, -0.5], [-0.5,  0.5, -0.5],
-        # Top face
-        [-0.5,  0.5, -0.5], [0.5,  0.5, -0.5], [0.5,  0.5,  0.5], [-0.5,  0.5,  0.5],
-        # Bottom face
-        [-0.5, -0.5, -0.5], [0.5, -0.5, -0.5], [0.5, -0.5,  0.5], [-0.5, -0.5,  0.5],
-        # Left face
-        [-0.5, -0.5, -0.5], [-0.5,  0.5, -0.5], [-0.5,  0.5,  0.5], [-0.5, -0.5,  0.5],
-        # Right face
-        [0.5, -0.5, -0.5], [0.5,  0.5, -0.5], [0.5,  0.5,  0.5], [0.5, -0.5,  0.5]
-    ]
-
-    indices = [
-        [0, 1, 2, 3],  # Front
-        [4, 5, 6, 7],  # Back
-        [8, 9, 10, 11],  # Top
-        [12, 13, 14, 15],  # Bottom
-        [16, 17, 18, 19],  # Left
-        [20, 21, 22, 23]   # Right
-    ]
-
-    display_list = glGenLists(1)
-    glNewList(display_list, GL_COMPILE)
-    glBegin(GL_QUADS)
-    for face in indices:
-        for vertex in face:
-            glVertex3fv(vertices[vertex])
-    glEnd()
-    glEndList()
-    return display_list
-
-def create_sphere_display_list(radius=0.5, slices=16, stacks=16):
-    """
-    Create a display list for a sphere.
-    """
-    display_list = glGenLists(1)
-    glNewList(display_list, GL_COMPILE)
-    quadric = gluNewQuadric()
-    gluSphere(quadric, radius, slices, stacks)
-    gluDeleteQuadric(quadric)
-    glEndList()
-    return display_list
-
-
-
-class Node:
-    def __init__(self):
-        self.color_index = random.randint(MIN_COLOR, MAX_COLOR)
-        self.aabb = AABB([0.0, 0.0, 0.0], [0.5, 0.5, 0.5])
-        self.translation_matrix = np.identity(4)
-        self.scaling_matrix = np.identity(4)
-        self.selected = False
-
-    def render(self):
-        glPushMatrix()
-        glMultMatrixf(np.transpose(self.translation_matrix))
-        glMultMatrixf(self.scaling_matrix)
-        cur_color = COLORS[self.color_index]
-        glColor3f(cur_color[0], cur_color[1], cur_color[2])
-        if self.selected:
-            glMaterialfv(GL_FRONT, GL_EMISSION, [0.3, 0.3, 0.3])
-
-        self.render_self()
-
-        if self.selected:
-            glMaterialfv(GL_FRONT, GL_EMISSION, [0.0, 0.0, 0.0])
-        glPopMatrix()
-
-    def render_self(self):
-        raise NotImplementedError("The abstract node does not define render_self")
-
-    def translate(self, x, y, z):
-        self.translation_matrix = np.dot(self.translation_matrix, translation([x, y, z]))
-
-    def scale(self, up):
-        s = 1.1 if up else 0.9
-        self.scaling_matrix = np.dot(self.scaling_matrix, scaling([s, s, s]))
-        self.aabb.scale(s)
-
-    def rotate_color(self, forward):
-        self.color_index += 1 if forward else -1
-        if self.color_index > MAX_COLOR:
-            self.color_index = MIN_COLOR
-        if self.color_index < MIN_COLOR:
-            self.color_index = MAX_COLOR
-
-    def pick(self, start, direction, mat):
-        newmat = np.dot(np.dot(mat, self.translation_matrix), np.linalg.inv(self.scaling_matrix))
-        return self.aabb.ray_hit(start, direction, newmat)
-
-    def select(self, select=None):
-        if select is not None:
-            self.selected = select
-        else:
-            self.selected = not self.selected
-class Primitive(Node):
-    def __init__(self):
-        super(Primitive, self).__init__()
-        self.call_list = None
-
-    def render_self(self):
-        if self.call_list is None:
-            self._init_display_list()
-        glCallList(self.call_list)
-
-    def _init_display_list(self):
-        raise NotImplementedError("Subclasses must implement this method")
-
-class Cube(Primitive):
-    def __init__(self):
-        super(Cube, self).__init__()
-
-    def _init_display_list(self):
-        self.call_list = create_cube_display_list()
-
-class Sphere(Primitive):
-    def __init__(self):
-        super(Sphere, self).__init__()
-
-    def _init_display_list(self):
-        self.call_list = create_sphere_display_list()
-
-
-class HierarchicalNode(Node):
-    def __init__(self):
-        super(HierarchicalNode, self).__init__()
-        self.child_nodes = []
-
-    def render_self(self):
-        for child in self.child_nodes:
-            child.render()
-
-class SnowFigure(HierarchicalNode):
-    def __init__(self):
-        super(SnowFigure, self).__init__()
-        self.child_nodes = [Sphere(), Sphere(), Sphere()]
-        self.child_nodes[0].translate(0, -0.6, 0)
-        self.child_nodes[1].translate(0, 0.1, 0)
-        self.child_nodes[1].scaling_matrix = np.dot(self.scaling_matrix, scaling([0.8, 0.8, 0.8]))
-        self.child_nodes[2].translate(0, 0.75, 0)
-        self.child_nodes[2].scaling_matrix = np.dot(self.scaling_matrix, scaling([0.7, 0.7, 0.7]))
-        for child_node in self.child_nodes:
-            child_node.color_index = MIN_COLOR
-        self.aabb = AABB([0.0, 0.0, 0.0], [0.5, 1.1, 0.5])
-
-def translation(displacement):
-    t = np.identity(4)
-    t[0, 3] = displacement[0]
-    t[1, 3] = displacement[1]
-    t[2, 3] = displacement[2]
-    return t
-
-def scaling(scale):
-    s = np.identity(4)
-    s[0, 0] = scale[0]
-    s[1, 1] = scale[1]
-    s[2, 2] = scale[2]
-    s[3, 3] = 1
-    return s
\ No newline at end of file
+#Node, Primitive, Sphere, Cube, and HierarchicalNode classes
+from OpenGL.GL import *
+from OpenGL.GLU import *
+import numpy as np
+import random
+from aabb import AABB
+from color import COLORS, MIN_COLOR, MAX_COLOR
+from geometry import GEOMETRY_CACHE, mesh_for_key
+from nodestore import DEFAULT_STORE, NodeStore, SELECTED, DIRTY
+from profiling import PROFILER
+
+def create_cube_display_list():
+    """
+    Create a display list for a cube.
+    """
+    vertices = [
+        # Front face
+        [-0.5, -0.5,  0.5], [0.5, -0.5,  0.5], [0.5,  0.5,  0.5], [-0.5,  0.5,  0.5],
+        # Back face
+        [-0.5, -0.5, -0.5], [0.5, -0.5, -0.5], [0.5,  0.5, -0.5], [-0.5,  0.5, -0.5],
+        # Top face
+        [-0.5,  0.5, -0.5], [0.5,  0.5, -0.5], [0.5,  0.5,  0.5], [-0.5,  0.5,  0.5],
+        # Bottom face
+        [-0.5, -0.5, -0.5], [0.5, -0.5, -0.5], [0.5, -0.5,  0.5], [-0.5, -0.5,  0.5],
+        # Left face
+        [-0.5, -0.5, -0.5], [-0.5,  0.5, -0.5], [-0.5,  0.5,  0.5], [-0.5, -0.5,  0.5],
+        # Right face
+        [0.5, -0.5, -0.5], [0.5,  0.5, -0.5], [0.5,  0.5,  0.5], [0.5, -0.5,  0.5]
+    ]
+
+    indices = [
+        [0, 1, 2, 3],  # Front
+        [4, 5, 6, 7],  # Back
+        [8, 9, 10, 11],  # Top
+        [12, 13, 14, 15],  # Bottom
+        [16, 17, 18, 19],  # Left
+        [20, 21, 22, 23]   # Right
+    ]
+
+    display_list = glGenLists(1)
+    glNewList(display_list, GL_COMPILE)
+    glBegin(GL_QUADS)
+    for face in indices:
+        for vertex in face:
+            glVertex3fv(vertices[vertex])
+    glEnd()
+    glEndList()
+    return display_list
+
+def create_sphere_display_list(radius=0.5, slices=16, stacks=16):
+    """
+    Create a display list for a sphere.
+    """
+    display_list = glGenLists(1)
+    glNewList(display_list, GL_COMPILE)
+    quadric = gluNewQuadric()
+    gluSphere(quadric, radius, slices, stacks)
+    gluDeleteQuadric(quadric)
+    glEndList()
+    return display_list
+
+def create_baked_display_list(parts):
+    """
+    Create one display list drawing several primitives, each given as
+    (geometry key, color index, matrix), as a single triangle batch with
+    the matrices and colors already applied.
+    """
+    vertices, normals, colors = [], [], []
+    for key, color_index, matrix in parts:
+        mesh = mesh_for_key(key).astype(np.float64)
+        vertices.append(mesh[:, :3].dot(matrix[:3, :3].T) + matrix[:3, 3])
+        # Normals transform by the inverse transpose
+        n = mesh[:, 3:].dot(np.linalg.inv(matrix[:3, :3]))
+        normals.append(n / np.linalg.norm(n, axis=1)[:, None])
+        colors.append(np.tile(COLORS[color_index], (len(mesh), 1)))
+    vertices, normals, colors = [np.ascontiguousarray(np.concatenate(a), dtype=np.float32)
+                                 for a in (vertices, normals, colors)]
+
+    # Client state is not recorded in display lists, but the arrays are
+    # copied into the list when glDrawArrays is compiled
+    glEnableClientState(GL_VERTEX_ARRAY)
+    glEnableClientState(GL_NORMAL_ARRAY)
+    glEnableClientState(GL_COLOR_ARRAY)
+    glVertexPointer(3, GL_FLOAT, 0, vertices)
+    glNormalPointer(GL_FLOAT, 0, normals)
+    glColorPointer(3, GL_FLOAT, 0, colors)
+    display_list = glGenLists(1)
+    glNewList(display_list, GL_COMPILE)
+    glDrawArrays(GL_TRIANGLES, 0, len(vertices))
+    # Cube lists draw without normals, so put back the default one
+    glNormal3f(0.0, 0.0, 1.0)
+    glEndList()
+    glDisableClientState(GL_COLOR_ARRAY)
+    glDisableClientState(GL_NORMAL_ARRAY)
+    glDisableClientState(GL_VERTEX_ARRAY)
+    return display_list
+
+
+
+class Node:
+    # All state lives in a NodeStore; a node is only a handle to its row
+    __slots__ = ('store', 'id', 'parent', 'scene',
+                 '_local_matrix', '_gl_matrix', '_world_matrix', '_inverse_world_matrix', '__weakref__')
+    # Stored in NodeStore.types and in scene files, see NODE_TYPES
+    type_code = 0
+
+    def __init__(self, store=None):
+        self.store = DEFAULT_STORE if store is None else store
+        self.id = self.store.allocate()
+        self.store.colors[self.id] = random.randint(MIN_COLOR, MAX_COLOR)
+        self.store.types[self.id] = self.type_code
+        self.parent = None
+        self.scene = None
+        self.invalidate()
+
+    @classmethod
+    def from_store(cls, store, node_id):
+        """
+        A handle for a row that already holds a node, such as one loaded
+        from a scene file, leaving the stored state as it is.
+        """
+        node = cls.__new__(cls)
+        node.store = store
+        node.id = node_id
+        node.parent = None
+        node.scene = None
+        node.attach()
+        node.invalidate()
+        return node
+
+    def attach(self):
+        # Set up what the constructor would have, apart from the stored state
+        pass
+
+    def forget(self):
+        """
+        Drop the handle's hold on its row, and those of its children, once
+        the rows were freed some other way, such as by Scene.clear().
+        """
+        for child in getattr(self, 'child_nodes', ()):
+            child.forget()
+        self.store = None
+
+    def __del__(self):
+        try:
+            self.store.free(self.id)
+        except (AttributeError, TypeError):
+            # Never fully constructed, or the interpreter is shutting down
+            pass
+
+    @property
+    def color_index(self):
+        return int(self.store.colors[self.id])
+
+    @color_index.setter
+    def color_index(self, index):
+        self.store.colors[self.id] = index
+        self._parent_changed()
+
+    @property
+    def selected(self):
+        return bool(self.store.flags[self.id] & SELECTED)
+
+    @selected.setter
+    def selected(self, selected):
+        if selected:
+            self.store.flags[self.id] |= SELECTED
+        else:
+            self.store.flags[self.id] &= ~SELECTED & 0xff
+
+    @property
+    def aabb(self):
+        return AABB(self.store.bounds_min[self.id], self.store.bounds_max[self.id])
+
+    @aabb.setter
+    def aabb(self, aabb):
+        self.store.bounds_min[self.id] = aabb.min_corner
+        self.store.bounds_max[self.id] = aabb.max_corner
+
+    @property
+    def translation_matrix(self):
+        return translation(self.store.translations[self.id])
+
+    @translation_matrix.setter
+    def translation_matrix(self, matrix):
+        self.store.translations[self.id] = np.asarray(matrix)[:3, 3]
+        self.invalidate()
+        self._parent_changed()
+
+    @property
+    def scaling_matrix(self):
+        return scaling(self.store.scales[self.id])
+
+    @scaling_matrix.setter
+    def scaling_matrix(self, matrix):
+        self.store.scales[self.id] = np.diagonal(matrix)[:3]
+        self.invalidate()
+        self._parent_changed()
+
+    @property
+    def local_matrix(self):
+        """
+        Node-to-parent transform, translation times scale.
+        """
+        if self._local_matrix is None:
+            self._local_matrix = self.store.local_matrices([self.id])[0]
+        return self._local_matrix
+
+    @property
+    def gl_matrix(self):
+        """
+        The local matrix in the column-major float32 layout glMultMatrixf expects.
+        """
+        if self._gl_matrix is None:
+            self._gl_matrix = np.ascontiguousarray(self.local_matrix.T, dtype=np.float32)
+        return self._gl_matrix
+
+    @property
+    def world_matrix(self):
+        """
+        Node-to-scene transform, composed through the parent chain.
+        """
+        if self._world_matrix is None:
+            if self.parent is None:
+                self._world_matrix = self.local_matrix
+            else:
+                self._world_matrix = np.dot(self.parent.world_matrix, self.local_matrix)
+        return self._world_matrix
+
+    @property
+    def inverse_world_matrix(self):
+        if self._inverse_world_matrix is None:
+            self._inverse_world_matrix = trs_inverse(self.world_matrix)
+        return self._inverse_world_matrix
+
+    def invalidate(self):
+        """
+        Drop the cached matrices of this node and of everything below it.
+        """
+        self._local_matrix = None
+        self._gl_matrix = None
+        self._world_matrix = None
+        self._inverse_world_matrix = None
+        for child in getattr(self, 'child_nodes', ()):
+            child.invalidate_world()
+
+    def invalidate_world(self):
+        if self._world_matrix is None:
+            # Already dirty, and so is everything below
+            return
+        self._world_matrix = None
+        self._inverse_world_matrix = None
+        for child in getattr(self, 'child_nodes', ()):
+            child.invalidate_world()
+
+    def render(self):
+        glPushMatrix()
+        glMultMatrixf(self.gl_matrix)
+        cur_color = COLORS[self.color_index]
+        glColor3f(cur_color[0], cur_color[1], cur_color[2])
+        if self.selected:
+            glMaterialfv(GL_FRONT, GL_EMISSION, [0.3, 0.3, 0.3])
+
+        self.render_self()
+
+        if self.selected:
+            glMaterialfv(GL_FRONT, GL_EMISSION, [0.0, 0.0, 0.0])
+        glPopMatrix()
+        if PROFILER.enabled:
+            # draw_calls counts matrix pushes and pops as well as draws
+            PROFILER.count('draw_calls', 2)
+
+    def render_self(self):
+        raise NotImplementedError("The abstract node does not define render_self")
+
+    def leaves(self):
+        """
+        The primitives that make up this node, in render order.
+        """
+        return [self]
+
+    def release(self):
+        """
+        Give back any shared GL resources, once the node leaves the scene.
+        """
+        pass
+
+    def translate(self, x, y, z):
+        self.store.translations[self.id] += (x, y, z)
+        self.invalidate()
+        self.changed()
+
+    def scale(self, up):
+        s = 1.1 if up else 0.9
+        self.store.scales[self.id] *= s
+        self.invalidate()
+        self.changed()
+
+    def changed(self, transform=True):
+        self.store.flags[self.id] |= DIRTY
+        if self.parent is not None:
+            # Refit the parent's box around its children and pass the change up
+            if transform:
+                self.parent.update_bounds()
+            self.parent.descendant_changed()
+            self.parent.changed(transform)
+        # Let the owning scene refresh whatever it derived from this node
+        if self.scene is not None:
+            self.scene.node_changed(self, transform)
+
+    def _parent_changed(self):
+        if self.parent is not None:
+            self.parent.descendant_changed()
+
+    def descendant_changed(self):
+        """
+        Called when a node below this one moves, resizes or changes color.
+        """
+        pass
+
+    def rotate_color(self, forward):
+        self.color_index += 1 if forward else -1
+        if self.color_index > MAX_COLOR:
+            self.color_index = MIN_COLOR
+        if self.color_index < MIN_COLOR:
+            self.color_index = MAX_COLOR
+        self.changed(transform=False)
+
+    def pick(self, start, direction, mat):
+        newmat = np.dot(mat, self.world_matrix)
+        inverse = np.dot(self.inverse_world_matrix, trs_inverse(mat))
+        return self.aabb.ray_hit(start, direction, newmat, inverse)
+
+    def select(self, select=None):
+        if select is not None:
+            self.selected = select
+        else:
+            self.selected = not self.selected
+        self.changed(transform=False)
+class Primitive(Node):
+    __slots__ = ('call_lists',)
+    # Identifies the shared display list in GEOMETRY_CACHE
+    geometry_key = None
+    # Geometry keys of the tessellation tiers, coarsest first, for shapes
+    # with screen-space level of detail; see lod.LODSelector
+    lod_keys = None
+    lod_triangles = None
+    DEFAULT_LOD_TIER = None
+    # Local bounds as (min corner, max corner); cube and sphere geometry
+    # both fill the unit box around the origin
+    BOUNDS = ((-0.5, -0.5, -0.5), (0.5, 0.5, 0.5))
+
+    def __init__(self, store=None):
+        super(Primitive, self).__init__(store)
+        self.aabb = AABB(*self.BOUNDS)
+        self.call_lists = {}
+        self.lod_tier = self.DEFAULT_LOD_TIER
+
+    def attach(self):
+        self.call_lists = {}
+
+    @property
+    def lod_tier(self):
+        tier = self.store.lod_tiers[self.id]
+        return None if tier < 0 else int(tier)
+
+    @lod_tier.setter
+    def lod_tier(self, tier):
+        self.store.lod_tiers[self.id] = -1 if tier is None else tier
+
+    @property
+    def current_geometry_key(self):
+        if self.lod_tier is None:
+            return self.geometry_key
+        return self.lod_keys[self.lod_tier]
+
+    def render_self(self):
+        key = self.current_geometry_key
+        call_list = self.call_lists.get(key)
+        if call_list is None:
+            call_list = self._init_display_list(key)
+        glCallList(call_list)
+        if PROFILER.enabled:
+            PROFILER.count('draw_calls')
+
+    def _init_display_list(self, key):
+        call_list = GEOMETRY_CACHE.acquire(key, lambda: self.create_display_list(key))
+        self.call_lists[key] = call_list
+        return call_list
+
+    @classmethod
+    def create_display_list(cls, key):
+        raise NotImplementedError("Subclasses must implement this method")
+
+    def release(self):
+        for key in self.call_lists:
+            GEOMETRY_CACHE.release(key)
+        self.call_lists = {}
+
+class Cube(Primitive):
+    __slots__ = ()
+    type_code = 2
+    geometry_key = ('cube',)
+
+    def __init__(self, store=None):
+        super(Cube, self).__init__(store)
+
+    @classmethod
+    def create_display_list(cls, key):
+        return create_cube_display_list()
+
+class Sphere(Primitive):
+    __slots__ = ()
+    type_code = 3
+    RADIUS, SLICES, STACKS = 0.5, 16, 16
+    geometry_key = ('sphere', RADIUS, SLICES, STACKS)
+    lod_keys = (('sphere', RADIUS, 6, 6), ('sphere', RADIUS, 10, 10), geometry_key, ('sphere', RADIUS, 32, 32))
+    # gluSphere draws fans at the poles and quad strips in between
+    lod_triangles = tuple(key[2] * (2 * key[3] - 2) for key in lod_keys)
+    DEFAULT_LOD_TIER = 2
+
+    def __init__(self, store=None):
+        super(Sphere, self).__init__(store)
+
+    @classmethod
+    def create_display_list(cls, key):
+        return create_sphere_display_list(*key[1:])
+
+
+class HierarchicalNode(Node):
+    __slots__ = ('child_nodes', '_baked')
+    type_code = 1
+    # Draw all primitives below through one display list, with their
+    # transforms and colors baked in, rather than child by child
+    BAKED = True
+
+    def __init__(self, store=None):
+        self.child_nodes = []
+        self._baked = None
+        super(HierarchicalNode, self).__init__(store)
+
+    def attach(self):
+        self.child_nodes = []
+        self._baked = None
+        for child_id in self.store.take_pending_children(self.id):
+            child = NODE_TYPES[self.store.types[child_id]].from_store(self.store, child_id)
+            child.parent = self
+            self.child_nodes.append(child)
+
+    def add_child(self, node):
+        node.parent = self
+        self.store.parents[node.id] = self.id
+        node.invalidate_world()
+        self.child_nodes.append(node)
+        node.changed()
+        return node
+
+    def leaves(self):
+        result = []
+        for child in self.child_nodes:
+            result.extend(child.leaves())
+        return result
+
+    def update_bounds(self):
+        """
+        Fit the AABB around the children, in this node's local space.
+        """
+        bounds = None
+        for child in self.child_nodes:
+            child_bounds = child.aabb.transform(child.local_matrix)
+            bounds = child_bounds if bounds is None else bounds.union(child_bounds)
+        if bounds is not None:
+            self.aabb = bounds
+
+    def render_self(self):
+        if not self.BAKED:
+            for child in self.child_nodes:
+                child.render()
+            return
+        baked = self._baked
+        # Children switching tessellation tiers need a new bake as well
+        if baked is not None and not np.array_equal(self.store.lod_tiers[baked[0]], baked[1]):
+            self.descendant_changed()
+            baked = None
+        if baked is None:
+            baked = self._bake()
+        glCallList(baked[3])
+        if PROFILER.enabled:
+            PROFILER.count('draw_calls')
+
+    def _bake(self):
+        """
+        Compile the primitives below into one display list, shared through
+        GEOMETRY_CACHE with every node whose primitives have the same
+        shapes, colors and transforms relative to it.
+        """
+        leaves = self.leaves()
+        parts = tuple((leaf.current_geometry_key, leaf.color_index, self._matrix_to(leaf)) for leaf in leaves)
+        key = ('baked',) + tuple((shape, color, matrix.tobytes()) for shape, color, matrix in parts)
+        display_list = GEOMETRY_CACHE.acquire(key, lambda: create_baked_display_list(parts))
+        ids = np.array([leaf.id for leaf in leaves], dtype=np.int64)
+        self._baked = (ids, self.store.lod_tiers[ids].copy(), key, display_list)
+        return self._baked
+
+    def _matrix_to(self, node):
+        # Transform from a node below to this node's space
+        matrix = node.local_matrix
+        node = node.parent
+        while node is not self:
+            matrix = np.dot(node.local_matrix, matrix)
+            node = node.parent
+        return matrix
+
+    def descendant_changed(self):
+        if self._baked is not None:
+            GEOMETRY_CACHE.release(self._baked[2])
+            self._baked = None
+        self._parent_changed()
+
+    def release(self):
+        for child in self.child_nodes:
+            child.release()
+        if self._baked is not None:
+            GEOMETRY_CACHE.release(self._baked[2])
+            self._baked = None
+
+class SnowFigure(HierarchicalNode):
+    __slots__ = ()
+    type_code = 4
+
+    def __init__(self, store=None):
+        super(SnowFigure, self).__init__(store)
+        for _ in range(3):
+            self.add_child(Sphere(self.store))
+        self.child_nodes[0].translate(0, -0.6, 0)
+        self.child_nodes[1].translate(0, 0.1, 0)
+        self.child_nodes[1].scaling_matrix = np.dot(self.scaling_matrix, scaling([0.8, 0.8, 0.8]))
+        self.child_nodes[2].translate(0, 0.75, 0)
+        self.child_nodes[2].scaling_matrix = np.dot(self.scaling_matrix, scaling([0.7, 0.7, 0.7]))
+        for child_node in self.child_nodes:
+            child_node.color_index = MIN_COLOR
+        self.update_bounds()
+
+# Node classes by type_code; codes are stored in scene files, so they
+# must never be reused or renumbered
+NODE_TYPES = dict((cls.type_code, cls) for cls in (Node, HierarchicalNode, Cube, Sphere, SnowFigure))
+# Indexed by type code
+IS_HIERARCHICAL = np.array([issubclass(NODE_TYPES.get(code, Node), HierarchicalNode) for code in range(256)])
+
+
+def set_default_lod_tiers(store, ids):
+    """
+    Put curved primitives among the given rows on their default tier.
+    """
+    for code, cls in NODE_TYPES.items():
+        if getattr(cls, 'DEFAULT_LOD_TIER', None) is not None:
+            store.lod_tiers[ids[store.types[ids] == code]] = cls.DEFAULT_LOD_TIER
+
+
+# Store columns a new node's constructor fills in
+TEMPLATE_FIELDS = ('translations', 'scales', 'colors', 'bounds_min', 'bounds_max', 'lod_tiers', 'types')
+
+
+def allocate_nodes(cls, count, store=None):
+    """
+    Rows for count new nodes of class cls, as its constructor leaves them
+    but without handles. One node is built in a scratch store and its rows
+    are copied into the store in bulk; the rows of the children of
+    hierarchical nodes wait as pending children, like those of a loaded
+    scene file. Returns the ids of the top-level rows.
+    """
+    store = DEFAULT_STORE if store is None else store
+    scratch = NodeStore(capacity=16)
+    template = cls(scratch)
+    size = scratch.size
+    roots = store.allocate(count)
+    # ids[i, j] is row j of the template copied for node i; row 0 is its root
+    ids = np.hstack([roots[:, None], store.allocate(count * (size - 1)).reshape(count, size - 1)])
+    for name in TEMPLATE_FIELDS:
+        getattr(store, name)[ids] = getattr(scratch, name)[:size]
+    parents = scratch.parents[:size]
+    store.parents[ids] = np.where(parents >= 0, ids[:, np.maximum(parents, 0)], -1)
+    stack = [template]
+    while stack:
+        node = stack.pop()
+        children = [child.id for child in getattr(node, 'child_nodes', ())]
+        if children:
+            store.add_pending_children(np.repeat(ids[:, node.id], len(children)), ids[:, children].ravel())
+        stack.extend(getattr(node, 'child_nodes', ()))
+    return roots
+
+
+def node_for_id(node_id, store=None):
+    """
+    The handle of a row that was stored without one, made on first use.
+    """
+    store = DEFAULT_STORE if store is None else store
+    node = store.handles.get(node_id)
+    if node is None:
+        node = store.handles[node_id] = NODE_TYPES[store.types[node_id]].from_store(store, node_id)
+    return node
+
+
+class NodeList(object):
+    """
+    A list of nodes kept as an array of ids, in which nodes that have no
+    handle yet stay plain ids. Indexing or iterating makes the handle on
+    first access, through make_node; ids() never does. Ids are added and
+    removed in bulk on the array, without a Python step per node.
+    """
+    def __init__(self, make_node=None):
+        self.node_ids = np.zeros(16, dtype=np.int64)
+        self.count = 0
+        # Handles made or added so far, by id
+        self.nodes = {}
+        self.make_node = make_node or node_for_id
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self.count))]
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError("NodeList index out of range")
+        node_id = int(self.node_ids[i])
+        node = self.nodes.get(node_id)
+        if node is None:
+            node = self.nodes[node_id] = self.make_node(node_id)
+        return node
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self[i]
+
+    def __contains__(self, node):
+        return self._find(node) is not None
+
+    def _reserve(self, n):
+        if n <= len(self.node_ids):
+            return
+        node_ids = np.zeros(max(n, 2 * len(self.node_ids)), dtype=np.int64)
+        node_ids[:self.count] = self.node_ids[:self.count]
+        self.node_ids = node_ids
+
+    def append(self, node):
+        self.extend([node])
+
+    def extend(self, nodes):
+        nodes = list(nodes)
+        self.nodes.update((node.id, node) for node in nodes)
+        self.extend_ids([node.id for node in nodes])
+
+    def extend_ids(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        n = self.count + len(ids)
+        self._reserve(n)
+        self.node_ids[self.count:n] = ids
+        self.count = n
+
+    def remove(self, node):
+        i = self.index(node)
+        self.node_ids[i:self.count - 1] = self.node_ids[i + 1:self.count]
+        self.count -= 1
+        self.nodes.pop(node.id, None)
+
+    def remove_ids(self, ids):
+        """
+        Remove many nodes at once, given by id, keeping the order of the rest.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        keep = ~np.isin(self.node_ids[:self.count], ids)
+        kept = self.node_ids[:self.count][keep]
+        self.node_ids[:len(kept)] = kept
+        self.count = len(kept)
+        for node_id in ids.tolist():
+            self.nodes.pop(node_id, None)
+
+    def index(self, node):
+        i = self._find(node)
+        if i is None:
+            raise ValueError("Node not in list")
+        return i
+
+    def _find(self, node):
+        # A different handle for the same id is a different node
+        held = self.nodes.get(node.id)
+        if held is not None and held is not node:
+            return None
+        found = np.flatnonzero(self.node_ids[:self.count] == node.id)
+        return int(found[0]) if len(found) else None
+
+    def ids(self):
+        return self.node_ids[:self.count].copy()
+
+
+def translation(displacement):
+    t = np.identity(4)
+    t[0, 3] = displacement[0]
+    t[1, 3] = displacement[1]
+    t[2, 3] = displacement[2]
+    return t
+
+def scaling(scale):
+    s = np.identity(4)
+    s[0, 0] = scale[0]
+    s[1, 1] = scale[1]
+    s[2, 2] = scale[2]
+    s[3, 3] = 1
+    return s
+
+def trs_inverse(m):
+    """
+    Closed-form inverse of an affine translate-rotate-scale matrix.
+
+    The upper 3x3 block is R.S, so its inverse is S^-1.R^T, which is its
+    transpose with each row divided by the squared column length.
+    """
+    a = m[:3, :3]
+    inverse = np.identity(4)
+    inverse[:3, :3] = a.T / np.einsum('ij,ij->j', a, a)[:, None]
+    inverse[:3, 3] = -np.dot(inverse[:3, :3], m[:3, 3])
+    return inverse
@@ -0,0 +1,207 @@
+# Structure-of-arrays storage for node state
+import numpy as np
+
+# Bit flags per node
+ALIVE = 1
+SELECTED = 2
+# Changed since the scene it belongs to was last saved
+DIRTY = 4
+
+DEFAULT_MIN = (0.0, 0.0, 0.0)
+DEFAULT_MAX = (0.5, 0.5, 0.5)
+
+
+class NodeStore(object):
+    """
+    Node state in contiguous arrays indexed by node id: translation, scale,
+    color index, local bounds, parent id, level-of-detail tier and flags.
+
+    Node objects are thin handles holding an id into a store, so bulk work
+    (picking, culling, uploads, serialization) can run over whole arrays.
+    Ids of freed nodes are reused.
+
+    Rows can also exist without a handle, e.g. after loading a scene file.
+    handles keeps the handles made for such rows later on. The child ids
+    of rows whose handle, and so whose child list, does not exist yet wait
+    in pending_pool: pending_starts and pending_counts give each row its
+    run of it, so whole files of child lists are filed without a Python
+    step per node.
+    """
+    FIELDS = (
+        ('translations', np.float32, (3,)),
+        ('scales', np.float32, (3,)),
+        ('colors', np.int32, ()),
+        ('bounds_min', np.float32, (3,)),
+        ('bounds_max', np.float32, (3,)),
+        ('parents', np.int32, ()),
+        ('lod_tiers', np.int8, ()),
+        ('types', np.uint8, ()),
+        ('flags', np.uint8, ()),
+        ('pending_starts', np.int64, ()),
+        ('pending_counts', np.int32, ()),
+    )
+    # Compact pending_pool once it holds this many more ids than are pending
+    PENDING_SLACK = 4096
+
+    def __init__(self, capacity=64):
+        self.size = 0
+        self.free_ids = []
+        self.handles = {}
+        self.pending_pool = np.zeros(0, dtype=np.int64)
+        self.pending_size = 0
+        for name, dtype, shape in self.FIELDS:
+            setattr(self, name, np.zeros((0,) + shape, dtype=dtype))
+        self.reserve(capacity)
+
+    def __len__(self):
+        return self.size - len(self.free_ids)
+
+    @property
+    def capacity(self):
+        return len(self.flags)
+
+    def reserve(self, capacity):
+        if capacity <= self.capacity:
+            return
+        capacity = max(capacity, 2 * self.capacity)
+        for name, dtype, shape in self.FIELDS:
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + shape, dtype=dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def allocate(self, count=None):
+        """
+        Reserve one id, or an array of count ids, with default state.
+        """
+        if count is None:
+            if self.free_ids:
+                ids = self.free_ids.pop()
+            else:
+                self.reserve(self.size + 1)
+                ids = self.size
+                self.size += 1
+        else:
+            reused = self.free_ids[len(self.free_ids) - min(count, len(self.free_ids)):]
+            del self.free_ids[len(self.free_ids) - len(reused):]
+            fresh = count - len(reused)
+            self.reserve(self.size + fresh)
+            ids = np.concatenate([np.array(reused, dtype=np.int64), np.arange(self.size, self.size + fresh)])
+            self.size += fresh
+        self.translations[ids] = 0.0
+        self.scales[ids] = 1.0
+        self.colors[ids] = 0
+        self.bounds_min[ids] = DEFAULT_MIN
+        self.bounds_max[ids] = DEFAULT_MAX
+        self.parents[ids] = -1
+        self.lod_tiers[ids] = -1
+        self.types[ids] = 0
+        self.flags[ids] = ALIVE | DIRTY
+        self.pending_counts[ids] = 0
+        return ids
+
+    def free(self, node_id):
+        # Still dirty, so the next incremental save drops the row
+        if not self.flags[node_id] & ALIVE:
+            return
+        self.flags[node_id] = DIRTY
+        self.pending_counts[node_id] = 0
+        self.free_ids.append(node_id)
+
+    def free_many(self, ids):
+        """
+        Free many rows at once, with any handles or pending children kept
+        for them.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        ids = ids[(self.flags[ids] & ALIVE) != 0]
+        for node_id in ids.tolist():
+            self.handles.pop(node_id, None)
+        self.flags[ids] = DIRTY
+        self.pending_counts[ids] = 0
+        self.free_ids.extend(ids.tolist())
+
+    def add_pending_children(self, parents, children):
+        """
+        File child ids until their parents' handles are made: children[i]
+        belongs to parents[i], and each parent's children keep their order.
+        """
+        parents = np.asarray(parents, dtype=np.int64)
+        children = np.asarray(children, dtype=np.int64)
+        if not len(children):
+            return
+        order = np.argsort(parents, kind='stable')
+        parents, children = parents[order], children[order]
+        starts = np.flatnonzero(np.r_[True, parents[1:] != parents[:-1]])
+        if self.pending_size - int(self.pending_counts[:self.size].sum()) > self.PENDING_SLACK:
+            self._compact_pending()
+        n = self.pending_size + len(children)
+        if n > len(self.pending_pool):
+            pool = np.zeros(max(n, 2 * len(self.pending_pool)), dtype=np.int64)
+            pool[:self.pending_size] = self.pending_pool[:self.pending_size]
+            self.pending_pool = pool
+        self.pending_pool[self.pending_size:n] = children
+        self.pending_starts[parents[starts]] = self.pending_size + starts
+        self.pending_counts[parents[starts]] = np.diff(np.r_[starts, len(children)])
+        self.pending_size = n
+
+    def take_pending_children(self, node_id):
+        """
+        The pending child ids of a row, as a list, which are then no longer
+        pending.
+        """
+        count = int(self.pending_counts[node_id])
+        if not count:
+            return []
+        self.pending_counts[node_id] = 0
+        start = int(self.pending_starts[node_id])
+        return self.pending_pool[start:start + count].tolist()
+
+    def _compact_pending(self):
+        # Move the runs still pending to the front of the pool, in one gather
+        parents = np.flatnonzero(self.pending_counts[:self.size])
+        counts = self.pending_counts[parents].astype(np.int64)
+        offsets = np.cumsum(counts) - counts
+        index = np.repeat(self.pending_starts[parents] - offsets, counts) + np.arange(int(counts.sum()))
+        self.pending_pool[:len(index)] = self.pending_pool[index]
+        self.pending_starts[parents] = offsets
+        self.pending_size = len(index)
+
+    def alive_ids(self):
+        return np.flatnonzero(self.flags[:self.size] & ALIVE)
+
+    def local_matrices(self, ids):
+        """
+        (N, 4, 4) translation times scale matrices of the given nodes.
+        """
+        ids = np.asarray(ids)
+        m = np.zeros((len(ids), 4, 4))
+        s = self.scales[ids]
+        m[:, 0, 0], m[:, 1, 1], m[:, 2, 2] = s[:, 0], s[:, 1], s[:, 2]
+        m[:, :3, 3] = self.translations[ids]
+        m[:, 3, 3] = 1.0
+        return m
+
+    def inverse_local_matrices(self, ids):
+        ids = np.asarray(ids)
+        m = np.zeros((len(ids), 4, 4))
+        inv = 1.0 / self.scales[ids].astype(np.float64)
+        m[:, 0, 0], m[:, 1, 1], m[:, 2, 2] = inv[:, 0], inv[:, 1], inv[:, 2]
+        m[:, :3, 3] = -self.translations[ids] * inv
+        m[:, 3, 3] = 1.0
+        return m
+
+    def local_bounds_in_parent(self, ids):
+        """
+        Bounds of the given nodes after their own translation and scale,
+        i.e. in their parent's space, or world space for top-level nodes.
+        """
+        ids = np.asarray(ids)
+        t = self.translations[ids].astype(np.float64)
+        s = self.scales[ids].astype(np.float64)
+        a = t + s * self.bounds_min[ids]
+        b = t + s * self.bounds_max[ids]
+        return np.minimum(a, b), np.maximum(a, b)
+
+
+DEFAULT_STORE = NodeStore()
@@ -0,0 +1,145 @@
+# Batch rendering of scene views to image files, without a display
+"""
+Renders views of a scene with the software rasterizer in rasterizer.py,
+spread over a pool of worker processes, e.g. for thumbnails or image
+comparisons on machines without a GPU:
+
+    python offscreen.py scene.3drs --views 8 --size 320 240 --output renders
+
+Each view is written as a PNG, or as a PPM when the name ends in .ppm.
+Like benchmark.py, this runs against the recording GL stub, so it must
+be the entry point rather than imported next to the real viewer.
+"""
+import argparse
+import multiprocessing
+import os
+import shutil
+import struct
+import tempfile
+import time
+import zlib
+
+import glstub
+glstub.install()
+
+import numpy as np
+import scenefile
+from camera import Camera
+from rasterizer import SoftwareRenderer
+from scene import Scene
+from trackball import Trackball
+
+
+def save_image(path, image):
+    """
+    Write an (height, width, 3) uint8 image as PNG, or as binary PPM.
+    """
+    height, width = image.shape[:2]
+    with open(path, 'wb') as f:
+        if path.lower().endswith('.ppm'):
+            f.write(b'P6\n%d %d\n255\n' % (width, height))
+            f.write(np.ascontiguousarray(image).tobytes())
+            return
+        # Each row starts with filter type 0, i.e. no filter
+        raw = np.hstack([np.zeros((height, 1), dtype=np.uint8), image.reshape(height, -1)]).tobytes()
+
+        def chunk(kind, data):
+            return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(raw, 6)))
+        f.write(chunk(b'IEND', b''))
+
+
+def orbit_views(count, width, height, distance=Trackball.DISTANCE, elevation=20.0):
+    """
+    (projection, model_view) pairs of count cameras evenly spaced around
+    the y axis, looking down by elevation degrees, as the viewer would
+    set them up for a trackball turned that far.
+    """
+    views = []
+    for i in range(count):
+        trackball = Trackball(distance)
+        trackball.rotate((0, 1, 0), 360.0 * i / count)
+        trackball.rotate((1, 0, 0), elevation)
+        camera = Camera()
+        camera.update(width, height, trackball)
+        views.append((camera.projection, camera.model_view))
+    return views
+
+
+# Per worker process: the scene, loaded once, and the renderer
+_WORKER = {}
+
+
+def _init_worker(scene_path, width, height):
+    _WORKER['scene'] = scenefile.load(scene_path)
+    _WORKER['renderer'] = SoftwareRenderer(width, height)
+
+
+def _render_view(job):
+    path, projection, model_view = job
+    start = time.perf_counter()
+    color, _ = _WORKER['renderer'].render(_WORKER['scene'], projection, model_view)
+    save_image(path, color)
+    return path, time.perf_counter() - start
+
+
+def render_batch(scene, views, paths, width, height, processes=None):
+    """
+    Render each (projection, model_view) view of a scene, given as a Scene
+    or the path of a scene file, to the matching image path, across a pool
+    of processes. Each worker maps the scene file and loads it once.
+    Returns (path, seconds) per view.
+    """
+    if len(views) != len(paths):
+        raise ValueError("Got %d views for %d paths" % (len(views), len(paths)))
+    directory = None
+    try:
+        if isinstance(scene, Scene):
+            # Workers read the scene from a file rather than a pickle
+            directory = tempfile.mkdtemp()
+            scene_path = os.path.join(directory, 'batch.3drs')
+            scenefile.SceneFile.write(scene, scene_path, mark_saved=False)
+        else:
+            scene_path = scene
+            # Fail here on a bad file, not in every worker the pool starts
+            scenefile.SceneFile(scene_path)
+        jobs = [(path, projection, model_view) for path, (projection, model_view) in zip(paths, views)]
+        if processes == 1:
+            _init_worker(scene_path, width, height)
+            return [_render_view(job) for job in jobs]
+        pool = multiprocessing.Pool(processes, _init_worker, (scene_path, width, height))
+        try:
+            return pool.map(_render_view, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        if directory is not None:
+            shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scene', help="scene file to render")
+    parser.add_argument('--views', type=int, default=8, help="number of views around the scene")
+    parser.add_argument('--size', type=int, nargs=2, default=(320, 240), metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--output', default='renders', help="directory for the images")
+    parser.add_argument('--format', choices=('png', 'ppm'), default='png')
+    parser.add_argument('--processes', type=int, default=None, help="worker processes, all cores by default")
+    args = parser.parse_args()
+
+    width, height = args.size
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    paths = [os.path.join(args.output, 'view%03d.%s' % (i, args.format)) for i in range(args.views)]
+    start = time.perf_counter()
+    results = render_batch(args.scene, orbit_views(args.views, width, height), paths, width, height, args.processes)
+    for path, seconds in results:
+        print("%s  %.1f ms" % (path, 1000.0 * seconds))
+    print("%d views in %.2f s" % (len(results), time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
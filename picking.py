@@ -0,0 +1,456 @@
+# Batched ray picking over all scene nodes
+import collections
+import numpy as np
+from bvh import BVH
+from node import node_for_id, IS_HIERARCHICAL, Sphere
+from nodestore import DEFAULT_STORE
+
+# Corners of a box as 0/1 selectors between its min and max corner
+BOX_CORNERS = np.array([[i & 1, (i >> 1) & 1, (i >> 2) & 1] for i in range(8)], dtype=np.float64)
+
+
+def ray_hit_batch(origins, directions, min_corners, max_corners):
+    """
+    Slab test of N rays against N boxes, one ray per box.
+
+    Returns a boolean hit mask and the entry distance of each ray
+    (inf where the ray misses).
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        tmin = (min_corners - origins) / directions
+        tmax = (max_corners - origins) / directions
+    tmin, tmax = np.minimum(tmin, tmax), np.maximum(tmin, tmax)
+    tmin_max = np.max(tmin, axis=1)
+    tmax_min = np.min(tmax, axis=1)
+
+    hit = (tmax_min >= tmin_max) & (tmax_min >= 0)
+    return hit, np.where(hit, tmin_max, np.inf)
+
+
+def ray_sphere_batch(origins, directions, min_corners, max_corners):
+    """
+    Exact test of N rays against the spheres inscribed in N cubic boxes,
+    one ray per sphere, returned like ray_hit_batch.
+    """
+    centers = (min_corners + max_corners) / 2.0
+    radii = (max_corners[:, 0] - min_corners[:, 0]) / 2.0
+    offsets = origins - centers
+    a = np.einsum('ij,ij->i', directions, directions)
+    b = np.einsum('ij,ij->i', offsets, directions)
+    c = np.einsum('ij,ij->i', offsets, offsets) - radii * radii
+    discriminant = b * b - a * c
+    root = np.sqrt(np.maximum(discriminant, 0.0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        near = (-b - root) / a
+        far = (-b + root) / a
+    # Like the slab test, a ray starting inside reports its negative entry
+    hit = (discriminant >= 0) & (far >= 0)
+    return hit, np.where(hit, near, np.inf)
+
+
+def box_normal(offsets, half_extents):
+    # The face a surface point lies on is the axis it is furthest out along
+    axis = np.argmax(np.abs(offsets) / half_extents)
+    normal = np.zeros(3)
+    normal[axis] = np.sign(offsets[axis])
+    return normal
+
+
+def sphere_normal(offsets, half_extents):
+    return offsets
+
+
+# Exact tests that replace the box test for primitive types, by type code,
+# and the local surface normal of each type at a point offset from the
+# box centre. Other types are hit exactly by their box.
+NARROW_PHASE = {Sphere.type_code: ray_sphere_batch}
+NORMALS = {Sphere.type_code: sphere_normal}
+
+
+def narrow_phase(types, origins, directions, min_corners, max_corners, hit, distances):
+    """
+    Redo box hits with the exact test of the primitive type where there is
+    one, as one batch per type. Updates hit and distances in place.
+    """
+    for code, test in NARROW_PHASE.items():
+        rows = np.flatnonzero(hit & (types == code))
+        if len(rows):
+            hit[rows], distances[rows] = test(origins[rows], directions[rows], min_corners[rows], max_corners[rows])
+    return hit, distances
+
+
+def surface_normal(leaf, point):
+    """
+    Unit world space normal of a primitive at a world space surface point.
+    """
+    store = leaf.store
+    local = np.dot(leaf.inverse_world_matrix, np.append(point, 1.0))[:3]
+    low, high = store.bounds_min[leaf.id], store.bounds_max[leaf.id]
+    normal = NORMALS.get(leaf.type_code, box_normal)(local - (low + high) / 2.0, (high - low) / 2.0)
+    normal = np.dot(leaf.inverse_world_matrix[:3, :3].T, normal)
+    return normal / np.linalg.norm(normal)
+
+
+def transform_bounds(matrices, min_corners, max_corners):
+    """
+    World-space bounds of N local boxes under N affine 4x4 transforms.
+    """
+    extent = max_corners - min_corners
+    corners = min_corners[:, None, :] + BOX_CORNERS[None, :, :] * extent[:, None, :]
+    world = np.einsum('nij,nkj->nki', matrices[:, :3, :3], corners) + matrices[:, None, :3, 3]
+    return world.min(axis=1), world.max(axis=1)
+
+
+class Hit(collections.namedtuple('Hit', 'node distance leaf path point normal')):
+    """
+    A pick result: the top-level node hit, the ray parameter of the hit,
+    the primitive actually hit with the nodes from node down to it, and
+    the world space surface point and unit normal there.
+    """
+    __slots__ = ()
+
+
+def hierarchy_hit(node, origin, ray):
+    """
+    Closest hit among the children of a hierarchical node, descending into
+    children that are hierarchical themselves, as (distance, path from a
+    child down to the primitive hit), or (inf, None). origin and ray are
+    homogeneous world space vectors.
+    """
+    children = node.child_nodes
+    if not children:
+        return float('inf'), None
+    store = node.store
+    ids = [child.id for child in children]
+    # World matrices are cached on the nodes, so each is composed once
+    inverse = np.array([child.inverse_world_matrix for child in children])
+    origins, directions = np.dot(inverse, origin)[:, :3], np.dot(inverse, ray)[:, :3]
+    min_corners, max_corners = store.bounds_min[ids], store.bounds_max[ids]
+    hit, distances = ray_hit_batch(origins, directions, min_corners, max_corners)
+    narrow_phase(store.types[ids], origins, directions, min_corners, max_corners, hit, distances)
+    best, best_path = float('inf'), None
+    for k in np.argsort(distances, kind='stable'):
+        # No hit in a box can come before the box itself
+        if not hit[k] or distances[k] >= best:
+            break
+        child = children[k]
+        if getattr(child, 'child_nodes', None) is not None:
+            distance, path = hierarchy_hit(child, origin, ray)
+        else:
+            distance, path = distances[k], ()
+        if path is not None and distance < best:
+            best, best_path = distance, (child,) + path
+    return best, best_path
+
+
+# Per-row arrays, kept in step by reserve and remove
+ROW_ARRAYS = ('ids', 'min_corners', 'max_corners', 'inverse_matrices', 'world_min', 'world_max')
+
+
+class PickBuffer(object):
+    """
+    Stacked node bounds and inverse node transforms, so that a ray can be
+    tested against every node of the scene in one vectorized pass.
+
+    A BVH over the world-space node bounds narrows each query down to the
+    few nodes whose boxes the ray actually passes through. id_rows maps
+    node ids to rows, -1 for nodes without one; being an array, it takes
+    a batch of rows without a Python step per node.
+    """
+    def __init__(self, store=None, make_node=None):
+        self.store = DEFAULT_STORE if store is None else store
+        # Turns the node id of a row into its node, for ray_hit
+        self.make_node = make_node or node_for_id
+        self.bvh = BVH()
+        self.clear()
+
+    def clear(self):
+        self.count = 0
+        self.id_rows = np.full(len(self.store.types), -1, dtype=np.int64)
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.min_corners = np.zeros((0, 3), dtype=np.float32)
+        self.max_corners = np.zeros((0, 3), dtype=np.float32)
+        self.inverse_matrices = np.zeros((0, 4, 4))
+        self.world_min = np.zeros((0, 3))
+        self.world_max = np.zeros((0, 3))
+        self.bvh.clear()
+
+    def __len__(self):
+        return self.count
+
+    def reserve(self, n):
+        # Room for n rows, and for every id the store has room for; the
+        # arrays grow by doubling
+        self._reserve_ids(len(self.store.types))
+        capacity = len(self.min_corners)
+        if n <= capacity:
+            return
+        capacity = max(n, 2 * capacity, 16)
+        for name in ROW_ARRAYS:
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def _reserve_ids(self, n):
+        capacity = len(self.id_rows)
+        if n <= capacity:
+            return
+        id_rows = np.full(max(n, 2 * capacity), -1, dtype=np.int64)
+        id_rows[:capacity] = self.id_rows
+        self.id_rows = id_rows
+
+    def row(self, node_id):
+        """
+        Row of a node id, or None if the node has none.
+        """
+        if node_id >= len(self.id_rows):
+            return None
+        i = int(self.id_rows[node_id])
+        return i if i >= 0 else None
+
+    def rebuild(self, nodes):
+        self.clear()
+        self.extend_ids([node.id for node in nodes])
+        n = self.count
+        if n:
+            self.bvh.build(self.world_min[:n], self.world_max[:n])
+
+    def extend(self, nodes):
+        self.extend_ids([node.id for node in nodes])
+
+    def extend_ids(self, ids):
+        """
+        Append rows for many nodes at once, given by id; their handles need
+        not exist. The BVH is rebuilt once, on the next query, instead of
+        taking one insert per node.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        if not len(ids):
+            return
+        i = self.count
+        n = i + len(ids)
+        self.reserve(n)
+        self._reserve_ids(int(ids.max()) + 1)
+        self.ids[i:n] = ids
+        self.id_rows[ids] = np.arange(i, n)
+        self.count = n
+        self._fill_rows(slice(i, n), ids)
+        self.bvh.needs_rebuild = True
+
+    def _fill_rows(self, rows, ids):
+        # Scene nodes are top level, so their local transform is their world
+        # transform and every row comes straight out of the store arrays
+        self.min_corners[rows] = self.store.bounds_min[ids]
+        self.max_corners[rows] = self.store.bounds_max[ids]
+        self.inverse_matrices[rows] = self.store.inverse_local_matrices(ids)
+        self.world_min[rows], self.world_max[rows] = self.store.local_bounds_in_parent(ids)
+
+    def add(self, node):
+        i = self.count
+        self.reserve(i + 1)
+        self._reserve_ids(node.id + 1)
+        self.ids[i] = node.id
+        self.id_rows[node.id] = i
+        self.count += 1
+        self._set_row(i, node)
+        self.bvh.insert(i)
+
+    def remove(self, node):
+        """
+        Drop a node's row by moving the last row into its place.
+        """
+        i = self.row(node.id)
+        if i is None:
+            return
+        self.id_rows[node.id] = -1
+        last = self.count - 1
+        if i != last:
+            self.id_rows[self.ids[last]] = i
+            for name in ROW_ARRAYS:
+                array = getattr(self, name)
+                array[i] = array[last]
+        self.count = last
+        # Row indices moved under the tree, so rebuild it before the next query
+        self.bvh.needs_rebuild = True
+
+    def remove_ids(self, ids):
+        """
+        Drop the rows of many nodes at once, given by id, keeping the
+        order of the rest.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        ids = ids[ids < len(self.id_rows)]
+        rows = self.id_rows[ids]
+        rows = rows[rows >= 0]
+        if not len(rows):
+            return
+        keep = np.ones(self.count, dtype=bool)
+        keep[rows] = False
+        self.id_rows[self.ids[rows]] = -1
+        n = int(keep.sum())
+        for name in ROW_ARRAYS:
+            array = getattr(self, name)
+            array[:n] = array[:self.count][keep]
+        self.id_rows[self.ids[:n]] = np.arange(n)
+        self.count = n
+        self.bvh.needs_rebuild = True
+
+    def update(self, node):
+        """
+        Refresh the row of a single node after its transform or bounds changed.
+        """
+        i = self.row(node.id)
+        if i is None:
+            return
+        self._set_row(i, node)
+        n = self.count
+        self.bvh.refit(i, self.world_min[:n], self.world_max[:n])
+
+    def update_many(self, nodes):
+        """
+        Refresh the rows of many nodes at once, e.g. after a group move.
+        """
+        ids = np.array([node.id for node in nodes if self.row(node.id) is not None], dtype=np.int64)
+        if not len(ids):
+            return
+        rows = self.id_rows[ids]
+        self._fill_rows(rows, ids)
+        n = self.count
+        for i in rows.tolist():
+            self.bvh.refit(i, self.world_min[:n], self.world_max[:n])
+
+    def _set_row(self, i, node):
+        self.min_corners[i] = node.store.bounds_min[node.id]
+        self.max_corners[i] = node.store.bounds_max[node.id]
+        self.inverse_matrices[i] = node.inverse_world_matrix
+        self._update_world_bounds(slice(i, i + 1), node.world_matrix[None])
+
+    def _update_world_bounds(self, rows, matrices):
+        self.world_min[rows], self.world_max[rows] = transform_bounds(
+            matrices, self.min_corners[rows].astype(np.float64), self.max_corners[rows].astype(np.float64))
+
+    def ray_hit(self, start, direction, mat):
+        """
+        Return the closest node hit by the ray and its distance, or
+        (None, inf) if nothing is hit.
+        """
+        hit = self.query(start, direction, mat)
+        if hit is None:
+            return None, float('inf')
+        return hit.node, hit.distance
+
+    def query(self, start, direction, mat):
+        """
+        The closest Hit along an eye space ray, or None. Hierarchical nodes
+        are descended into, so the hit is always on one of their leaves.
+        """
+        if not self.count:
+            return None
+        inv_mat = self._prepare(mat)
+        origin = np.dot(inv_mat, np.append(start, 1.0))
+        ray = np.dot(inv_mat, np.append(direction, 0.0))
+
+        # Paths below the hierarchical rows hit during this query
+        paths = {}
+        i, distance = self.bvh.ray_query(origin[:3], ray[:3],
+                                         lambda indices: self._closest(indices, origin, ray, paths))
+        if i is None:
+            return None
+        return self._hit(i, distance, paths.get(i, ()), origin, ray)
+
+    def _hit(self, i, distance, path, origin, ray):
+        node = self.make_node(int(self.ids[i]))
+        path = (node,) + path
+        point = (origin + distance * ray)[:3]
+        return Hit(node, float(distance), path[-1], path, point, surface_normal(path[-1], point))
+
+    def _prepare(self, mat):
+        # Bring the tree up to date and return the eye to world transform
+        if self.bvh.needs_rebuild:
+            n = self.count
+            self.bvh.build(self.world_min[:n], self.world_max[:n])
+        return np.linalg.inv(mat)
+
+    def query_many(self, starts, directions, mat):
+        """
+        query for N eye space rays at once, such as one per pixel of a
+        screen region, returning a list of N Hits or Nones. The tree walk,
+        the box tests and the exact tests each run once over all candidate
+        (ray, row) pairs; only hits on hierarchical rows are resolved ray
+        by ray, nearest first.
+        """
+        starts = np.asarray(starts, dtype=np.float64).reshape(-1, 3)
+        n_rays = len(starts)
+        if not self.count or not n_rays:
+            return [None] * n_rays
+        inv_mat = self._prepare(mat)
+        origins = np.hstack([starts, np.ones((n_rays, 1))]).dot(inv_mat.T)
+        rays = np.hstack([np.asarray(directions, dtype=np.float64).reshape(-1, 3), np.zeros((n_rays, 1))]).dot(inv_mat.T)
+
+        ray_of, rows = self.bvh.ray_candidates(origins[:, :3], rays[:, :3])
+        inverse = self.inverse_matrices[rows]
+        local_origins = np.einsum('nij,nj->ni', inverse, origins[ray_of])[:, :3]
+        local_directions = np.einsum('nij,nj->ni', inverse, rays[ray_of])[:, :3]
+        min_corners, max_corners = self.min_corners[rows], self.max_corners[rows]
+        hit, distances = ray_hit_batch(local_origins, local_directions, min_corners, max_corners)
+        types = self.store.types[self.ids[rows]]
+        narrow_phase(types, local_origins, local_directions, min_corners, max_corners, hit, distances)
+
+        # As in _closest, per ray: hierarchical rows only count through a
+        # child hit, and are only descended while they could still win
+        deep = hit & IS_HIERARCHICAL[types]
+        best = np.full(n_rays, np.inf)
+        shallow = hit & ~deep
+        np.minimum.at(best, ray_of[shallow], distances[shallow])
+        paths = {}
+        for k in np.flatnonzero(deep)[np.argsort(distances[deep], kind='stable')].tolist():
+            r = ray_of[k]
+            if distances[k] > best[r]:
+                distances[k] = np.inf
+                continue
+            distance, path = hierarchy_hit(self.make_node(int(self.ids[rows[k]])), origins[r], rays[r])
+            distances[k] = distance
+            if path is not None:
+                paths[k] = path
+                best[r] = min(best[r], distance)
+
+        # The nearest pair of each ray, ties going to the lowest row
+        results = [None] * n_rays
+        order = np.lexsort((rows, distances, ray_of))
+        first = order[np.r_[True, ray_of[order][1:] != ray_of[order][:-1]]] if len(order) else order
+        for k in first[np.isfinite(distances[first])].tolist():
+            r = ray_of[k]
+            results[r] = self._hit(int(rows[k]), distances[k], paths.get(k, ()), origins[r], rays[r])
+        return results
+
+    def _closest(self, indices, origin, ray, paths):
+        inverse = self.inverse_matrices[indices]
+        origins = np.dot(inverse, origin)[:, :3]
+        directions = np.dot(inverse, ray)[:, :3]
+        min_corners, max_corners = self.min_corners[indices], self.max_corners[indices]
+        hit, distances = ray_hit_batch(origins, directions, min_corners, max_corners)
+        if not hit.any():
+            return None, float('inf')
+        types = self.store.types[self.ids[indices]]
+        narrow_phase(types, origins, directions, min_corners, max_corners, hit, distances)
+
+        # The box of a hierarchical node only bounds its children, so a hit
+        # on it counts once one of them is hit, nearest boxes first
+        deep = hit & IS_HIERARCHICAL[types]
+        if deep.any():
+            best = distances[hit & ~deep].min() if (hit & ~deep).any() else float('inf')
+            for k in np.flatnonzero(deep)[np.argsort(distances[deep], kind='stable')]:
+                if distances[k] > best:
+                    distances[k] = np.inf
+                    continue
+                distance, path = hierarchy_hit(self.make_node(int(self.ids[indices[k]])), origin, ray)
+                distances[k] = distance
+                if path is not None:
+                    paths[int(indices[k])] = path
+                    best = min(best, distance)
+
+        best = distances.min()
+        if not np.isfinite(best):
+            return None, float('inf')
+        return int(indices[distances == best].min()), best
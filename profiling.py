@@ -0,0 +1,201 @@
+# Per-frame timing and counters for the render and interaction hot paths
+import collections
+import csv
+import json
+import time
+import numpy as np
+
+# Upper bounds in milliseconds of the pick latency histogram buckets
+PICK_BUCKETS_MS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 25.0, 50.0, 100.0, float('inf'))
+
+
+def latency(samples):
+    """
+    Percentiles of a list of durations in seconds, reported in milliseconds.
+    """
+    ms = np.asarray(samples) * 1000.0
+    return {
+        'count': len(ms),
+        'mean_ms': float(ms.mean()),
+        'p50_ms': float(np.percentile(ms, 50)),
+        'p90_ms': float(np.percentile(ms, 90)),
+        'p99_ms': float(np.percentile(ms, 99)),
+        'max_ms': float(ms.max()),
+    }
+
+
+class _NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_STAGE = _NullStage()
+
+
+class _Stage(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.add_time(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class Profiler(object):
+    """
+    Collects CPU time per named stage and event counters for each frame.
+
+    Finished frames go into a ring buffer of the last `history` frames.
+    The profiler is off by default. Instrumented code checks `enabled`, or
+    goes through stage(), which then hands out a shared no-op context, so
+    the hot paths cost next to nothing until it is switched on.
+    """
+    def __init__(self, history=600):
+        self.enabled = False
+        self.frames = collections.deque(maxlen=history)
+        self.current = self._new_frame()
+        self.pick_histogram = [0] * len(PICK_BUCKETS_MS)
+        self.callbacks = collections.defaultdict(lambda: [0, 0.0])
+        self.dump_path = None
+        self.dump_format = 'json'
+        self.dump_interval = 5.0
+        self.last_dump = time.time()
+        self.undumped = []
+
+    def _new_frame(self):
+        return {'start': time.perf_counter(), 'stages': {}, 'counters': {}}
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+        self.current = self._new_frame()
+
+    def reset(self):
+        self.frames.clear()
+        self.pick_histogram = [0] * len(PICK_BUCKETS_MS)
+        self.callbacks.clear()
+        self.current = self._new_frame()
+
+    def begin_frame(self):
+        # Work recorded between frames, like picks, stays with the next frame
+        self.current['start'] = time.perf_counter()
+
+    def stage(self, name):
+        if not self.enabled:
+            return NULL_STAGE
+        return _Stage(self, name)
+
+    def add_time(self, name, seconds):
+        stages = self.current['stages']
+        stages[name] = stages.get(name, 0.0) + seconds
+
+    def count(self, name, n=1):
+        counters = self.current['counters']
+        counters[name] = counters.get(name, 0) + n
+
+    def record_pick(self, seconds):
+        ms = seconds * 1000.0
+        for i, bound in enumerate(PICK_BUCKETS_MS):
+            if ms <= bound:
+                self.pick_histogram[i] += 1
+                break
+
+    def record_callback(self, name, seconds):
+        entry = self.callbacks[name]
+        entry[0] += 1
+        entry[1] += seconds
+
+    def end_frame(self):
+        """
+        Close the current frame, push it into the ring buffer and dump if due.
+        """
+        frame = self.current
+        frame['total'] = time.perf_counter() - frame['start']
+        frame['time'] = time.time()
+        del frame['start']
+        self.frames.append(frame)
+        if self.dump_path is not None:
+            self.undumped.append(frame)
+        self.current = self._new_frame()
+        if self.dump_path is not None and frame['time'] - self.last_dump >= self.dump_interval:
+            self.dump(self.dump_path, self.dump_format)
+        return frame
+
+    def summary(self):
+        """
+        Mean and worst time per stage over the frames in the ring buffer,
+        plus mean counters, pick histogram and callback dispatch times.
+        """
+        stages = collections.defaultdict(list)
+        counters = collections.defaultdict(int)
+        for frame in self.frames:
+            stages['frame'].append(frame['total'])
+            for name, seconds in frame['stages'].items():
+                stages[name].append(seconds)
+            for name, n in frame['counters'].items():
+                counters[name] += n
+        frames = max(len(self.frames), 1)
+        return {
+            'frames': len(self.frames),
+            'stages_ms': dict((name, {'mean': 1000.0 * sum(times) / len(times), 'max': 1000.0 * max(times)})
+                              for name, times in stages.items()),
+            'counters_per_frame': dict((name, float(n) / frames) for name, n in counters.items()),
+            'pick_histogram_ms': dict(zip([str(b) for b in PICK_BUCKETS_MS], self.pick_histogram)),
+            'callbacks': dict((name, {'count': n, 'mean_ms': 1000.0 * total / n})
+                              for name, (n, total) in self.callbacks.items()),
+        }
+
+    def overlay_lines(self):
+        """
+        Short text lines for the on-screen overlay, about the last frame.
+        """
+        if not self.frames:
+            return ['profiling: no frames yet']
+        frame = self.frames[-1]
+        lines = ['frame %.2f ms' % (1000.0 * frame['total'])]
+        for name, seconds in sorted(frame['stages'].items()):
+            lines.append('%s %.2f ms' % (name, 1000.0 * seconds))
+        for name, n in sorted(frame['counters'].items()):
+            lines.append('%s %d' % (name, n))
+        return lines
+
+    def configure_dump(self, path, interval=5.0, format='json'):
+        """
+        Periodically write to path: the JSON summary (overwritten), or the
+        frames since the previous dump as CSV rows (appended).
+        """
+        if format not in ('json', 'csv'):
+            raise ValueError("Unknown dump format %r" % (format,))
+        self.dump_path, self.dump_interval, self.dump_format = path, interval, format
+
+    def dump(self, path, format='json'):
+        if format == 'json':
+            with open(path, 'w') as f:
+                json.dump(self.summary(), f, indent=2, sort_keys=True)
+        else:
+            self._dump_csv(path)
+        self.undumped = []
+        self.last_dump = time.time()
+
+    def _dump_csv(self, path):
+        # One (time, metric, value) row per measurement, so new stages and
+        # counters never change the columns
+        with open(path, 'a') as f:
+            writer = csv.writer(f)
+            if f.tell() == 0:
+                writer.writerow(['time', 'metric', 'value'])
+            for frame in self.undumped:
+                writer.writerow([frame['time'], 'frame_ms', 1000.0 * frame['total']])
+                for name, seconds in sorted(frame['stages'].items()):
+                    writer.writerow([frame['time'], name + '_ms', 1000.0 * seconds])
+                for name, n in sorted(frame['counters'].items()):
+                    writer.writerow([frame['time'], name, n])
+
+PROFILER = Profiler()
@@ -0,0 +1,188 @@
+# Software rasterizer that renders a scene into NumPy buffers
+"""
+Renders the same Scene and Node graph as the GL path, without a GL
+context or display, into a color and a depth buffer:
+
+    renderer = SoftwareRenderer(640, 480)
+    color, depth = renderer.render(scene, camera.projection, camera.model_view)
+
+Nodes go through the same frustum culling and level-of-detail selection
+as Scene.render, and primitives use the triangle meshes of the instanced
+path. Triangles are shaded flat with the fixed-function lighting the
+viewer sets up: GL_LIGHT0 as a directional light along the eye space z
+axis, the default light model ambient and the selection emission.
+
+Triangles are set up in one vectorized pass, binned into square screen
+tiles, and each tile is filled with all of its triangles at once.
+Triangles reaching behind the eye are dropped rather than clipped.
+"""
+import numpy as np
+from color import COLORS
+from geometry import mesh_for_key
+from instancing import SELECTED_EMISSION
+
+# glClearColor of Viewer.init_opengl, and the GL defaults it relies on
+CLEAR_COLOR = (0.4, 0.4, 0.4)
+AMBIENT = 0.2
+LIGHT_DIRECTION = np.array([0.0, 0.0, 1.0])
+# Clip w below which a vertex counts as behind the eye
+MIN_W = 1e-6
+
+
+class SoftwareRenderer(object):
+    """
+    Renders scenes at a fixed resolution. Meshes are built once per
+    geometry key and kept for later frames.
+    """
+    TILE_SIZE = 8
+    # Upper bound on triangle x pixel tests per vectorized step
+    BATCH_ELEMENTS = 1 << 18
+
+    def __init__(self, width, height, tile_size=None):
+        self.width, self.height = int(width), int(height)
+        self.tile_size = tile_size or self.TILE_SIZE
+        self.meshes = {}
+        self.stats = {'triangles': 0, 'rasterized': 0, 'tiles': 0}
+
+    def mesh(self, key):
+        """
+        Triangle positions (T, 3, 3) and face normals (T, 3) for a geometry key.
+        """
+        mesh = self.meshes.get(key)
+        if mesh is None:
+            data = mesh_for_key(key).astype(np.float64).reshape(-1, 3, 6)
+            normals = data[:, :, 3:].sum(axis=1)
+            mesh = self.meshes[key] = (data[:, :, :3], normals / np.linalg.norm(normals, axis=1)[:, None])
+        return mesh
+
+    def render(self, scene, projection, model_view):
+        """
+        Draw the scene as seen through the given camera matrices. Returns an
+        (height, width, 3) uint8 color image, top row first, and the
+        (height, width) float32 window depth, 1.0 where nothing was drawn.
+        """
+        color = np.empty((self.height, self.width, 3), dtype=np.float32)
+        color[:] = CLEAR_COLOR
+        depth = np.ones((self.height, self.width), dtype=np.float32)
+        clip, colors = self.triangles(scene, projection, model_view)
+        self.rasterize(clip, colors, color, depth)
+        return (np.clip(color, 0.0, 1.0) * 255.0 + 0.5).astype(np.uint8), depth
+
+    def triangles(self, scene, projection, model_view):
+        """
+        Clip space corners (T, 3, 4) and shaded colors (T, 3) of every
+        triangle of the nodes in view.
+        """
+        nodes = scene.visible_nodes(np.dot(projection, model_view))
+        leaves, emission = [], []
+        for node in nodes:
+            node_leaves = node.leaves()
+            leaves.extend(node_leaves)
+            # The emission a selected node sets stays on for all its children
+            emission.extend([SELECTED_EMISSION if node.selected else 0.0] * len(node_leaves))
+        scene.lod.update(leaves, projection, model_view, self.height)
+
+        groups = {}
+        for leaf, glow in zip(leaves, emission):
+            group = groups.setdefault(leaf.current_geometry_key, ([], []))
+            group[0].append(leaf)
+            group[1].append(glow)
+        clips, colors = [np.zeros((0, 3, 4))], [np.zeros((0, 3))]
+        for key, (group, glow) in groups.items():
+            positions, normals = self.mesh(key)
+            eye = np.einsum('ij,ljk->lik', model_view, np.array([leaf.world_matrix for leaf in group]))
+            corners = np.concatenate([positions, np.ones(positions.shape[:2] + (1,))], axis=2)
+            clips.append(np.einsum('ij,ljk,tvk->ltvi', projection, eye, corners).reshape(-1, 3, 4))
+            # The subscripts 'lji' apply the inverses transposed
+            normal_matrices = np.linalg.inv(eye[:, :3, :3])
+            eye_normals = np.einsum('lji,tj->lti', normal_matrices, normals)
+            eye_normals /= np.linalg.norm(eye_normals, axis=2)[:, :, None]
+            light = AMBIENT + np.maximum(eye_normals.dot(LIGHT_DIRECTION), 0.0)
+            base = np.array([COLORS[leaf.color_index] for leaf in group])
+            shaded = base[:, None, :] * light[:, :, None] + np.array(glow)[:, None, None]
+            colors.append(shaded.reshape(-1, 3))
+        return np.concatenate(clips), np.concatenate(colors)
+
+    def rasterize(self, clip, colors, color_buffer, depth_buffer):
+        """
+        Depth-tested fill of triangles given in clip space into the buffers.
+        """
+        width, height, tile = self.width, self.height, self.tile_size
+        self.stats = {'triangles': len(clip), 'rasterized': 0, 'tiles': 0}
+        w = clip[:, :, 3]
+        visible = (w > MIN_W).all(axis=1)
+        clip, colors, w = clip[visible], colors[visible], w[visible]
+        ndc = clip[:, :, :3] / w[:, :, None]
+        # Window coordinates, with rows counted from the top
+        x = (ndc[:, :, 0] + 1.0) * 0.5 * width
+        y = (1.0 - ndc[:, :, 1]) * 0.5 * height
+        z = (ndc[:, :, 2] + 1.0) * 0.5
+
+        # Edge i runs between the two corners other than corner i; its
+        # function, divided by the area, is the barycentric weight of i
+        x0, x1, x2 = x[:, 0], x[:, 1], x[:, 2]
+        y0, y1, y2 = y[:, 0], y[:, 1], y[:, 2]
+        area = (x2 - x1) * (y0 - y1) - (y2 - y1) * (x0 - x1)
+        # Counter-clockwise front faces turn clockwise once rows go down
+        front = area < 0
+        low_x = np.maximum(np.ceil(x.min(axis=1) - 0.5), 0)
+        high_x = np.minimum(np.floor(x.max(axis=1) - 0.5), width - 1)
+        low_y = np.maximum(np.ceil(y.min(axis=1) - 0.5), 0)
+        high_y = np.minimum(np.floor(y.max(axis=1) - 0.5), height - 1)
+        keep = (front & (low_x <= high_x) & (low_y <= high_y) &
+                (z.max(axis=1) >= 0.0) & (z.min(axis=1) <= 1.0))
+        if not keep.any():
+            return
+        index = np.flatnonzero(keep)
+        with np.errstate(divide='ignore'):
+            inverse_area = 1.0 / area[index]
+        edges = []
+        for (xa, ya), (xb, yb) in (((x1, y1), (x2, y2)), ((x2, y2), (x0, y0)), ((x0, y0), (x1, y1))):
+            xa, ya, xb, yb = xa[index], ya[index], xb[index], yb[index]
+            # e(px, py) = a * px + b * py + c, prescaled by the inverse area
+            edges.append((-(yb - ya) * inverse_area, (xb - xa) * inverse_area,
+                          ((yb - ya) * xa - (xb - xa) * ya) * inverse_area))
+        depths, shades = z[index], colors[index]
+        self.stats['rasterized'] = len(index)
+
+        # Bin triangles into every tile their pixel bounds touch
+        tile_x0, tile_x1 = (low_x[index] // tile).astype(np.int64), (high_x[index] // tile).astype(np.int64)
+        tile_y0, tile_y1 = (low_y[index] // tile).astype(np.int64), (high_y[index] // tile).astype(np.int64)
+        span_x, span_y = tile_x1 - tile_x0 + 1, tile_y1 - tile_y0 + 1
+        counts = span_x * span_y
+        triangles = np.repeat(np.arange(len(index)), counts)
+        k = np.arange(int(counts.sum())) - np.repeat(np.cumsum(counts) - counts, counts)
+        columns = tile_x0[triangles] + k % span_x[triangles]
+        rows = tile_y0[triangles] + k // span_x[triangles]
+        tiles_across = (width + tile - 1) // tile
+        bins = rows * tiles_across + columns
+        order = np.argsort(bins, kind='stable')
+        bins, triangles = bins[order], triangles[order]
+        starts = np.flatnonzero(np.r_[True, bins[1:] != bins[:-1]])
+        ends = np.r_[starts[1:], len(bins)]
+        self.stats['tiles'] = len(starts)
+
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            row, column = divmod(int(bins[start]), tiles_across)
+            top, left = row * tile, column * tile
+            bottom, right = min(top + tile, height), min(left + tile, width)
+            py, px = np.mgrid[top:bottom, left:right]
+            px, py = px.ravel() + 0.5, py.ravel() + 0.5
+            tile_depth = depth_buffer[top:bottom, left:right].ravel()
+            tile_color = color_buffer[top:bottom, left:right].reshape(-1, 3)
+            step = max(1, self.BATCH_ELEMENTS // len(px))
+            for lo in range(start, end, step):
+                batch = triangles[lo:min(lo + step, end)]
+                weights = [a[batch, None] * px + b[batch, None] * py + c[batch, None] for a, b, c in edges]
+                inside = (weights[0] >= 0) & (weights[1] >= 0) & (weights[2] >= 0)
+                d = depths[batch]
+                pixel_depth = weights[0] * d[:, 0, None] + weights[1] * d[:, 1, None] + weights[2] * d[:, 2, None]
+                inside &= (pixel_depth >= 0.0) & (pixel_depth <= 1.0)
+                pixel_depth = np.where(inside, pixel_depth, np.inf)
+                nearest = pixel_depth.argmin(axis=0)
+                nearest_depth = pixel_depth[nearest, np.arange(len(px))]
+                closer = nearest_depth < tile_depth
+                tile_depth[closer] = nearest_depth[closer]
+                tile_color[closer] = shades[batch[nearest[closer]]]
+            depth_buffer[top:bottom, left:right] = tile_depth.reshape(bottom - top, right - left)
+            color_buffer[top:bottom, left:right] = tile_color.reshape(bottom - top, right - left, 3)
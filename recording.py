@@ -0,0 +1,228 @@
+# Recording of interaction sessions, and their replay as a load test
+"""
+An EventRecorder attached to an Interaction writes every callback it
+dispatches to a gzip compressed file of JSON lines, with the time since
+recording started, together with each frame the viewer draws and every
+change of the window size or the trackball's view:
+
+    python main.py my_scene.3drs --record session.rec
+
+Replaying feeds the same stream back into a Viewer, either at the pace
+it was recorded or as fast as possible, and reports latency percentiles
+per callback and of the frames, as JSON:
+
+    python recording.py session.rec --headless --output replay.json
+    python recording.py session.rec --headless --compare replay.json
+
+A replay starts from a copy of the scene file the session was recorded
+on, as that file is now, so sessions that save should be recorded on a
+copy of the scene. Random node colors are seeded from the recording.
+With --headless the viewer runs against the GL stub in glstub.py.
+"""
+import argparse
+import atexit
+import collections
+import gzip
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+from profiling import latency
+
+VERSION = 2
+# Record kinds besides callbacks, which are named after the callback
+FRAME = '@frame'
+VIEW = '@view'
+
+
+def _plain(value):
+    # NumPy scalars and arrays that reach a callback
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    raise TypeError("Cannot record %r" % (value,))
+
+
+def view_state(interaction):
+    """
+    Window size, and trackball orientation, distance and pan.
+    """
+    orientation, distance, pan = interaction.trackball.state()
+    return [list(interaction.window_size), list(orientation), distance, list(pan)]
+
+
+def apply_view(interaction, window_size, orientation, distance, pan):
+    interaction.window_size = tuple(window_size)
+    interaction.trackball.set_state(orientation, distance, pan)
+
+
+class EventRecorder(object):
+    """
+    Writes the session of one Interaction to path, until closed or the
+    process exits. Records are [time, name, args] or
+    [time, name, args, kwargs] per callback, [time, FRAME] per frame and
+    [time, VIEW, window_size, orientation, distance, pan] per view change.
+    """
+    def __init__(self, path, interaction, scene_path=None):
+        self.interaction = interaction
+        self.file = gzip.open(path, 'wt')
+        self.seed = random.randrange(1 << 32)
+        random.seed(self.seed)
+        self._write({
+            'version': VERSION,
+            'scene': os.path.abspath(scene_path) if scene_path else None,
+            'window': list(interaction.window_size),
+            'seed': self.seed,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        })
+        self.start = time.perf_counter()
+        self.view = None
+        self.records = 0
+        atexit.register(self.close)
+
+    def _write(self, record):
+        self.file.write(json.dumps(record, separators=(',', ':'), default=_plain))
+        self.file.write('\n')
+
+    def _now(self):
+        return round(time.perf_counter() - self.start, 6)
+
+    def _check_view(self, now):
+        # Camera changes made without a callback, like wheel zoom
+        view = view_state(self.interaction)
+        if view != self.view:
+            self.view = view
+            self._write([now, VIEW] + view)
+
+    def record(self, name, args, kwargs):
+        if self.file is None:
+            return
+        now = self._now()
+        self._check_view(now)
+        self._write([now, name, list(args), kwargs] if kwargs else [now, name, list(args)])
+        self.records += 1
+
+    def frame(self):
+        if self.file is None:
+            return
+        now = self._now()
+        self._check_view(now)
+        self._write([now, FRAME])
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def read_session(path):
+    """
+    The header and the list of records of a recorded session.
+    """
+    with gzip.open(path, 'rt') as f:
+        header = json.loads(f.readline() or 'null')
+        if not isinstance(header, dict) or header.get('version') != VERSION:
+            raise ValueError("%s is not a version %d session recording" % (path, VERSION))
+        return header, [json.loads(line) for line in f if line.strip()]
+
+
+def replay(viewer, records, realtime=False):
+    """
+    Dispatch recorded callbacks to the viewer's Interaction and render
+    its frames, waiting for each record's time when realtime is set.
+    Returns the report: latency per callback and of frames, and the
+    recorded and replayed durations.
+    """
+    interaction = viewer.interaction
+    callbacks = collections.defaultdict(list)
+    frames = []
+    start = time.perf_counter()
+    for record in records:
+        if realtime:
+            delay = start + record[0] - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        name = record[1]
+        if name == VIEW:
+            apply_view(interaction, *record[2:])
+            continue
+        begin = time.perf_counter()
+        if name == FRAME:
+            viewer.render()
+            frames.append(time.perf_counter() - begin)
+        else:
+            interaction.dispatch(name, *record[2], **(record[3] if len(record) > 3 else {}))
+            callbacks[name].append(time.perf_counter() - begin)
+    return {
+        'realtime': realtime,
+        'recorded_s': records[-1][0] if records else 0.0,
+        'replayed_s': time.perf_counter() - start,
+        'events': sum(len(samples) for samples in callbacks.values()),
+        'frames': latency(frames) if frames else None,
+        'callbacks': dict((name, latency(samples)) for name, samples in callbacks.items()),
+        'nodes': len(viewer.scene.node_list),
+    }
+
+
+def _metrics(report, prefix=''):
+    for key, value in report.items():
+        if isinstance(value, dict):
+            for item in _metrics(value, prefix + key + '.'):
+                yield item
+        elif isinstance(value, float):
+            yield prefix + key, value
+
+
+def compare(current, baseline):
+    """
+    Ratio current / baseline for every timing both replay reports have.
+    """
+    old = dict(_metrics(baseline))
+    return dict((name, value / old[name]) for name, value in _metrics(current) if old.get(name))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('session', help="recorded session to replay")
+    parser.add_argument('--realtime', action='store_true', help="keep the recorded pace instead of running flat out")
+    parser.add_argument('--headless', action='store_true', help="run against the GL stub, without a display")
+    parser.add_argument('--scene', help="scene file to start from instead of the recorded one")
+    parser.add_argument('--output', help="write the report here instead of stdout")
+    parser.add_argument('--compare', help="earlier report to give ratios against")
+    args = parser.parse_args(argv)
+
+    header, records = read_session(args.session)
+    if args.headless:
+        import glstub
+        glstub.install(tuple(header['window']))
+    # The viewer is imported once the GL modules are settled
+    from viewer import Viewer
+
+    # Saves in the session go to a copy, not the original scene file
+    directory = tempfile.mkdtemp()
+    try:
+        scene_path = os.path.join(directory, 'replay.3drs')
+        source = args.scene or header['scene']
+        if source and os.path.exists(source):
+            shutil.copyfile(source, scene_path)
+        viewer = Viewer(scene_path)
+        random.seed(header['seed'])
+        report = replay(viewer, records, args.realtime)
+    finally:
+        shutil.rmtree(directory)
+    report['session'] = args.session
+    if args.compare:
+        with open(args.compare) as f:
+            report['ratios'] = compare(report, json.load(f))
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,77 +1,510 @@
-# Scene Class and Node Management
-import numpy as np
-from node import Node
-
-class Scene(object):
-    PLACE_DEPTH = 15.0
-    
-    def __init__(self):
-        self.node_list = []
-        self.selected_node = None
-        
-    def add_node(self, node):
-        self.node_list.append(node)
-        
-    def render(self):
-        for node in self.node_list:
-            node.render()
-            
-    def pick(self, start, direction, mat):
-        if self.selected_node is not None:
-            self.selected_node.select(False)
-            self.selected_node = None
-    
-        mindist = float('inf')
-        closest_node = None
-        for node in self.node_list:
-            hit, distance = node.pick(start, direction, mat)
-            if hit and distance < mindist:
-                mindist, closest_node = distance, node
-                
-        if closest_node is not None:
-            closest_node.select()
-            closest_node.depth = mindist
-            closest_node.selected_loc = start + direction * mindist
-            
-    def rotate_selected_color(self, forward):
-        # Rotate the selected object by color or orientation
-        if self.selected_node is not None:
-            if forward:
-                self.selected_node.rotate_color(True)  # Rotate color forward
-            else:
-                self.selected_node.rotate_color(False)  # Rotate color backward
-        
-    def scale_selected(self, up):
-        # Scale the selected object
-        if self.selected_node is not None:
-            scale_factor = 1.1 if up else 0.9
-            self.selected_node.scale(scale_factor)
-        
-    def move_selected(self, start, direction, inv_modelView):
-        if self.selected_node is None: 
-            return
-        node = self.selected_node
-        depth = node.depth
-        oldloc = node.selected_loc
-        newloc = start + direction * depth
-        translation = newloc - oldloc
-        pre_tran = np.array([translation[0], translation[1], translation[2], 0])
-        translation = inv_modelView.dot(pre_tran)
-        node.translate(translation[0], translation[1], translation[2])
-        node.selected_loc = newloc
-        
-    def place(self, shape, start, direction, inv_modelView):
-        from node import Sphere, Cube, SnowFigure
-        new_node = None
-        if shape == 'sphere': 
-            new_node = Sphere()
-        elif shape == 'cube': 
-            new_node = Cube()
-        elif shape == 'figure': 
-            new_node = SnowFigure()
-        
-        self.add_node(new_node)
-        translation = start + direction * self.PLACE_DEPTH
-        pre_tran = np.array([translation[0], translation[1], translation[2], 1])
-        translation = inv_modelView.dot(pre_tran)
-        new_node.translate(translation[0], translation[1], translation[2])
+# Scene Class and Node Management
+import collections
+import random
+import numpy as np
+from node import Node, Sphere, Cube, SnowFigure, NodeList, node_for_id, allocate_nodes
+from picking import PickBuffer
+from collision import HashGrid
+from instancing import InstancedRenderer
+from culling import frustum_planes, boxes_in_frustum, region_planes, points_in_polygon, is_convex, signed_area
+from color import MIN_COLOR, MAX_COLOR
+from geometry import GEOMETRY_CACHE
+from nodestore import ALIVE, SELECTED, DIRTY
+from lod import LODSelector
+from profiling import PROFILER
+import time
+
+class Scene(object):
+    PLACE_DEPTH = 15.0
+    # 'immediate' renders node by node, 'instanced' one draw per geometry
+    RENDER_MODES = ('immediate', 'instanced')
+    SHAPES = {'sphere': Sphere, 'cube': Cube, 'figure': SnowFigure}
+    # What a drag does about nodes it runs into: nothing, list them in
+    # contacts, or also stop the move along the axes that would overlap
+    COLLISION_MODES = ('off', 'report', 'resolve')
+    
+    def __init__(self):
+        # Nodes loaded from a scene file stay plain ids until first used
+        self.node_list = NodeList(self.node_for_id)
+        # Every selected node, and the one last grabbed by a pick, if any
+        self.selection = []
+        self.selected_node = None
+        self.pick_buffer = PickBuffer(make_node=self.node_for_id)
+        self.bvh = self.pick_buffer.bvh
+        self.collisions = HashGrid(self.pick_buffer)
+        self.collision_mode = 'report'
+        # (node id, other node id) overlaps after the last drag or placement
+        self.contacts = []
+        self.render_mode = 'immediate'
+        self.instancing = None
+        self.cull_stats = {'visible': 0, 'culled': 0}
+        self.lod = LODSelector()
+        # Bumped on every change that needs a new frame
+        self.version = 0
+        # Eye distance and eye space point where the selected node was grabbed
+        self.drag_depth = None
+        self.drag_loc = None
+        # picking.Hit of the last pick, or None
+        self.last_hit = None
+        # The scenefile.SceneFile last saved to or loaded from
+        self.scene_file = None
+        # GEOMETRY_CACHE keys held for nodes that have not drawn yet
+        self.held_geometry = collections.Counter()
+
+    def node_for_id(self, node_id):
+        node = node_for_id(node_id)
+        node.scene = self
+        return node
+        
+    def add_node(self, node):
+        self.node_list.append(node)
+        node.scene = self
+        node.store.handles[node.id] = node
+        self.version += 1
+        self.pick_buffer.add(node)
+        self.collisions.update([node.id])
+        if self.instancing is not None:
+            self.instancing.add(node)
+
+    def add_nodes(self, nodes):
+        """
+        Add many nodes in one go. The pick index and the instance buffers
+        take the whole batch at once instead of one update per node.
+        """
+        nodes = list(nodes)
+        for node in nodes:
+            node.scene = self
+            node.store.handles[node.id] = node
+        self.node_list.extend(nodes)
+        self.version += 1
+        self.pick_buffer.extend(nodes)
+        self.collisions.update([node.id for node in nodes])
+        if self.instancing is not None:
+            self.instancing.add_many(nodes)
+        return nodes
+
+    def reserve(self, count):
+        """
+        Make room for count more nodes up front, so adding them in batches
+        later never stops to grow and copy the per-node arrays.
+        """
+        store = self.pick_buffer.store
+        store.reserve(store.size + count)
+        self.pick_buffer.reserve(len(self.pick_buffer) + count)
+
+    def hold_geometry(self, keys):
+        """
+        Take over references to GEOMETRY_CACHE entries acquired for the
+        scene's nodes, such as display lists compiled ahead of streamed
+        nodes. Each is kept until a node holds the entry itself.
+        """
+        self.held_geometry.update(keys)
+
+    def release_geometry(self, everything=False):
+        """
+        Release the held entries nodes now hold, or all of them when the
+        scene is torn down.
+        """
+        for key, count in list(self.held_geometry.items()):
+            if everything or GEOMETRY_CACHE.refcounts.get(key, 0) > count:
+                for _ in range(count):
+                    GEOMETRY_CACHE.release(key)
+                del self.held_geometry[key]
+
+    def add_node_ids(self, ids):
+        """
+        Add top-level nodes that only exist as rows of the node store, like
+        those of a loaded scene file. Their handles are made when something
+        first needs them, such as rendering or picking.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        self.node_list.extend_ids(ids)
+        self.version += 1
+        self.pick_buffer.extend_ids(ids)
+        self.collisions.update(ids)
+        if self.instancing is not None:
+            self.instancing.add_many(self.node_for_id(i) for i in ids.tolist())
+
+    def remove_node(self, node):
+        self.remove_nodes([node])
+
+    def remove_nodes(self, nodes):
+        """
+        Remove many top-level nodes at once, with one pass over the node
+        list, the pick rows and the collision grid.
+        """
+        nodes = list(nodes)
+        if not nodes:
+            return
+        removed = set(nodes)
+        if removed.intersection(self.selection):
+            self.set_selection([n for n in self.selection if n not in removed])
+        ids = np.array([node.id for node in nodes], dtype=np.int64)
+        self.node_list.remove_ids(ids)
+        self.version += 1
+        self.pick_buffer.remove_ids(ids)
+        self.collisions.update(ids)
+        for node in nodes:
+            if self.instancing is not None:
+                self.instancing.remove(node)
+            node.scene = None
+            node.store.handles.pop(node.id, None)
+            node.release()
+
+    def clear(self):
+        """
+        Remove every node and give its store rows back, children included,
+        along with the display lists held for the scene. Rows otherwise
+        only go back when their handle is collected, which never happens
+        for rows added as plain ids, as scene files and streaming add them.
+        """
+        store = self.pick_buffer.store
+        roots = self.node_list.ids()
+        ids, rows = [roots], roots
+        while len(rows):
+            alive = (store.flags[:store.size] & ALIVE) != 0
+            rows = np.flatnonzero(np.isin(store.parents[:store.size], rows) & alive)
+            ids.append(rows)
+        handles = [store.handles.get(i) for i in roots.tolist()]
+        for node in handles:
+            if node is not None:
+                node.release()
+                node.forget()
+        store.free_many(np.concatenate(ids))
+        if self.instancing is not None:
+            self.instancing.delete()
+            self.instancing = None
+        self.release_geometry(everything=True)
+        self.node_list = NodeList(self.node_for_id)
+        self.selection = []
+        self.selected_node = None
+        self.pick_buffer.clear()
+        self.collisions.clear()
+        self.contacts = []
+        self.cull_stats = {'visible': 0, 'culled': 0}
+        self.drag_depth = None
+        self.drag_loc = None
+        self.last_hit = None
+        self.scene_file = None
+        self.version += 1
+
+    def remove_selected(self):
+        self.remove_nodes(self.selection)
+
+    def node_changed(self, node, transform=True):
+        self.version += 1
+        if transform:
+            self.pick_buffer.update(node)
+            self.collisions.update([node.id])
+        if self.instancing is not None:
+            self.instancing.update(node)
+
+    def nodes_changed(self, nodes, transform=True):
+        """
+        node_changed for many top-level nodes, with their pick rows
+        refreshed in one pass.
+        """
+        self.version += 1
+        if transform:
+            self.pick_buffer.update_many(nodes)
+            self.collisions.update([node.id for node in nodes])
+        if self.instancing is not None:
+            for node in nodes:
+                self.instancing.update(node)
+
+    def set_selection(self, nodes):
+        """
+        Make nodes the selection, setting and clearing selection flags in bulk.
+        """
+        old, self.selection = self.selection, list(nodes)
+        store = self.pick_buffer.store
+        if old:
+            store.flags[[node.id for node in old]] &= ~SELECTED & 0xff
+        if self.selection:
+            store.flags[[node.id for node in self.selection]] |= SELECTED
+        if self.selected_node is not None and not self.selected_node.selected:
+            self.selected_node = None
+        self.version += 1
+        if self.instancing is not None:
+            for node in set(old) | set(self.selection):
+                self.instancing.update(node)
+
+    def clear_selection(self):
+        self.set_selection([])
+
+    def select_region(self, polygon, projection, model_view, viewport, add=False):
+        """
+        Select the nodes inside a screen polygon of window pixels, origin
+        bottom left, within a viewport of (width, height). A convex polygon,
+        like a marquee rectangle, selects every node whose bounds reach into
+        it, tested as a narrower frustum against all node bounds at once; a
+        concave lasso selects the nodes whose bounds' centre falls inside.
+        With add, the nodes join the current selection.
+        """
+        polygon = np.asarray(polygon, dtype=np.float64).reshape(-1, 2)
+        nodes = []
+        if len(polygon) >= 3 and abs(signed_area(polygon)) > 0.5:
+            ndc = polygon / np.asarray(viewport, dtype=np.float64) * 2.0 - 1.0
+            matrix = np.dot(projection, model_view)
+            buffer = self.pick_buffer
+            n = len(buffer)
+            min_corners, max_corners = buffer.world_min[:n], buffer.world_max[:n]
+            if is_convex(ndc):
+                inside = boxes_in_frustum(region_planes(matrix, ndc), min_corners, max_corners)
+            else:
+                centers = np.hstack([(min_corners + max_corners) / 2.0, np.ones((n, 1))]).dot(matrix.T)
+                w = centers[:, 3]
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    inside = (w > 0) & points_in_polygon(centers[:, :2] / w[:, None], ndc)
+            nodes = [self.node_for_id(i) for i in buffer.ids[:n][inside].tolist()]
+        if add:
+            old = set(self.selection)
+            nodes = self.selection + [node for node in nodes if node not in old]
+        self.set_selection(nodes)
+        return nodes
+
+    def select_rectangle(self, x0, y0, x1, y1, projection, model_view, viewport, add=False):
+        """
+        select_region for the window rectangle between two corners.
+        """
+        polygon = [(x0, y0), (x1, y0), (x1, y1), (x0, y1)]
+        return self.select_region(polygon, projection, model_view, viewport, add)
+
+    def set_collision_mode(self, mode):
+        if mode not in self.COLLISION_MODES:
+            raise ValueError("Unknown collision mode %r" % (mode,))
+        self.collision_mode = mode
+        self.contacts = []
+
+    def overlapping_pairs(self):
+        """
+        Every pair of top-level nodes whose world bounds overlap, as an
+        (M, 2) array of node ids.
+        """
+        return self.collisions.all_pairs()
+
+    def _free_translation(self, ids, translation):
+        # Keep the axes of a move that run into no node the moved ones did
+        # not already overlap, so a node can slide along another, or leave
+        # one it was dropped into
+        touching = set(other for _, other in self.collisions.contacts(ids))
+        allowed = np.zeros(3)
+        for axis in range(3):
+            if not translation[axis]:
+                continue
+            step = allowed.copy()
+            step[axis] = translation[axis]
+            if all(other in touching for _, other in self.collisions.contacts(ids, step)):
+                allowed = step
+        return allowed
+
+    def set_lod_thresholds(self, thresholds, hysteresis=None):
+        """
+        Screen sizes in pixels at which curved primitives switch to the next
+        finer tessellation tier.
+        """
+        self.lod.set_thresholds(thresholds, hysteresis)
+        self.version += 1
+
+    def set_render_mode(self, mode):
+        if mode not in self.RENDER_MODES:
+            raise ValueError("Unknown render mode %r" % (mode,))
+        self.render_mode = mode
+        self.version += 1
+        if mode != 'instanced' and self.instancing is not None:
+            self.instancing.delete()
+            self.instancing = None
+        self.cull_stats = {'visible': 0, 'culled': 0}
+
+    def render(self, projection=None, model_view=None, viewport_height=None):
+        """
+        Draw the scene. Given the current projection and model-view
+        matrices, nodes whose world bounds lie outside the view frustum are
+        skipped; a hierarchical node is culled as a whole, children and all.
+        With the viewport height as well, curved primitives get a
+        tessellation tier for their size on screen.
+        """
+        if self.render_mode == 'instanced':
+            # Created on first use, since it needs a current GL context
+            if self.instancing is None:
+                self.instancing = InstancedRenderer(self)
+            if self.instancing.supported:
+                visible = None
+                self.cull_stats = {'visible': len(self.node_list), 'culled': 0}
+                if projection is not None and model_view is not None:
+                    with PROFILER.stage('cull'):
+                        rows = self._visible_rows(np.dot(projection, model_view))
+                        buffer = self.pick_buffer
+                        visible = np.zeros(len(buffer.id_rows), dtype=bool)
+                        visible[buffer.ids[:len(buffer)][rows]] = True
+                    shown = int(rows.sum())
+                    self.cull_stats = {'visible': shown, 'culled': len(self.node_list) - shown}
+                view = None
+                if viewport_height is not None and projection is not None and model_view is not None:
+                    view = (projection, model_view, viewport_height)
+                with PROFILER.stage('submit'):
+                    self.instancing.render(visible, self.lod, view)
+                if PROFILER.enabled:
+                    PROFILER.count('visible', self.cull_stats['visible'])
+                    PROFILER.count('culled', self.cull_stats['culled'])
+                return
+        nodes = self.node_list
+        if projection is not None and model_view is not None:
+            with PROFILER.stage('cull'):
+                nodes = self.visible_nodes(np.dot(projection, model_view))
+        self.cull_stats = {'visible': len(nodes), 'culled': len(self.node_list) - len(nodes)}
+        if viewport_height is not None and projection is not None and model_view is not None:
+            with PROFILER.stage('lod'):
+                leaves = [leaf for node in nodes for leaf in node.leaves()]
+                self.lod.update(leaves, projection, model_view, viewport_height)
+        with PROFILER.stage('submit'):
+            for node in nodes:
+                node.render()
+        if self.held_geometry:
+            self.release_geometry()
+        if PROFILER.enabled:
+            PROFILER.count('visible', self.cull_stats['visible'])
+            PROFILER.count('culled', self.cull_stats['culled'])
+
+    def visible_nodes(self, matrix):
+        """
+        The nodes at least partly inside the frustum of a combined
+        projection . model-view matrix.
+        """
+        buffer = self.pick_buffer
+        visible = self._visible_rows(matrix)
+        return [self.node_for_id(i) for i in buffer.ids[:len(buffer)][visible].tolist()]
+
+    def _visible_rows(self, matrix):
+        # Pick buffer rows whose world bounds touch the frustum
+        buffer = self.pick_buffer
+        n = len(buffer)
+        return boxes_in_frustum(frustum_planes(matrix), buffer.world_min[:n], buffer.world_max[:n])
+            
+    def pick(self, start, direction, mat):
+        if PROFILER.enabled:
+            began = time.perf_counter()
+        hit = self.last_hit = self.pick_buffer.query(start, direction, mat)
+        closest_node, mindist = (hit.node, hit.distance) if hit is not None else (None, float('inf'))
+
+        # Grabbing a node of a group selection keeps the group, to drag it
+        if closest_node is None or closest_node not in self.selection:
+            self.set_selection([] if closest_node is None else [closest_node])
+        self.selected_node = closest_node
+        if closest_node is not None:
+            self.drag_depth = mindist
+            self.drag_loc = start + direction * mindist
+        if PROFILER.enabled:
+            PROFILER.record_pick(time.perf_counter() - began)
+            PROFILER.count('picks')
+        return closest_node, mindist
+
+    def pick_many(self, starts, directions, mat):
+        """
+        The picking.Hit, or None, of each of many eye space rays, cast in
+        one batch. Unlike pick, this leaves the selection alone.
+        """
+        return self.pick_buffer.query_many(starts, directions, mat)
+
+    def _selection_changed(self, ids, transform=True):
+        # The group edits below write the store directly for all selected
+        # nodes, then do what Node.changed would for each
+        self.pick_buffer.store.flags[ids] |= DIRTY
+        if transform:
+            for node in self.selection:
+                node.invalidate()
+        self.nodes_changed(self.selection, transform)
+
+    def _selection_ids(self):
+        return np.array([node.id for node in self.selection], dtype=np.int64)
+
+    def rotate_selected_color(self, forward):
+        # Rotate the selected objects by color
+        if not self.selection:
+            return
+        ids = self._selection_ids()
+        colors = self.pick_buffer.store.colors
+        step = 1 if forward else -1
+        colors[ids] = MIN_COLOR + (colors[ids] - MIN_COLOR + step) % (MAX_COLOR - MIN_COLOR + 1)
+        self._selection_changed(ids, transform=False)
+
+    def scale_selected(self, up):
+        # Scale the selected objects, each about its own origin
+        if not self.selection:
+            return
+        ids = self._selection_ids()
+        self.pick_buffer.store.scales[ids] *= 1.1 if up else 0.9
+        self._selection_changed(ids)
+
+    def move_selected(self, start, direction, inv_modelView):
+        if self.selected_node is None or not self.selection:
+            return
+        oldloc = self.drag_loc
+        newloc = start + direction * self.drag_depth
+        translation = newloc - oldloc
+        # A direction has w = 0, so only the linear part of the inverse applies
+        translation = inv_modelView[:3, :3].dot(translation)
+        ids = self._selection_ids()
+        if self.collision_mode == 'resolve':
+            translation = self._free_translation(ids, translation)
+        self.pick_buffer.store.translations[ids] += translation
+        self._selection_changed(ids)
+        if self.collision_mode != 'off':
+            self.contacts = self.collisions.contacts(ids)
+        self.drag_loc = newloc
+        
+    def place(self, shape, start, direction, inv_modelView, depth=None):
+        new_node = self.SHAPES[shape]()
+        translation = start + direction * (self.PLACE_DEPTH if depth is None else depth)
+        pre_tran = np.array([translation[0], translation[1], translation[2], 1])
+        translation = inv_modelView.dot(pre_tran)
+        new_node.translate(translation[0], translation[1], translation[2])
+        self.add_node(new_node)
+        if self.collision_mode != 'off':
+            self.contacts = self.collisions.contacts([new_node.id])
+        return new_node
+
+    def place_many(self, shapes, positions, scales=None, colors=None):
+        """
+        Add one node per shape name at the matching world space position,
+        and return their ids. scales is a uniform scale per node or an
+        (N, 3) array, colors an index into COLORS per node; without them
+        nodes get unit scale and random colors. A single shape name is
+        used for every position. The nodes are written to the store in
+        bulk, and their handles are only made when first used.
+        """
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+        if isinstance(shapes, str):
+            shapes = [shapes] * len(positions)
+        if len(shapes) != len(positions):
+            raise ValueError("Got %d shapes for %d positions" % (len(shapes), len(positions)))
+        ids = np.zeros(len(shapes), dtype=np.int64)
+        if not len(ids):
+            return ids
+        store = self.pick_buffer.store
+        names = np.asarray(shapes)
+        for shape in sorted(set(shapes)):
+            same = names == shape
+            ids[same] = allocate_nodes(self.SHAPES[shape], int(same.sum()), store)
+        store.translations[ids] = positions
+        if scales is not None:
+            scales = np.asarray(scales, dtype=np.float32)
+            store.scales[ids] = scales[:, None] if scales.ndim == 1 else scales
+        if colors is None:
+            # Drawn from random, like Node colors, so seeding it still works
+            colors = np.random.default_rng(random.getrandbits(64)).integers(MIN_COLOR, MAX_COLOR + 1, len(ids))
+        store.colors[ids] = colors
+        self.add_node_ids(ids)
+        return ids
+
+    def place_on_rays(self, shapes, starts, directions, inv_modelView, depth=None, scales=None, colors=None):
+        """
+        place_many for eye space rays, such as Camera.get_ray gives for
+        screen points: each node goes depth along its ray, PLACE_DEPTH by
+        default, and all points are taken to world space in one product.
+        """
+        depth = self.PLACE_DEPTH if depth is None else depth
+        points = np.asarray(starts, dtype=np.float64) + np.asarray(directions) * np.reshape(depth, (-1, 1))
+        points = np.hstack([points, np.ones((len(points), 1))])
+        positions = points.dot(inv_modelView.T)[:, :3]
+        return self.place_many(shapes, positions, scales, colors)
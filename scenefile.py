@@ -0,0 +1,224 @@
+# Binary scene files, memory-mapped for lazy loading and incremental saves
+"""
+A scene file is a fixed header followed by one column per node field,
+each sized for `capacity` rows, so any row can be read or rewritten in
+place:
+
+    header   magic, version, count, capacity
+    columns  types u1, flags u1, parents i4, colors i4,
+             translations 3f4, scales 3f4, bounds_min 3f4, bounds_max 3f4
+
+Rows hold every node of a scene, children included. Parents are row
+numbers, -1 for top-level nodes. A removed node keeps its row, with
+flags 0, until a full save compacts the file.
+"""
+import os
+import numpy as np
+from node import set_default_lod_tiers
+from nodestore import DEFAULT_STORE, ALIVE, DIRTY
+from scene import Scene
+
+MAGIC = b'3DRSCENE'
+VERSION = 1
+HEADER = np.dtype([('magic', 'S8'), ('version', '<u4'), ('count', '<u4'), ('capacity', '<u4'), ('reserved', '<u4')])
+COLUMNS = (
+    ('types', '<u1', ()),
+    ('flags', '<u1', ()),
+    ('parents', '<i4', ()),
+    ('colors', '<i4', ()),
+    ('translations', '<f4', (3,)),
+    ('scales', '<f4', (3,)),
+    ('bounds_min', '<f4', (3,)),
+    ('bounds_max', '<f4', (3,)),
+)
+# Columns copied as they are to and from the NodeStore field of that name
+STATE = ('types', 'colors', 'translations', 'scales', 'bounds_min', 'bounds_max')
+MIN_CAPACITY = 64
+# Rewrite the whole file once this share of its rows are removed nodes
+COMPACT_RATIO = 0.5
+
+
+def _column_bytes(capacity, dtype, shape):
+    return capacity * np.dtype(dtype).itemsize * int(np.prod(shape))
+
+
+def _layout(capacity):
+    """
+    Byte offset of each column, and the total file size.
+    """
+    offsets, offset = {}, HEADER.itemsize
+    for name, dtype, shape in COLUMNS:
+        offset = (offset + 7) & ~7
+        offsets[name] = offset
+        offset += _column_bytes(capacity, dtype, shape)
+    return offsets, offset
+
+
+def _create(path, capacity):
+    _, size = _layout(capacity)
+    data = np.memmap(path, dtype=np.uint8, mode='w+', shape=(size,))
+    header = data[:HEADER.itemsize].view(HEADER)
+    header['magic'], header['version'], header['capacity'] = MAGIC, VERSION, capacity
+    data.flush()
+    del data
+
+
+def scene_ids(scene, store=DEFAULT_STORE):
+    """
+    Store ids of every node of a scene, children included, with each
+    level of the hierarchy after the one above it.
+    """
+    level = scene.node_list.ids()
+    levels = [level]
+    alive = store.alive_ids()
+    parents = store.parents[alive]
+    while len(level):
+        level = alive[np.isin(parents, level)]
+        levels.append(level)
+    return np.concatenate(levels)
+
+
+class SceneFile(object):
+    """
+    A scene file mapped into memory, with the node store id each row was
+    saved from, so that a later save only rewrites the rows of nodes
+    added, removed or changed since.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.data = np.memmap(path, dtype=np.uint8, mode='r+')
+        self.header = self.data[:HEADER.itemsize].view(HEADER)
+        if self.header['magic'][0] != MAGIC or self.header['version'][0] != VERSION:
+            raise ValueError("%s is not a version %d scene file" % (path, VERSION))
+        self.capacity = int(self.header['capacity'][0])
+        offsets, _ = _layout(self.capacity)
+        self.columns = {}
+        for name, dtype, shape in COLUMNS:
+            start = offsets[name]
+            column = self.data[start:start + _column_bytes(self.capacity, dtype, shape)]
+            self.columns[name] = column.view(dtype).reshape((self.capacity,) + shape)
+        # -1 for rows of removed nodes, and rows not loaded or saved yet
+        self.ids = np.full(self.capacity, -1, dtype=np.int64)
+
+    @property
+    def count(self):
+        return int(self.header['count'][0])
+
+    @classmethod
+    def write(cls, scene, path, store=DEFAULT_STORE, mark_saved=True):
+        """
+        Write every node of the scene to a new file at path. Without
+        mark_saved, nodes stay dirty for the next save to the scene's own
+        file, as suits a copy made for some other use.
+        """
+        ids = scene_ids(scene, store)
+        n = len(ids)
+        capacity = max(MIN_CAPACITY, n + n // 2)
+        # A file mapped by an earlier SceneFile keeps its old contents
+        temporary = path + '.tmp'
+        _create(temporary, capacity)
+        scene_file = cls(temporary)
+        row_of = np.full(store.capacity, -1, dtype=np.int64)
+        row_of[ids] = np.arange(n)
+        scene_file._write_rows(store, ids, row_of)
+        scene_file.header['count'] = n
+        scene_file.data.flush()
+        del scene_file
+        os.replace(temporary, path)
+        if mark_saved:
+            store.flags[ids] &= ~DIRTY & 0xff
+
+        scene_file = cls(path)
+        scene_file.ids[:n] = ids
+        return scene_file
+
+    def _write_rows(self, store, ids, row_of):
+        rows = row_of[ids]
+        for name in STATE:
+            self.columns[name][rows] = getattr(store, name)[ids]
+        parents = store.parents[ids]
+        self.columns['parents'][rows] = np.where(parents >= 0, row_of[np.maximum(parents, 0)], -1)
+        self.columns['flags'][rows] = ALIVE
+        self.ids[rows] = ids
+
+    def save_changes(self, scene, store=DEFAULT_STORE):
+        """
+        Rewrite the rows of nodes changed since the last save, append added
+        nodes and mark removed ones. Returns False, writing nothing, when
+        the file is out of room or mostly removed nodes and needs a full
+        write instead.
+        """
+        count = self.count
+        ids = scene_ids(scene, store)
+        saved = self.ids[:count]
+        live = saved >= 0
+        row_of = np.full(store.capacity, -1, dtype=np.int64)
+        row_of[saved[live]] = np.flatnonzero(live)
+        rows = row_of[ids]
+        new = ids[rows < 0]
+        if count + len(new) > self.capacity:
+            return False
+        # Rows of nodes that left the scene, or whose ids were freed
+        present = np.zeros(count, dtype=bool)
+        present[rows[rows >= 0]] = True
+        gone = np.flatnonzero(live & ~present)
+        if len(gone) + np.count_nonzero(~live) > COMPACT_RATIO * (count + len(new)):
+            return False
+
+        row_of[new] = np.arange(count, count + len(new))
+        dirty = ids[(rows >= 0) & (store.flags[ids] & DIRTY != 0)]
+        changed = np.concatenate([dirty, new])
+        self._write_rows(store, changed, row_of)
+        self.columns['flags'][gone] = 0
+        self.ids[gone] = -1
+        self.header['count'] = count + len(new)
+        self.data.flush()
+        store.flags[changed] &= ~DIRTY & 0xff
+        return True
+
+
+def save(scene, path):
+    """
+    Save the scene to path. Saving again to the file the scene was loaded
+    from or last saved to only writes what changed since; anything else
+    writes the whole file.
+    """
+    scene_file = scene.scene_file
+    if (scene_file is None or os.path.abspath(scene_file.path) != os.path.abspath(path)
+            or not scene_file.save_changes(scene)):
+        scene.scene_file = SceneFile.write(scene, path)
+    return scene.scene_file
+
+
+def load(path, scene=None):
+    """
+    Add the nodes of a scene file to scene, or to a new Scene, and return
+    the scene. Node state is copied into the store in bulk; node handles,
+    and the display lists behind them, are only made for nodes that are
+    rendered, picked or otherwise used.
+    """
+    store = DEFAULT_STORE
+    scene = Scene() if scene is None else scene
+    scene_file = SceneFile(path)
+    columns = scene_file.columns
+    rows = np.flatnonzero(columns['flags'][:scene_file.count] & ALIVE)
+    ids = store.allocate(len(rows))
+    for name in STATE:
+        getattr(store, name)[ids] = columns[name][rows]
+    id_of = np.full(scene_file.count, -1, dtype=np.int64)
+    id_of[rows] = ids
+    parents = columns['parents'][rows]
+    store.parents[ids] = np.where(parents >= 0, id_of[parents], -1)
+    store.flags[ids] = ALIVE
+    scene_file.ids[rows] = ids
+
+    # Tiers are not saved; curved primitives start on their default one
+    set_default_lod_tiers(store, ids)
+
+    # Child lists, in row order, for when the parents' handles are made
+    children = ids[parents >= 0]
+    store.add_pending_children(store.parents[children], children)
+
+    scene.add_node_ids(ids[parents < 0])
+    scene.scene_file = scene_file
+    return scene
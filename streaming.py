@@ -0,0 +1,215 @@
+# Scene population generated in the background and added a slice per frame
+"""
+Builds large procedural scenes without blocking the main loop:
+
+    streamer = SceneStreamer(scene, 1000000)
+    streamer.start()
+    ...
+    streamer.step(0.008)    # once per frame, spends up to 8 ms
+
+Worker processes, or threads, generate node state in chunks: shape,
+translation, scale and color arrays, with nothing of GL or node handles
+in them. step() runs on the main thread. It adds finished chunks to the
+store and the scene a slice of rows at a time, like a loaded scene
+file, and compiles the display lists the new shapes draw with, until
+the time budget is spent. Content appears progressively, and the window
+keeps handling input between frames. progress() reports how far
+generation and integration are, and the backlog between them.
+"""
+import collections
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+from color import MIN_COLOR, MAX_COLOR
+from geometry import GEOMETRY_CACHE
+from node import HierarchicalNode, Primitive, set_default_lod_tiers
+from profiling import PROFILER
+
+
+def generate_chunk(job):
+    """
+    Node state for rows start to start + count of a streamed scene, the
+    same for a given seed whichever worker makes it.
+    """
+    seed, start, count, codes, extent, scales = job
+    rng = np.random.default_rng([seed, start])
+    return {
+        'types': np.asarray(codes, dtype=np.uint8)[rng.integers(0, len(codes), count)],
+        'translations': rng.uniform(-extent, extent, (count, 3)).astype(np.float32),
+        'scales': np.repeat(rng.uniform(scales[0], scales[1], (count, 1)), 3, axis=1).astype(np.float32),
+        'colors': rng.integers(MIN_COLOR, MAX_COLOR + 1, count).astype(np.int32),
+    }
+
+
+class SceneStreamer(object):
+    """
+    Adds count primitives of the given shapes, spread at random through a
+    cube around the origin, to a scene. The cube grows with count so the
+    density stays about the same.
+    """
+    CHUNK_SIZE = 65536
+    # Bounds on the rows added to the scene per slice of a frame's budget;
+    # in between, slices are sized to the time left at the measured row
+    # rate, and a slice that would not fit waits for the next step
+    MIN_SLICE_ROWS = 256
+    MAX_SLICE_ROWS = 16384
+    BUDGET = 0.008
+    SPACING = 2.0
+    SCALES = (0.5, 1.5)
+
+    def __init__(self, scene, count, shapes=('sphere', 'cube'), seed=0, extent=None,
+                 workers=None, threads=False, chunk_size=None):
+        classes = [scene.SHAPES[shape] for shape in shapes]
+        if any(issubclass(cls, HierarchicalNode) for cls in classes):
+            raise ValueError("Only primitives can be streamed, not %r" % (shapes,))
+        self.scene = scene
+        self.store = scene.pick_buffer.store
+        self.count = int(count)
+        self.classes = classes
+        self.seed = seed
+        self.extent = extent if extent is not None else 0.5 * self.SPACING * max(self.count, 1) ** (1.0 / 3.0)
+        self.chunk_size = chunk_size or self.CHUNK_SIZE
+        self.workers = workers
+        self.threads = threads
+        self.executor = None
+        self.in_flight = 0
+        # Jobs not handed out yet, futures in submission order, and
+        # finished chunks with the next row to add
+        self.jobs = collections.deque()
+        self.futures = collections.deque()
+        self.ready = collections.deque()
+        # Display lists still to compile, and the ones compiled, which the
+        # scene holds on to from close() until nodes draw with them
+        self.geometry = [(cls, key) for cls in classes for key in (cls.lod_keys or (cls.geometry_key,))]
+        self.acquired = []
+        self.generated = 0
+        self.integrated = 0
+        self.row_seconds = None
+        self.started = None
+        self.finished = None
+
+    @property
+    def done(self):
+        return self.integrated == self.count and not self.geometry
+
+    def start(self):
+        codes = [cls.type_code for cls in self.classes]
+        for start in range(0, self.count, self.chunk_size):
+            count = min(self.chunk_size, self.count - start)
+            self.jobs.append((self.seed, start, count, codes, self.extent, self.SCALES))
+        workers = self.workers or os.cpu_count() or 1
+        self.executor = (ThreadPoolExecutor if self.threads else ProcessPoolExecutor)(workers)
+        # Two chunks in flight per worker keep them busy without holding
+        # the whole scene in memory ahead of integration
+        self.in_flight = 2 * workers
+        self.scene.reserve(self.count)
+        self._submit()
+        self.started = time.perf_counter()
+
+    def _submit(self):
+        while self.jobs and len(self.futures) < self.in_flight:
+            self.futures.append(self.executor.submit(generate_chunk, self.jobs.popleft()))
+
+    def _collect(self):
+        # Chunks are added in order, so a seed always gives the same ids
+        while self.futures and self.futures[0].done():
+            chunk = self.futures.popleft().result()
+            self.generated += len(chunk['types'])
+            self.ready.append([chunk, 0])
+        self._submit()
+
+    def _slice_rows(self, seconds):
+        # Rows that fit in seconds; a first small slice measures the rate
+        if self.row_seconds is None:
+            return self.MIN_SLICE_ROWS
+        return min(int(seconds / self.row_seconds), self.MAX_SLICE_ROWS)
+
+    def _integrate(self, rows):
+        chunk, offset = self.ready[0]
+        end = min(offset + rows, len(chunk['types']))
+        began = time.perf_counter()
+        store = self.store
+        ids = store.allocate(end - offset)
+        for name in ('types', 'translations', 'scales', 'colors'):
+            getattr(store, name)[ids] = chunk[name][offset:end]
+        store.bounds_min[ids], store.bounds_max[ids] = Primitive.BOUNDS
+        set_default_lod_tiers(store, ids)
+        self.scene.add_node_ids(ids)
+        self.integrated += end - offset
+        # Rows cost more when they first touch fresh memory, so the rate
+        # follows slow slices at once and fast ones only gradually
+        seconds = (time.perf_counter() - began) / (end - offset)
+        self.row_seconds = seconds if self.row_seconds is None else max(seconds, 0.8 * self.row_seconds)
+        if end == len(chunk['types']):
+            self.ready.popleft()
+        else:
+            self.ready[0][1] = end
+        return end - offset
+
+    def _compile(self):
+        cls, key = self.geometry.pop()
+        GEOMETRY_CACHE.acquire(key, lambda: cls.create_display_list(key))
+        self.acquired.append(key)
+
+    def step(self, budget=None):
+        """
+        Integrate finished rows, then compile display lists, for up to
+        budget seconds. Each slice is sized before it is added, from the
+        measured cost per row, to fit the time left. At least one slice
+        of MIN_SLICE_ROWS is added, so streaming progresses under any
+        budget. Returns True once everything is in the scene.
+        """
+        if self.executor is None:
+            self.start()
+        deadline = time.perf_counter() + (self.BUDGET if budget is None else budget)
+        added = 0
+        with PROFILER.stage('stream'):
+            self._collect()
+            while self.ready:
+                rows = self._slice_rows(deadline - time.perf_counter())
+                if rows < self.MIN_SLICE_ROWS:
+                    if added:
+                        break
+                    rows = self.MIN_SLICE_ROWS
+                added += self._integrate(rows)
+            while self.geometry and (time.perf_counter() < deadline or not added):
+                self._compile()
+                if not added:
+                    break
+        if PROFILER.enabled:
+            PROFILER.count('streamed', added)
+        if self.done and self.finished is None:
+            self.finished = time.perf_counter()
+            self.executor.shutdown(wait=False)
+        return self.done
+
+    def progress(self):
+        elapsed = ((self.finished or time.perf_counter()) - self.started) if self.started else 0.0
+        return {
+            'total': self.count,
+            'generated': self.generated,
+            'integrated': self.integrated,
+            # Generated rows waiting for the main thread
+            'backlog': self.generated - self.integrated,
+            'chunks_in_flight': len(self.futures),
+            'geometry_pending': len(self.geometry),
+            'elapsed_s': elapsed,
+            'rows_per_s': self.integrated / elapsed if elapsed else 0.0,
+            'done': self.done,
+        }
+
+    def close(self):
+        """
+        Stop generating, and hand the compiled display lists to the scene,
+        which keeps them until its nodes hold them; released here, unused
+        lists would be deleted before the new nodes first draw.
+        """
+        if self.executor is not None:
+            for future in self.futures:
+                future.cancel()
+            self.executor.shutdown(wait=False)
+        self.jobs.clear()
+        self.futures.clear()
+        self.scene.hold_geometry(self.acquired)
+        self.acquired = []
@@ -0,0 +1,25 @@
+# Runs the suite against the recording GL stub, without a display
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import glstub
+glstub.install()
+
+import numpy as np
+import pytest
+from camera import Camera
+from trackball import Trackball
+
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(1234)
+
+
+@pytest.fixture
+def camera():
+    camera = Camera()
+    camera.update(640, 480, Trackball())
+    return camera
@@ -0,0 +1,20 @@
+# The benchmark's scenes keep overlaps in proportion to their size
+import gc
+import benchmark
+from scene import Scene
+
+
+def test_overlaps_grow_linearly():
+    small = benchmark.bench_size(200, samples=5, frames=1, seed=0)
+    large = benchmark.bench_size(2000, samples=5, frames=1, seed=0)
+    assert large['overlap_pairs']['pairs'] < 2 * large['nodes']
+    assert large['overlap_pairs']['pairs'] < 20 * max(small['overlap_pairs']['pairs'], 1)
+
+
+def test_sizes_leave_the_store_as_they_found_it():
+    gc.collect()
+    store = Scene().pick_buffer.store
+    before = len(store)
+    benchmark.bench_size(100, samples=5, frames=1, seed=0)
+    gc.collect()
+    assert len(store) == before
@@ -0,0 +1,97 @@
+# Broad-phase collision checks against brute force over every pair
+import numpy as np
+from collision import HashGrid, boxes_overlap
+from scene import Scene
+
+
+def brute_force_pairs(scene):
+    buffer = scene.pick_buffer
+    n = len(buffer)
+    ids = buffer.ids[:n]
+    pairs = set()
+    for a in range(n):
+        overlap = boxes_overlap(buffer.world_min[a], buffer.world_max[a], buffer.world_min[:n], buffer.world_max[:n])
+        for b in np.flatnonzero(overlap).tolist():
+            if b != a:
+                pairs.add((min(ids[a], ids[b]), max(ids[a], ids[b])))
+    return pairs
+
+
+def random_scene(rng, n, spread=6.0):
+    scene = Scene()
+    positions = rng.uniform(-spread, spread, (n, 3))
+    scene.place_many('cube', positions, scales=rng.uniform(0.3, 1.5, n))
+    return scene
+
+
+def pair_set(pairs):
+    return set(map(tuple, np.asarray(pairs).tolist()))
+
+
+def test_all_pairs_matches_brute_force(rng):
+    scene = random_scene(rng, 300)
+    pairs = scene.overlapping_pairs()
+    assert len(pair_set(pairs)) == len(pairs)
+    assert pair_set(pairs) == brute_force_pairs(scene)
+
+
+def test_all_pairs_in_small_batches(rng, monkeypatch):
+    scene = random_scene(rng, 200, spread=3.0)
+    monkeypatch.setattr(HashGrid, 'PAIR_BATCH', 7)
+    pairs = scene.overlapping_pairs()
+    assert len(pair_set(pairs)) == len(pairs)
+    assert pair_set(pairs) == brute_force_pairs(scene)
+
+
+def test_all_pairs_with_oversized_nodes(rng):
+    scene = random_scene(rng, 200)
+    scene.place_many('cube', [(0, 0, 0), (2, 0, 0)], scales=[30.0, 25.0])
+    pairs = scene.overlapping_pairs()
+    assert len(pair_set(pairs)) == len(pairs)
+    assert pair_set(pairs) == brute_force_pairs(scene)
+
+
+def test_contacts_match_brute_force(rng):
+    scene = random_scene(rng, 200)
+    expected = brute_force_pairs(scene)
+    ids = scene.pick_buffer.ids[:20].tolist()
+    found = set((min(a, b), max(a, b)) for a, b in scene.collisions.contacts(ids))
+    moving = set(ids)
+    assert found == set(pair for pair in expected if (pair[0] in moving) != (pair[1] in moving))
+
+
+def contact_pairs(scene):
+    pairs = set()
+    for node_id in scene.pick_buffer.ids[:len(scene.pick_buffer)].tolist():
+        pairs.update((min(a, b), max(a, b)) for a, b in scene.collisions.contacts([node_id]))
+    return pairs
+
+
+def test_contacts_follow_updates(rng):
+    scene = random_scene(rng, 200)
+    grid = scene.collisions
+    assert contact_pairs(scene) == brute_force_pairs(scene)
+    # Small changes are refiled one by one into the built grid
+    nodes = list(scene.node_list)
+    for node in nodes[:10]:
+        node.translate(*rng.uniform(-2, 2, 3))
+    scene.remove_node(nodes[10])
+    scene.place_many('cube', rng.uniform(-6, 6, (10, 3)), scales=[40.0] + [1.0] * 9)
+    assert grid.built and grid.node_cells
+    assert contact_pairs(scene) == brute_force_pairs(scene)
+    # A large batch drops the grid for a rebuild
+    scene.place_many('cube', rng.uniform(-6, 6, (100, 3)))
+    assert not grid.built
+    assert contact_pairs(scene) == brute_force_pairs(scene)
+
+
+def test_neighbors_only_keep_overlapping_oversized_nodes(rng):
+    scene = random_scene(rng, 100)
+    near, far = scene.place_many('cube', [(0, 0, 0), (200, 0, 0)], scales=[30.0, 30.0]).tolist()
+    grid = scene.collisions
+    grid.build()
+    found = grid.neighbors(np.array([-1.0, -1.0, -1.0]), np.array([1.0, 1.0, 1.0]))
+    assert near in found and far not in found
+    # An oversized box is tested against every node
+    found = grid.neighbors(np.array([-100.0, -100.0, -100.0]), np.array([100.0, 100.0, 100.0]))
+    assert found == set(scene.pick_buffer.ids[:len(scene.pick_buffer)].tolist()) - {far}
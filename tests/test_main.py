@@ -0,0 +1,52 @@
+# Command line options of main.py
+import csv
+import json
+import os
+import pytest
+import main
+from profiling import PROFILER
+from viewer import Viewer
+
+
+@pytest.fixture
+def profiler():
+    yield PROFILER
+    PROFILER.enable(False)
+    PROFILER.dump_path = None
+    PROFILER.reset()
+
+
+def run_frames(args, count):
+    main.configure_profiler(args)
+    viewer = Viewer(args.scene)
+    for _ in range(count):
+        viewer.force_redraw = True
+        viewer.render()
+
+
+def test_profile_dump_json(profiler, tmp_path):
+    path = str(tmp_path / 'profile.json')
+    args = main.parse_args([str(tmp_path / 'scene.3drs'), '--profile-dump', path, '--profile-interval', '0'])
+    run_frames(args, 3)
+    with open(path) as f:
+        summary = json.load(f)
+    assert summary['frames'] >= 3
+    assert 'scene' in summary['stages_ms']
+
+
+def test_profile_dump_csv(profiler, tmp_path):
+    path = str(tmp_path / 'profile.csv')
+    args = main.parse_args([str(tmp_path / 'scene.3drs'), '--profile-dump', path,
+                            '--profile-format', 'csv', '--profile-interval', '0'])
+    run_frames(args, 3)
+    with open(path) as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == ['time', 'metric', 'value']
+    assert sum(row[1] == 'frame_ms' for row in rows[1:]) == 3
+
+
+def test_no_profile_dump_leaves_profiler_off(profiler, tmp_path):
+    args = main.parse_args([str(tmp_path / 'scene.3drs')])
+    run_frames(args, 1)
+    assert not PROFILER.enabled
+    assert os.listdir(str(tmp_path)) == []
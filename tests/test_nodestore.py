@@ -0,0 +1,34 @@
+# Pending child lists of rows that have no handle yet
+import numpy as np
+from nodestore import NodeStore
+
+
+def test_pending_children_keep_their_order():
+    store = NodeStore()
+    ids = store.allocate(6)
+    store.add_pending_children(ids[[3, 0, 3, 0]], ids[[5, 1, 4, 2]])
+    assert store.take_pending_children(ids[0]) == ids[[1, 2]].tolist()
+    assert store.take_pending_children(ids[3]) == ids[[5, 4]].tolist()
+    assert store.take_pending_children(ids[3]) == []
+
+
+def test_pending_children_survive_compaction(monkeypatch):
+    monkeypatch.setattr(NodeStore, 'PENDING_SLACK', 8)
+    store = NodeStore()
+    parents = store.allocate(50)
+    children = store.allocate(100)
+    expected = {}
+    for i, parent in enumerate(parents.tolist()):
+        pair = children[2 * i:2 * i + 2]
+        store.add_pending_children([parent, parent], pair)
+        expected[parent] = pair.tolist()
+        if i % 2:
+            # Taken and freed rows leave garbage in the pool
+            store.take_pending_children(parents[i - 1])
+            del expected[int(parents[i - 1])]
+    store.free(int(parents[-1]))
+    del expected[int(parents[-1])]
+    assert store.pending_size < 2 * 50
+    for parent, pair in expected.items():
+        assert store.take_pending_children(parent) == pair
+    assert not np.any(store.pending_counts)
@@ -0,0 +1,109 @@
+# Scene.pick against a brute-force test of every node
+import numpy as np
+from scene import Scene
+
+
+def brute_force_pick(scene, start, direction, mat):
+    """
+    Closest (node, distance) by testing each node on its own: boxes with
+    the AABB slab test, spheres analytically in world space.
+    """
+    inverse = np.linalg.inv(mat)
+    origin = inverse.dot(np.append(start, 1.0))[:3]
+    ray = inverse.dot(np.append(direction, 0.0))[:3]
+    best, best_node = float('inf'), None
+    for node in scene.node_list:
+        if node.type_code == 3:
+            center = node.world_matrix[:3, 3]
+            radius = 0.5 * node.world_matrix[0, 0]
+            offset = origin - center
+            a, b, c = ray.dot(ray), offset.dot(ray), offset.dot(offset) - radius * radius
+            if b * b - a * c < 0 or (-b + np.sqrt(b * b - a * c)) / a < 0:
+                continue
+            distance = (-b - np.sqrt(b * b - a * c)) / a
+        else:
+            hit, distance = node.pick(start, direction, mat)
+            if not hit:
+                continue
+        if distance < best:
+            best, best_node = distance, node
+    return best_node, best
+
+
+def random_scene(rng, n, shapes=('cube', 'sphere')):
+    scene = Scene()
+    scene.place_many([shapes[i % len(shapes)] for i in range(n)], rng.uniform(-6, 6, (n, 3)),
+                     rng.uniform(0.3, 1.5, n))
+    return scene
+
+
+def rays(camera, rng, count):
+    return [camera.get_ray(x, y) for x, y in zip(rng.uniform(0, 640, count), rng.uniform(0, 480, count))]
+
+
+def test_pick_matches_brute_force(rng, camera):
+    scene = random_scene(rng, 300)
+    for start, direction in rays(camera, rng, 200):
+        node, distance = scene.pick(start, direction, camera.model_view)
+        expected, expected_distance = brute_force_pick(scene, start, direction, camera.model_view)
+        assert node is expected
+        if node is not None:
+            assert np.isclose(distance, expected_distance)
+
+
+def test_pick_after_moves(rng, camera):
+    scene = random_scene(rng, 200)
+    start, direction = camera.get_ray(320, 240)
+    scene.pick(start, direction, camera.model_view)
+    for node in scene.node_list[::3]:
+        node.translate(*rng.uniform(-2, 2, 3))
+    for start, direction in rays(camera, rng, 100):
+        node, _ = scene.pick(start, direction, camera.model_view)
+        assert node is brute_force_pick(scene, start, direction, camera.model_view)[0]
+
+
+def test_query_many_matches_query(rng, camera):
+    scene = random_scene(rng, 300, ('cube', 'sphere', 'figure'))
+    samples = rays(camera, rng, 150)
+    starts, directions = np.array([s for s, _ in samples]), np.array([d for _, d in samples])
+    hits = scene.pick_buffer.query_many(starts, directions, camera.model_view)
+    for (start, direction), hit in zip(samples, hits):
+        single = scene.pick_buffer.query(start, direction, camera.model_view)
+        assert (hit is None) == (single is None)
+        if hit is not None:
+            assert hit.leaf is single.leaf
+            assert np.isclose(hit.distance, single.distance)
+
+
+def test_empty_scene_picks_nothing(camera):
+    start, direction = camera.get_ray(320, 240)
+    assert Scene().pick(start, direction, camera.model_view) == (None, float('inf'))
+
+
+def test_pick_rows_follow_removed_nodes(rng):
+    scene = Scene()
+    nodes = [scene.node_for_id(i) for i in scene.place_many('cube', rng.uniform(-5, 5, (50, 3))).tolist()]
+    for node in nodes[::3]:
+        scene.remove_node(node)
+    buffer = scene.pick_buffer
+    assert len(buffer) == len(nodes) - len(nodes[::3])
+    for row, node_id in enumerate(buffer.ids[:len(buffer)].tolist()):
+        assert buffer.row(node_id) == row
+    assert all(buffer.row(node.id) is None for node in nodes[::3])
+
+
+def test_remove_selected_in_bulk(rng, monkeypatch):
+    scene = Scene()
+    nodes = [scene.node_for_id(i) for i in scene.place_many('cube', rng.uniform(-5, 5, (60, 3))).tolist()]
+    scene.overlapping_pairs()
+    updates = []
+    update = scene.collisions.update
+    monkeypatch.setattr(scene.collisions, 'update', lambda ids: updates.append(len(ids)) or update(ids))
+    scene.set_selection(nodes[::2])
+    scene.remove_selected()
+    kept = nodes[1::2]
+    assert updates == [len(nodes[::2])]
+    assert scene.selection == [] and list(scene.node_list) == kept
+    buffer = scene.pick_buffer
+    assert buffer.ids[:len(buffer)].tolist() == [node.id for node in kept]
+    assert all(buffer.row(node.id) is None for node in nodes[::2])
@@ -0,0 +1,41 @@
+# Profiler counters against the GL calls the stub records
+import pytest
+from glstub import RECORDER
+from node import HierarchicalNode
+from profiling import PROFILER
+from scene import Scene
+
+COUNTED = ('glCallList', 'glDrawArrays', 'glDrawArraysInstanced', 'glPushMatrix', 'glPopMatrix')
+
+
+@pytest.fixture
+def profiler():
+    PROFILER.enable()
+    yield PROFILER
+    PROFILER.enable(False)
+
+
+def draw_calls(scene, camera, profiler):
+    RECORDER.reset()
+    profiler.reset()
+    scene.render(camera.projection, camera.model_view, camera.height)
+    return profiler.current['counters'].get('draw_calls', 0), sum(RECORDER.calls[name] for name in COUNTED)
+
+
+@pytest.mark.parametrize('mode', Scene.RENDER_MODES)
+def test_draw_calls_match_gl_calls(camera, profiler, rng, mode):
+    scene = Scene()
+    scene.place_many(['cube', 'sphere', 'figure'] * 10, rng.uniform(-4, 4, (30, 3)))
+    scene.set_render_mode(mode)
+    # The first frame bakes and compiles display lists
+    draw_calls(scene, camera, profiler)
+    counted, issued = draw_calls(scene, camera, profiler)
+    assert counted == issued > 0
+
+
+def test_draw_calls_of_unbaked_figures(camera, profiler, rng, monkeypatch):
+    monkeypatch.setattr(HierarchicalNode, 'BAKED', False)
+    scene = Scene()
+    scene.place_many('figure', rng.uniform(-4, 4, (10, 3)))
+    counted, issued = draw_calls(scene, camera, profiler)
+    assert counted == issued > 0
@@ -0,0 +1,137 @@
+# Software rendering against analytic shading and Scene.pick
+import struct
+import zlib
+import numpy as np
+import offscreen
+from camera import Camera
+from color import COLORS
+from rasterizer import SoftwareRenderer, AMBIENT, CLEAR_COLOR
+from scene import Scene
+from trackball import Trackball
+
+WIDTH, HEIGHT = 160, 120
+
+
+def view(degrees=0.0):
+    trackball = Trackball()
+    if degrees:
+        trackball.rotate((0, 1, 0), degrees)
+    camera = Camera()
+    camera.update(WIDTH, HEIGHT, trackball)
+    return camera
+
+
+def shade(color_index, n_dot_l):
+    # Lambert term of the renderer's light, as the uint8 it writes
+    return np.round(np.clip(np.array(COLORS[color_index]) * (AMBIENT + n_dot_l), 0.0, 1.0) * 255.0)
+
+
+def covered(image):
+    return (image != np.round(np.array(CLEAR_COLOR) * 255.0)).any(axis=2)
+
+
+def window_square(camera, corners):
+    # Window space bounds of points given in world space
+    clip = np.hstack([corners, np.ones((len(corners), 1))]).dot(np.dot(camera.projection, camera.model_view).T)
+    ndc = clip[:, :2] / clip[:, 3:]
+    x, y = (ndc[:, 0] + 1.0) * 0.5 * WIDTH, (ndc[:, 1] + 1.0) * 0.5 * HEIGHT
+    return x.max() - x.min(), y.max() - y.min()
+
+
+def test_cube_face_on():
+    scene = Scene()
+    scene.place_many('cube', [(0.0, 0.0, 0.0)], scales=[2.0], colors=[0])
+    camera = view()
+    image, _ = SoftwareRenderer(WIDTH, HEIGHT).render(scene, camera.projection, camera.model_view)
+    # Only the front face shows, facing the light
+    colors = set(map(tuple, image[covered(image)].tolist()))
+    assert colors == {tuple(shade(0, 1.0))}
+    front = np.array([(x, y, 1.0) for x in (-1.0, 1.0) for y in (-1.0, 1.0)])
+    width, height = window_square(camera, front)
+    assert abs(covered(image).sum() - width * height) <= width + height
+    scene.clear()
+
+
+def test_cube_turned_shows_two_lit_faces():
+    scene = Scene()
+    scene.place_many('cube', [(0.0, 0.0, 0.0)], scales=[2.0], colors=[3])
+    camera = view(30.0)
+    image, _ = SoftwareRenderer(WIDTH, HEIGHT).render(scene, camera.projection, camera.model_view)
+    colors = set(map(tuple, image[covered(image)].tolist()))
+    angle = np.radians(30.0)
+    assert colors == {tuple(shade(3, np.cos(angle))), tuple(shade(3, np.sin(angle)))}
+    scene.clear()
+
+
+def test_sphere_coverage_and_center():
+    scene = Scene()
+    scene.place_many('sphere', [(0.0, 0.0, 0.0)], scales=[10.0], colors=[1])
+    camera = view()
+    image, _ = SoftwareRenderer(WIDTH, HEIGHT).render(scene, camera.projection, camera.model_view)
+    # Facets near the middle face the light almost head on
+    assert np.abs(image[HEIGHT // 2, WIDTH // 2] - shade(1, 1.0)).max() <= 8
+    # A sphere of radius 5 seen from 15 away covers the circle its
+    # tangent cone cuts through the plane of its center
+    radius = 5.0 * 15.0 / np.sqrt(15.0 ** 2 - 5.0 ** 2)
+    width, _ = window_square(camera, np.array([(-radius, 0.0, 0.0), (radius, 0.0, 0.0)]))
+    assert abs(covered(image).sum() / (np.pi * (width / 2.0) ** 2) - 1.0) < 0.05
+    scene.clear()
+
+
+def test_depth_matches_pick(rng):
+    scene = Scene()
+    scene.place_many(['cube', 'sphere', 'figure'] * 10, rng.uniform(-4, 4, (30, 3)), scales=rng.uniform(0.5, 1.5, 30))
+    camera = view(20.0)
+    image, depth = SoftwareRenderer(WIDTH, HEIGHT).render(scene, camera.projection, camera.model_view)
+    # Pixels away from silhouettes, where the pixel center sees the same
+    # surface as the rasterized triangle: no depth step to any neighbor
+    inside = covered(image)
+    for shift in ((0, 1), (0, -1), (1, 0), (-1, 0)):
+        inside &= np.abs(np.roll(depth, shift, axis=(0, 1)) - depth) < 1e-3
+    rows, columns = np.nonzero(inside)
+    for i in rng.choice(len(rows), 100, replace=False).tolist():
+        row, column = rows[i], columns[i]
+        x, y = column + 0.5, HEIGHT - row - 0.5
+        start, direction = camera.get_ray(x, y)
+        node, distance = scene.pick(start, direction, camera.model_view)
+        assert node is not None
+        # The buffer depth back in eye space, along the same ray
+        rendered = np.linalg.norm(camera.unproject(x, y, depth[row, column]) - start)
+        leaf = scene.last_hit.leaf
+        if leaf.type_code == 3:
+            # Sphere facets lie inside the sphere, at coarse tiers by up
+            # to a fifth of the radius along a slanted ray
+            radius = 0.5 * leaf.world_matrix[0, 0]
+            assert distance - 1e-3 < rendered < distance + 0.25 * radius
+        else:
+            assert abs(rendered - distance) < 1e-3
+    scene.clear()
+
+
+def read_png(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    assert data[:8] == b'\x89PNG\r\n\x1a\n'
+    chunks, offset = {}, 8
+    while offset < len(data):
+        length, = struct.unpack('>I', data[offset:offset + 4])
+        chunks[data[offset + 4:offset + 8]] = data[offset + 8:offset + 8 + length]
+        offset += 12 + length
+    width, height = struct.unpack('>II', chunks[b'IHDR'][:8])
+    raw = np.frombuffer(zlib.decompress(chunks[b'IDAT']), dtype=np.uint8).reshape(height, -1)
+    return raw[:, 1:].reshape(height, width, 3)
+
+
+def test_offscreen_batch_writes_pngs(rng, tmp_path):
+    scene = Scene()
+    scene.place_many(['cube', 'sphere', 'figure'], rng.uniform(-2, 2, (3, 3)))
+    views = offscreen.orbit_views(2, 64, 48)
+    paths = [str(tmp_path / ('view%d.png' % i)) for i in range(len(views))]
+    results = offscreen.render_batch(scene, views, paths, 64, 48, processes=2)
+    assert [path for path, _ in results] == paths
+    renderer = SoftwareRenderer(64, 48)
+    for path, (projection, model_view) in zip(paths, views):
+        expected, _ = renderer.render(scene, projection, model_view)
+        assert np.array_equal(read_png(path), expected)
+        assert covered(expected).any()
+    scene.clear()
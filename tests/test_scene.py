@@ -0,0 +1,128 @@
+# Scene state that must survive mode switches and other edits
+import gc
+import numpy as np
+import instancing
+import scenefile
+from geometry import mesh_for_key
+from node import Cube, Sphere, SnowFigure
+from scene import Scene
+from streaming import SceneStreamer
+
+
+def picked_scene(camera):
+    scene = Scene()
+    scene.place_many(['cube'], [(0.0, 0.0, 0.0)])
+    start, direction = camera.get_ray(320, 240)
+    node, _ = scene.pick(start, direction, camera.model_view)
+    assert node is not None
+    return scene, node
+
+
+def test_render_mode_switch_keeps_drag(camera):
+    scene, node = picked_scene(camera)
+    scene.set_render_mode('instanced')
+    start, direction = camera.get_ray(330, 240)
+    scene.move_selected(start, direction, camera.inverse_model_view)
+    assert node.store.translations[node.id][0] > 0
+
+
+def test_render_mode_switch_bumps_version():
+    scene = Scene()
+    scene.place_many(['cube', 'sphere'], np.zeros((2, 3)))
+    before = scene.version
+    scene.set_render_mode('instanced')
+    assert scene.version > before
+    middle = scene.version
+    scene.set_render_mode('immediate')
+    assert scene.version > middle
+
+
+def test_render_mode_switch_keeps_lod_settings():
+    scene = Scene()
+    scene.set_lod_thresholds((4, 16, 64), hysteresis=0.2)
+    scene.set_render_mode('instanced')
+    scene.set_render_mode('immediate')
+    assert scene.lod.thresholds.tolist() == [4, 16, 64]
+    assert scene.lod.hysteresis == 0.2
+
+
+def test_instanced_mode_culls_like_immediate(camera, rng, monkeypatch):
+    drawn = []
+    monkeypatch.setattr(instancing, 'glDrawArraysInstanced', lambda mode, first, count, instances: drawn.append(instances))
+    scene = Scene()
+    # Spread around the camera, so many nodes are behind or beside it
+    scene.place_many(['cube', 'sphere', 'figure'] * 40, rng.uniform(-30, 30, (120, 3)))
+    scene.render(camera.projection, camera.model_view, camera.height)
+    expected = dict(scene.cull_stats)
+    leaves = sum(len(node.leaves()) for node in scene.visible_nodes(camera.projection.dot(camera.model_view)))
+    assert 0 < expected['visible'] < len(scene.node_list)
+    scene.set_render_mode('instanced')
+    scene.render(camera.projection, camera.model_view, camera.height)
+    assert scene.cull_stats == expected
+    assert sum(drawn) == leaves
+
+
+def test_instanced_mode_draws_lod_tiers(camera, monkeypatch):
+    drawn = []
+    monkeypatch.setattr(instancing, 'glDrawArraysInstanced', lambda mode, first, count, instances: drawn.append((count, instances)))
+    scene = Scene()
+    # One sphere filling much of the view, two far off in the distance
+    scene.place_many('sphere', [(0.0, 0.0, 0.0), (0.0, 0.0, -500.0), (1.0, 0.0, -500.0)], scales=[8.0, 1.0, 1.0])
+    scene.set_render_mode('instanced')
+    scene.render(camera.projection, camera.model_view, camera.height)
+    near, far = [scene.node_for_id(i) for i in scene.node_list.ids()[:2].tolist()]
+    assert near.lod_tier > far.lod_tier
+    assert sorted(drawn) == sorted([(len(mesh_for_key(near.current_geometry_key)), 1),
+                                    (len(mesh_for_key(far.current_geometry_key)), 2)])
+    assert scene.lod.stats()['nodes'][far.lod_tier] == 2
+
+
+def test_place_many_matches_constructed_nodes():
+    scene = Scene()
+    ids = scene.place_many(['figure', 'sphere', 'cube'], [(1, 2, 3), (4, 5, 6), (7, 8, 9)], scales=[2.0, 1.0, 0.5])
+    assert not any(i in scene.pick_buffer.store.handles for i in ids.tolist())
+    for node_id, cls in zip(ids.tolist(), (SnowFigure, Sphere, Cube)):
+        placed = scene.node_for_id(node_id)
+        built = cls()
+        assert type(placed) is cls
+        assert np.allclose(placed.aabb.min_corner, built.aabb.min_corner)
+        assert np.allclose(placed.aabb.max_corner, built.aabb.max_corner)
+        placed_leaves, built_leaves = placed.leaves(), built.leaves()
+        assert len(placed_leaves) == len(built_leaves)
+        for a, b in zip(placed_leaves, built_leaves):
+            assert a.lod_tier == b.lod_tier
+            if a is not placed:
+                assert np.allclose(a.local_matrix, b.local_matrix)
+                assert a.color_index == b.color_index
+    assert np.allclose(scene.node_for_id(ids[0]).world_matrix[:3, 3], (1, 2, 3))
+    assert np.allclose(scene.node_for_id(ids[0]).world_matrix[0, 0], 2.0)
+
+
+def test_clear_gives_every_row_back(camera, rng, tmp_path):
+    # Handles of earlier tests' scenes free their rows when collected
+    gc.collect()
+    store = Scene().pick_buffer.store
+    before = len(store)
+    scene = Scene()
+    scene.place_many(['cube', 'sphere', 'figure'] * 20, rng.uniform(-4, 4, (60, 3)))
+    path = str(tmp_path / 'clear.3drs')
+    scenefile.save(scene, path)
+    scenefile.load(path, scene)
+    streamer = SceneStreamer(scene, 300, threads=True, workers=1)
+    while not streamer.step(1.0):
+        pass
+    streamer.close()
+    scene.render(camera.projection, camera.model_view, camera.height)
+    scene.set_selection([scene.node_list[0]])
+    assert len(store) > before + 400
+    scene.clear()
+    gc.collect()
+    assert len(store) == before
+    assert len(scene.node_list) == 0 and not scene.held_geometry
+    start, direction = camera.get_ray(320, 240)
+    assert scene.pick(start, direction, camera.model_view) == (None, float('inf'))
+    # Freed rows are reused, and the scene works as before
+    scene.place_many('cube', [(0.0, 0.0, 0.0)])
+    assert scene.pick(start, direction, camera.model_view)[0] is not None
+    assert len(store) == before + 1
+    scene.clear()
@@ -0,0 +1,83 @@
+# Scene files round trip: what is loaded draws the same as what was saved
+import time
+import numpy as np
+import scenefile
+from nodestore import DEFAULT_STORE
+from scene import Scene
+
+
+def snapshot(scene):
+    """
+    Per top-level node, its type and color, and the world matrix, color
+    and type of each primitive it draws. Files keep children in id order,
+    not necessarily the order they were added in, so leaves are sorted.
+    """
+    result = []
+    for node in scene.node_list:
+        leaves = sorted((type(leaf).__name__, leaf.color_index, np.round(leaf.world_matrix, 5).tolist())
+                        for leaf in node.leaves())
+        result.append((type(node).__name__, node.color_index, leaves))
+    return result
+
+
+def random_scene(rng, n=30):
+    scene = Scene()
+    scene.place_many(['cube', 'sphere', 'figure'] * (n // 3), rng.uniform(-5, 5, (n, 3)),
+                     scales=rng.uniform(0.5, 2.0, n))
+    return scene
+
+
+def test_round_trip(rng, tmp_path):
+    path = str(tmp_path / 'scene.3drs')
+    scene = random_scene(rng)
+    scenefile.save(scene, path)
+    assert snapshot(scenefile.load(path)) == snapshot(scene)
+    scene.clear()
+
+
+def test_incremental_save(rng, tmp_path):
+    path = str(tmp_path / 'scene.3drs')
+    scene = random_scene(rng)
+    first = scenefile.save(scene, path)
+    nodes = list(scene.node_list)
+    nodes[0].translate(1.0, 2.0, 3.0)
+    nodes[1].scale(True)
+    nodes[2].rotate_color(True)
+    scene.remove_node(nodes[3])
+    scene.place_many('figure', [(0.5, 0.5, 0.5)])
+    # Written in place, not as a new file
+    assert scenefile.save(scene, path) is first
+    assert snapshot(scenefile.load(path)) == snapshot(scene)
+    scene.clear()
+
+
+def test_mostly_removed_scene_is_rewritten(rng, tmp_path):
+    path = str(tmp_path / 'scene.3drs')
+    scene = random_scene(rng)
+    first = scenefile.save(scene, path)
+    for node in list(scene.node_list)[:25]:
+        scene.remove_node(node)
+    assert scenefile.save(scene, path) is not first
+    loaded = scenefile.load(path)
+    assert len(loaded.node_list) == 5
+    assert snapshot(loaded) == snapshot(scene)
+    scene.clear()
+
+
+def test_large_file_loads_in_bulk(rng, tmp_path):
+    path = str(tmp_path / 'scene.3drs')
+    n = 210000
+    scene = random_scene(rng, n)
+    scenefile.save(scene, path)
+    scene.clear()
+    handles = len(DEFAULT_STORE.handles)
+    began = time.perf_counter()
+    loaded = scenefile.load(path)
+    seconds = time.perf_counter() - began
+    # No handles are made, and no step of the load runs once per node in
+    # Python: one that did would take a few seconds at this size
+    assert len(DEFAULT_STORE.handles) == handles
+    assert seconds < 1.0
+    assert len(loaded.node_list) == n
+    assert len(loaded.node_list[n - 1].leaves()) == 3
+    loaded.clear()
@@ -0,0 +1,44 @@
+# Streaming generated nodes into a scene a slice at a time
+from geometry import GEOMETRY_CACHE
+from scene import Scene
+from streaming import SceneStreamer
+
+
+def stream(count, **options):
+    scene = Scene()
+    streamer = SceneStreamer(scene, count, threads=True, workers=2, **options)
+    while not streamer.step(0.01):
+        pass
+    streamer.close()
+    return scene, streamer
+
+
+def test_closed_streamer_keeps_display_lists(camera):
+    scene, streamer = stream(2000, chunk_size=500)
+    keys = [key for cls in streamer.classes for key in (cls.lod_keys or (cls.geometry_key,))]
+    assert all(key in GEOMETRY_CACHE.entries for key in keys)
+    misses = GEOMETRY_CACHE.misses
+    scene.render(camera.projection, camera.model_view, camera.height)
+    assert GEOMETRY_CACHE.misses == misses
+    # Lists the nodes drew with are theirs now, the rest are still held
+    drawn = set(key for key in keys if not scene.held_geometry[key])
+    assert drawn
+    for key in keys:
+        if key not in drawn:
+            assert GEOMETRY_CACHE.refcounts[key] == scene.held_geometry[key]
+    scene.release_geometry(everything=True)
+    assert not scene.held_geometry
+
+
+def test_step_adds_one_slice_when_out_of_budget():
+    scene = Scene()
+    streamer = SceneStreamer(scene, 5000, threads=True, workers=1, chunk_size=5000)
+    streamer.start()
+    while not streamer.ready:
+        streamer._collect()
+    streamer.step(1.0)
+    integrated = streamer.integrated
+    streamer.step(0.0)
+    assert streamer.integrated - integrated == min(SceneStreamer.MIN_SLICE_ROWS, 5000 - integrated)
+    streamer.close()
+
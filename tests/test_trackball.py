@@ -0,0 +1,68 @@
+# Trackball math against plain matrix algebra
+import math
+import numpy as np
+from trackball import Trackball, axis_angle, slerp
+
+
+def rotation_matrix(q):
+    # Reference: rotate each basis vector with the quaternion sandwich q v q*
+    w, x, y, z = q
+    columns = []
+    for v in np.identity(3):
+        u = np.array([x, y, z])
+        t = 2.0 * np.cross(u, v)
+        columns.append(v + w * t + np.cross(u, t))
+    return np.array(columns).T
+
+
+def angle_between(a, b):
+    return 2.0 * math.acos(min(1.0, abs(sum(p * q for p, q in zip(a, b)))))
+
+
+def test_view_and_inverse_after_edits():
+    trackball = Trackball()
+    trackball.drag(30, -12)
+    trackball.rotate((0, 0, 1), 40)
+    trackball.pan(1.5, -0.5)
+    trackball.zoom(3.0)
+    view = trackball.matrix
+    rotation = view[:3, :3]
+    assert np.allclose(rotation, rotation_matrix(trackball.orientation))
+    assert np.allclose(rotation.dot(rotation.T), np.identity(3))
+    assert np.allclose(view[:3, 3], (1.5, -0.5, -12.0))
+    assert np.allclose(view.dot(trackball.inverse), np.identity(4))
+
+
+def test_horizontal_drag_turns_about_the_view_y_axis():
+    trackball = Trackball()
+    trackball.drag(50, 0)
+    expected = axis_angle((0, 1, 0), math.degrees(50 * Trackball.SPEED))
+    assert np.allclose(trackball.orientation, expected)
+
+
+def test_zoom_keeps_min_distance():
+    trackball = Trackball()
+    trackball.zoom(1000.0)
+    assert trackball.distance == Trackball.MIN_DISTANCE
+
+
+def test_slerp_takes_the_short_way():
+    a = axis_angle((0, 0, 1), 10)
+    b = tuple(-v for v in axis_angle((0, 0, 1), 90))
+    middle = slerp(a, b, 0.5)
+    assert np.isclose(sum(v * v for v in middle), 1.0)
+    assert np.isclose(math.degrees(angle_between(a, middle)), 40.0)
+    assert np.isclose(math.degrees(angle_between(middle, b)), 40.0)
+    assert np.allclose(slerp(a, b, 0.0), a)
+
+
+def test_animation_ends_on_target():
+    trackball = Trackball()
+    target = axis_angle((1, 1, 0), 120)
+    trackball.animate_to(target, distance=5.0, pan=(1.0, 2.0), duration=1.0, now=0.0)
+    assert trackball.advance(now=0.5)
+    assert 5.0 < trackball.distance < Trackball.DISTANCE
+    assert not trackball.advance(now=1.0)
+    assert np.allclose(trackball.orientation, target)
+    assert trackball.state()[1:] == (5.0, (1.0, 2.0))
+    assert not trackball.advance(now=2.0)
@@ -0,0 +1,30 @@
+# Viewer frame scheduling on the GL stub
+import os
+import pytest
+import glstub
+from viewer import Viewer
+
+
+@pytest.fixture
+def viewer(tmp_path):
+    return Viewer(os.path.join(str(tmp_path), 'scene.3drs'))
+
+
+def draws(viewer):
+    glstub.RECORDER.reset()
+    viewer.render()
+    return glstub.RECORDER.calls['glClear'] > 0
+
+
+def test_unchanged_frame_is_skipped(viewer):
+    assert draws(viewer)
+    assert not draws(viewer)
+
+
+def test_damaged_window_is_redrawn(viewer):
+    viewer.render()
+    glstub.RECORDER.damaged = True
+    try:
+        assert draws(viewer)
+    finally:
+        glstub.RECORDER.damaged = False
@@ -1,37 +1,183 @@
-import numpy as np
-
-class Trackball:
-    def __init__(self, theta=-25, distance=15):
-        self.theta = theta
-        self.distance = distance
-        self.matrix = np.identity(4)
-        self.last_pos = None
-
-    def drag_to(self, x, y, dx, dy):
-        """
-        Update the rotation matrix based on mouse drag.
-        """
-        if self.last_pos is None:
-            self.last_pos = (x, y)
-            return
-
-        # Calculate rotation angles
-        delta_x = dx * 0.01
-        delta_y = dy * 0.01
-
-        # Create rotation matrices
-        rot_x = np.identity(4)
-        rot_x[1:3, 1:3] = [
-            [np.cos(delta_x), -np.sin(delta_x)],
-            [np.sin(delta_x), np.cos(delta_x)]
-        ]
-
-        rot_y = np.identity(4)
-        rot_y[0:3:2, 0:3:2] = [
-            [np.cos(delta_y), np.sin(delta_y)],
-            [-np.sin(delta_y), np.cos(delta_y)]
-        ]
-
-        # Update the trackball matrix
-        self.matrix = np.dot(self.matrix, np.dot(rot_x, rot_y))
-        self.last_pos = (x, y)
\ No newline at end of file
+# Orbiting camera: quaternion orientation, distance and pan
+import math
+import time
+import numpy as np
+
+
+def _multiply(a, b):
+    # Hamilton product of two (w, x, y, z) quaternions
+    aw, ax, ay, az = a
+    bw, bx, by, bz = b
+    return (aw * bw - ax * bx - ay * by - az * bz,
+            aw * bx + ax * bw + ay * bz - az * by,
+            aw * by - ax * bz + ay * bw + az * bx,
+            aw * bz + ax * by - ay * bx + az * bw)
+
+
+def _normalize(q):
+    w, x, y, z = q
+    length = math.sqrt(w * w + x * x + y * y + z * z)
+    return (w / length, x / length, y / length, z / length)
+
+
+def axis_angle(axis, degrees):
+    """
+    Unit quaternion of a right-handed rotation about axis.
+    """
+    x, y, z = axis
+    length = math.sqrt(x * x + y * y + z * z)
+    half = math.radians(degrees) * 0.5
+    s = math.sin(half) / length
+    return (math.cos(half), x * s, y * s, z * s)
+
+
+def slerp(a, b, t):
+    """
+    Spherical interpolation between unit quaternions, the short way round.
+    """
+    dot = a[0] * b[0] + a[1] * b[1] + a[2] * b[2] + a[3] * b[3]
+    if dot < 0.0:
+        b, dot = (-b[0], -b[1], -b[2], -b[3]), -dot
+    if dot > 0.9995:
+        # Nearly parallel: a normalized lerp is as good and stays stable
+        return _normalize(tuple(p + (q - p) * t for p, q in zip(a, b)))
+    theta = math.acos(dot)
+    s = math.sin(theta)
+    wa, wb = math.sin((1.0 - t) * theta) / s, math.sin(t * theta) / s
+    return tuple(wa * p + wb * q for p, q in zip(a, b))
+
+
+def smoothstep(t):
+    return t * t * (3.0 - 2.0 * t)
+
+
+class Trackball(object):
+    """
+    Camera orbiting the origin. The view is the rotation held as a unit
+    quaternion, then a pan across the screen and a step back by distance:
+
+        view = translation(pan_x, pan_y, -distance) . rotation(orientation)
+
+    Drags, pans and zooms are scalar updates. The view matrix and its
+    inverse are only rebuilt, into the same two arrays, when asked for
+    after a change; version counts the changes.
+    """
+    DISTANCE = 15.0
+    MIN_DISTANCE = 0.5
+    # Radians turned per pixel dragged
+    SPEED = 0.01
+
+    def __init__(self, distance=DISTANCE):
+        self.orientation = (1.0, 0.0, 0.0, 0.0)
+        self.distance = float(distance)
+        self.pan_x, self.pan_y = 0.0, 0.0
+        self.version = 0
+        self.animation = None
+        self._view = np.identity(4)
+        self._inverse = np.identity(4)
+        self._built = -1
+
+    def changed(self):
+        self.version += 1
+
+    def drag(self, dx, dy):
+        """
+        Turn the scene by a mouse drag of (dx, dy) pixels, y up, about the
+        screen axis perpendicular to the drag.
+        """
+        length = math.sqrt(dx * dx + dy * dy)
+        if length == 0:
+            return
+        half = 0.5 * self.SPEED * length
+        s = math.sin(half) / length
+        # The drag is in view space, so it applies after the orientation
+        self.orientation = _normalize(_multiply((math.cos(half), -dy * s, dx * s, 0.0), self.orientation))
+        self.changed()
+
+    def rotate(self, axis, degrees):
+        """
+        Turn the scene about an axis given in view space.
+        """
+        self.orientation = _normalize(_multiply(axis_angle(axis, degrees), self.orientation))
+        self.changed()
+
+    def pan(self, dx, dy):
+        self.pan_x += dx
+        self.pan_y += dy
+        self.changed()
+
+    def zoom(self, amount):
+        """
+        Move towards the origin by amount, keeping at least MIN_DISTANCE.
+        """
+        self.distance = max(self.MIN_DISTANCE, self.distance - amount)
+        self.changed()
+
+    def set_state(self, orientation, distance, pan):
+        self.orientation = _normalize(tuple(float(v) for v in orientation))
+        self.distance = float(distance)
+        self.pan_x, self.pan_y = float(pan[0]), float(pan[1])
+        self.changed()
+
+    def state(self):
+        return self.orientation, self.distance, (self.pan_x, self.pan_y)
+
+    def animate_to(self, orientation, distance=None, pan=None, duration=0.5, now=None):
+        """
+        Start moving smoothly to a view over duration seconds. advance()
+        then sets the view for the current time, e.g. once per frame.
+        """
+        now = time.perf_counter() if now is None else now
+        target = (_normalize(orientation), self.distance if distance is None else float(distance),
+                  (self.pan_x, self.pan_y) if pan is None else (float(pan[0]), float(pan[1])))
+        self.animation = (now, max(duration, 1e-6), self.state(), target)
+
+    def advance(self, now=None):
+        """
+        Apply the running animation at time now. Returns True while it has
+        further to go.
+        """
+        if self.animation is None:
+            return False
+        now = time.perf_counter() if now is None else now
+        start, duration, (q0, d0, p0), (q1, d1, p1) = self.animation
+        t = min(max((now - start) / duration, 0.0), 1.0)
+        e = smoothstep(t)
+        self.orientation = slerp(q0, q1, e)
+        self.distance = d0 + (d1 - d0) * e
+        self.pan_x, self.pan_y = p0[0] + (p1[0] - p0[0]) * e, p0[1] + (p1[1] - p0[1]) * e
+        self.changed()
+        if t >= 1.0:
+            self.animation = None
+        return self.animation is not None
+
+    def _build(self):
+        w, x, y, z = self.orientation
+        r = ((1.0 - 2.0 * (y * y + z * z), 2.0 * (x * y - w * z), 2.0 * (x * z + w * y)),
+             (2.0 * (x * y + w * z), 1.0 - 2.0 * (x * x + z * z), 2.0 * (y * z - w * x)),
+             (2.0 * (x * z - w * y), 2.0 * (y * z + w * x), 1.0 - 2.0 * (x * x + y * y)))
+        t = (self.pan_x, self.pan_y, -self.distance)
+        view, inverse = self._view, self._inverse
+        for i in range(3):
+            for j in range(3):
+                view[i, j] = r[i][j]
+                inverse[i, j] = r[j][i]
+            view[i, 3] = t[i]
+            # The inverse is R^T . translation(-t)
+            inverse[i, 3] = -(r[0][i] * t[0] + r[1][i] * t[1] + r[2][i] * t[2])
+        self._built = self.version
+
+    @property
+    def matrix(self):
+        """
+        World to eye space matrix, row-major. The array is reused.
+        """
+        if self._built != self.version:
+            self._build()
+        return self._view
+
+    @property
+    def inverse(self):
+        if self._built != self.version:
+            self._build()
+        return self._inverse
@@ -0,0 +1,29 @@
+# Matrix helpers shared by the viewer and the scene
+import numpy as np
+
+
+def perspective(fovy, aspect, near, far):
+    """
+    The projection matrix gluPerspective multiplies onto the stack.
+    """
+    f = 1.0 / np.tan(np.radians(fovy) / 2.0)
+    m = np.zeros((4, 4))
+    m[0, 0] = f / aspect
+    m[1, 1] = f
+    m[2, 2] = (far + near) / (near - far)
+    m[2, 3] = 2.0 * far * near / (near - far)
+    m[3, 2] = -1.0
+    return m
+
+
+def rotation(degrees, axis):
+    """
+    The matrix glRotatef multiplies onto the stack, for a unit axis.
+    """
+    x, y, z = axis
+    c, s = np.cos(np.radians(degrees)), np.sin(np.radians(degrees))
+    m = np.identity(4)
+    m[:3, :3] = [[x * x * (1 - c) + c, x * y * (1 - c) - z * s, x * z * (1 - c) + y * s],
+                 [y * x * (1 - c) + z * s, y * y * (1 - c) + c, y * z * (1 - c) - x * s],
+                 [z * x * (1 - c) - y * s, z * y * (1 - c) + x * s, z * z * (1 - c) + c]]
+    return m
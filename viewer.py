@@ -1,160 +1,332 @@
-# Viewer Class and main Rendering Logic
-
-from OpenGL.GL import *
-from OpenGL.GLUT import *
-from OpenGL.GLU import *
-import numpy as np
-from scene import Scene
-from interaction import Interaction
-
-class Viewer(object):
-    def __init__(self):
-        self.init_interface()
-        self.init_opengl()
-        self.init_scene()
-        self.init_interaction()
-        
-    def init_interface(self):
-        glutInit()
-        glutInitDisplayMode(GLUT_SINGLE | GLUT_RGB | GLUT_DEPTH)
-        glutInitWindowSize(640, 480)
-        glutCreateWindow(b"3D Render")
-        glutDisplayFunc(self.render)
-        
-    def init_opengl(self):      
-        glEnable(GL_CULL_FACE)
-        glCullFace(GL_BACK)
-        
-        glEnable(GL_DEPTH_TEST)
-        glDepthFunc(GL_LESS)
-        
-        glEnable(GL_LIGHT0)
-        position = np.array([0.0, 0.0, 1.0, 0.0], dtype=np.float32)
-        direction = np.array([0.0, 0.0, 0.0, -1.0], dtype=np.float32)
-        glLightfv(GL_LIGHT0, GL_POSITION, position)
-        glLightfv(GL_LIGHT0, GL_SPOT_DIRECTION, direction)
-        
-        glEnable(GL_COLOR_MATERIAL)
-        glColorMaterial(GL_FRONT_AND_BACK, GL_AMBIENT_AND_DIFFUSE)
-        
-        glClearColor(0.4, 0.4, 0.4, 0.0)
-        glClearDepth(1.0)
-        
-    def init_scene(self):
-        self.scene = Scene()
-        self.create_sample_scene()
-        
-    def create_sample_scene(self):
-        from node import Cube, Sphere, SnowFigure
-        cube_node = Cube()
-        cube_node.translate(2, 0, 2)
-        cube_node.color_index = 2
-        self.scene.add_node(cube_node)
-        
-        sphere_node = Sphere()
-        sphere_node.translate(2, 0, 2)
-        sphere_node.color_index = 1
-        self.scene.add_node(sphere_node)
-        
-        hierarchical_node = SnowFigure()
-        hierarchical_node.translate(-2, 0, -2)
-        self.scene.add_node(hierarchical_node)
-        
-    def init_interaction(self):
-        self.interaction = Interaction()
-        self.interaction.register_callback('pick', self.pick)
-        self.interaction.register_callback('move', self.move)
-        self.interaction.register_callback('place', self.place)
-        self.interaction.register_callback('rotate_color', self.rotate_color)
-        self.interaction.register_callback('scale', self.scale)
-        
-    def main_loop(self):
-        glutMainLoop()
-        
-    def render(self):
-        self.init_view()
-        glEnable(GL_LIGHTING)
-        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
-        
-        glMatrixMode(GL_MODELVIEW)
-        glPushMatrix()
-        glLoadIdentity()
-        loc = self.interaction.translation
-        glTranslated(loc[0], loc[1], loc[2])
-        glMultMatrixf(self.interaction.trackball.matrix)
-        
-        currentModeView = np.array(glGetFloatv(GL_MODELVIEW_MATRIX))
-        self.modelView = np.transpose(currentModeView)
-        self.inverseModelView = np.linalg.inv(self.modelView)
-        
-        # Draw grid lines before rendering the scene
-        self.draw_grid()
-
-        # Render the scene
-        self.scene.render()
-        
-        glDisable(GL_LIGHTING)
-        glCallList(1)
-        glPopMatrix()
-        
-        glFlush()
-
-    def draw_grid(self, grid_size=10, step=1.0):
-        """
-        Draws a 2D grid on the X-Y plane.
-        
-        :param grid_size: Size of the grid.
-        :param step: Spacing between grid lines.
-        """
-        glColor3f(0.5, 0.5, 0.5)  # Light grey color for grid lines
-        glBegin(GL_LINES)
-        
-        # Draw vertical lines
-        for x in range(-grid_size, grid_size + 1):
-            glVertex2f(x * step, -grid_size * step)
-            glVertex2f(x * step, grid_size * step)
-        
-        # Draw horizontal lines
-        for y in range(-grid_size, grid_size + 1):
-            glVertex2f(-grid_size * step, y * step)
-            glVertex2f(grid_size * step, y * step)
-        
-        glEnd()
-
-    def init_view(self):
-        xSize, ySize = glutGet(GLUT_WINDOW_WIDTH), glutGet(GLUT_WINDOW_HEIGHT)
-        aspect_ratio = float(xSize)/ float(ySize)
-        
-        glMatrixMode(GL_PROJECTION)
-        glLoadIdentity()
-        glViewport(0, 0, xSize, ySize)
-        gluPerspective(70, aspect_ratio, 0.1, 1000.0)
-        glTranslated(0, 0, -15)
-        
-    def pick(self, x, y):
-        start, direction = self.get_ray(x, y)
-        self.scene.pick(start, direction, self.modelView)
-        
-    def move(self, x, y):
-        start, direction = self.get_ray(x, y)
-        self.scene.move_selected(start, direction, self.inverseModelView)
-    
-    def rotate_color(self, forward):
-        self.scene.rotate_selected_color(forward)
-        
-    def scale(self, up):
-        self.scene.scale_selected(up)
-        
-    def place(self, shape, x, y):
-        start, direction = self.get_ray(x, y)
-        self.scene.place(shape, start, direction, self.inverseModelView)
-        
-    def get_ray(self, x, y):
-        self.init_view()
-        glMatrixMode(GL_MODELVIEW)
-        glLoadIdentity()
-        start = np.array(gluUnProject(x, y, 0.001))
-        end = np.array(gluUnProject(x, y, 0.999))
-        direction = end - start
-        direction = direction / np.linalg.norm(direction)
-        return start, direction
+# Viewer Class and main Rendering Logic
+
+from OpenGL.GL import *
+from OpenGL.GLUT import *
+from OpenGL.GLU import *
+import os
+import numpy as np
+import scenefile
+from scene import Scene
+from interaction import Interaction
+from camera import Camera
+from trackball import Trackball
+from profiling import PROFILER
+from recording import EventRecorder
+from streaming import SceneStreamer
+
+class Viewer(object):
+    DEFAULT_SCENE_PATH = 'scene.3drs'
+    # Main loop time per frame for streamed content, and how often to
+    # look for more of it while no input comes in
+    STREAM_BUDGET = 0.008
+    STREAM_POLL_MS = 16
+
+    def __init__(self, scene_path=None, record_path=None):
+        # Loaded at start up if it exists, and where the scene is saved to
+        self.scene_path = scene_path or self.DEFAULT_SCENE_PATH
+        self.camera = Camera()
+        # (scene version, camera version) of the frame on screen
+        self.frame_key = None
+        self.force_redraw = True
+        # SceneStreamer adding generated nodes, while one runs
+        self.streamer = None
+        self.init_interface()
+        self.init_opengl()
+        self.init_scene()
+        self.init_interaction()
+        if record_path is not None:
+            self.interaction.recorder = EventRecorder(record_path, self.interaction, self.scene_path)
+        
+    def init_interface(self):
+        glutInit()
+        glutInitDisplayMode(GLUT_SINGLE | GLUT_RGB | GLUT_DEPTH)
+        glutInitWindowSize(640, 480)
+        glutCreateWindow(b"3D Render")
+        glutDisplayFunc(self.render)
+        
+    def init_opengl(self):      
+        glEnable(GL_CULL_FACE)
+        glCullFace(GL_BACK)
+        
+        glEnable(GL_DEPTH_TEST)
+        glDepthFunc(GL_LESS)
+        
+        glEnable(GL_LIGHT0)
+        position = np.array([0.0, 0.0, 1.0, 0.0], dtype=np.float32)
+        direction = np.array([0.0, 0.0, 0.0, -1.0], dtype=np.float32)
+        glLightfv(GL_LIGHT0, GL_POSITION, position)
+        glLightfv(GL_LIGHT0, GL_SPOT_DIRECTION, direction)
+        
+        glEnable(GL_COLOR_MATERIAL)
+        glColorMaterial(GL_FRONT_AND_BACK, GL_AMBIENT_AND_DIFFUSE)
+        
+        glClearColor(0.4, 0.4, 0.4, 0.0)
+        glClearDepth(1.0)
+        
+    def init_scene(self):
+        self.scene = Scene()
+        if os.path.exists(self.scene_path):
+            scenefile.load(self.scene_path, self.scene)
+        else:
+            self.create_sample_scene()
+        
+    def create_sample_scene(self):
+        from node import Cube, Sphere, SnowFigure
+        cube_node = Cube()
+        cube_node.translate(2, 0, 2)
+        cube_node.color_index = 2
+        self.scene.add_node(cube_node)
+        
+        sphere_node = Sphere()
+        sphere_node.translate(2, 0, 2)
+        sphere_node.color_index = 1
+        self.scene.add_node(sphere_node)
+        
+        hierarchical_node = SnowFigure()
+        hierarchical_node.translate(-2, 0, -2)
+        self.scene.add_node(hierarchical_node)
+        
+    def init_interaction(self):
+        self.interaction = Interaction()
+        self.interaction.register_callback('pick', self.pick)
+        self.interaction.register_callback('move', self.move)
+        self.interaction.register_callback('rotate', self.rotate)
+        self.interaction.register_callback('reset_view', self.reset_view)
+        self.interaction.register_callback('place', self.place)
+        self.interaction.register_callback('rotate_color', self.rotate_color)
+        self.interaction.register_callback('scale', self.scale)
+        self.interaction.register_callback('remove', self.remove)
+        self.interaction.register_callback('toggle_instancing', self.toggle_instancing)
+        self.interaction.register_callback('reshape', self.reshape)
+        self.interaction.register_callback('toggle_profiling', self.toggle_profiling)
+        self.interaction.register_callback('save', self.save)
+        self.interaction.register_callback('toggle_collisions', self.toggle_collisions)
+        self.interaction.register_callback('select_rectangle', self.select_rectangle)
+        self.interaction.register_callback('select_lasso', self.select_lasso)
+        self.interaction.register_callback('region_changed', self.region_changed)
+        
+    def main_loop(self):
+        glutMainLoop()
+
+    def stream(self, count, **options):
+        """
+        Add count generated nodes to the scene in the background; see
+        streaming.SceneStreamer for the options.
+        """
+        if self.streamer is not None:
+            self.streamer.close()
+        self.streamer = SceneStreamer(self.scene, count, **options)
+        self.streamer.start()
+        glutTimerFunc(self.STREAM_POLL_MS, self.poll_stream, 0)
+
+    def poll_stream(self, value):
+        if self.streamer is None:
+            return
+        glutPostRedisplay()
+        glutTimerFunc(self.STREAM_POLL_MS, self.poll_stream, 0)
+        
+    def reshape(self, width, height):
+        self.force_redraw = True
+
+    def update_camera(self):
+        width, height = self.interaction.window_size
+        self.camera.update(width, height, self.interaction.trackball)
+
+    def render(self):
+        if self.interaction.recorder is not None:
+            self.interaction.recorder.frame()
+        # Deliver the motion coalesced since the last frame before drawing it
+        with PROFILER.stage('input'):
+            self.interaction.flush()
+        if self.streamer is not None:
+            # Added rows bump the scene version, so they get drawn
+            if self.streamer.step(self.STREAM_BUDGET):
+                self.streamer.close()
+                self.streamer = None
+                self.force_redraw = True
+        # Keep drawing frames until a camera animation is done
+        if self.interaction.trackball.advance():
+            glutPostRedisplay()
+        self.update_camera()
+        # Only draw when the scene or the camera changed since the last
+        # frame, or the window system lost what was on screen, e.g. when
+        # the window was uncovered
+        frame_key = (self.scene.version, self.camera.version)
+        if frame_key == self.frame_key and not self.force_redraw and not glutLayerGet(GLUT_NORMAL_DAMAGED):
+            return
+        self.frame_key = frame_key
+        self.force_redraw = False
+        if PROFILER.enabled:
+            PROFILER.begin_frame()
+
+        self.init_view()
+        glEnable(GL_LIGHTING)
+        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+        
+        glMatrixMode(GL_MODELVIEW)
+        glPushMatrix()
+        glLoadMatrixf(self.camera.gl_model_view)
+        
+        # Draw grid lines before rendering the scene
+        with PROFILER.stage('grid'):
+            self.draw_grid()
+
+        # Render the scene, culled against the current view frustum
+        with PROFILER.stage('scene'):
+            self.scene.render(self.camera.projection, self.camera.model_view, self.camera.height)
+        
+        glDisable(GL_LIGHTING)
+        glCallList(1)
+        glPopMatrix()
+
+        if self.interaction.region is not None:
+            self.draw_region(self.interaction.region, self.interaction.region_mode)
+        lines = self.stream_lines() if self.streamer is not None else []
+        if PROFILER.enabled:
+            lines += PROFILER.overlay_lines()
+        if lines:
+            self.draw_overlay(lines)
+        
+        glFlush()
+        if PROFILER.enabled:
+            PROFILER.end_frame()
+
+    def draw_overlay(self, lines):
+        """
+        Draws text lines in the top left corner, on top of the scene.
+        """
+        self.begin_window_space()
+        glColor3f(1.0, 1.0, 1.0)
+        for i, line in enumerate(lines):
+            glRasterPos2f(8, self.camera.height - 16 - 14 * i)
+            for char in line:
+                glutBitmapCharacter(GLUT_BITMAP_8_BY_13, ord(char))
+        self.end_window_space()
+
+    def stream_lines(self):
+        progress = self.streamer.progress()
+        return ['streaming %d / %d nodes' % (progress['integrated'], progress['total']),
+                'backlog %d, %d chunks in flight' % (progress['backlog'], progress['chunks_in_flight'])]
+
+    def draw_region(self, points, mode):
+        """
+        Draws the outline of a selection rectangle or lasso being dragged.
+        """
+        if mode == 'rectangle' and len(points) == 2:
+            (x0, y0), (x1, y1) = points
+            points = [(x0, y0), (x1, y0), (x1, y1), (x0, y1)]
+        self.begin_window_space()
+        glColor3f(1.0, 1.0, 0.0)
+        glBegin(GL_LINE_LOOP)
+        for x, y in points:
+            glVertex2f(x, y)
+        glEnd()
+        self.end_window_space()
+
+    def begin_window_space(self):
+        # Draw in window pixels, over the scene, until end_window_space
+        glMatrixMode(GL_PROJECTION)
+        glPushMatrix()
+        glLoadIdentity()
+        glOrtho(0, self.camera.width, 0, self.camera.height, -1, 1)
+        glMatrixMode(GL_MODELVIEW)
+        glPushMatrix()
+        glLoadIdentity()
+        glDisable(GL_DEPTH_TEST)
+
+    def end_window_space(self):
+        glEnable(GL_DEPTH_TEST)
+        glPopMatrix()
+        glMatrixMode(GL_PROJECTION)
+        glPopMatrix()
+        glMatrixMode(GL_MODELVIEW)
+
+    def draw_grid(self, grid_size=10, step=1.0):
+        """
+        Draws a 2D grid on the X-Y plane.
+        
+        :param grid_size: Size of the grid.
+        :param step: Spacing between grid lines.
+        """
+        glColor3f(0.5, 0.5, 0.5)  # Light grey color for grid lines
+        glBegin(GL_LINES)
+        
+        # Draw vertical lines
+        for x in range(-grid_size, grid_size + 1):
+            glVertex2f(x * step, -grid_size * step)
+            glVertex2f(x * step, grid_size * step)
+        
+        # Draw horizontal lines
+        for y in range(-grid_size, grid_size + 1):
+            glVertex2f(-grid_size * step, y * step)
+            glVertex2f(grid_size * step, y * step)
+        
+        glEnd()
+
+    def init_view(self):
+        glMatrixMode(GL_PROJECTION)
+        glViewport(0, 0, self.camera.width, self.camera.height)
+        glLoadMatrixf(self.camera.gl_projection)
+        
+    def pick(self, x, y):
+        start, direction = self.get_ray(x, y)
+        self.scene.pick(start, direction, self.camera.model_view)
+        
+    def move(self, x, y):
+        start, direction = self.get_ray(x, y)
+        self.scene.move_selected(start, direction, self.camera.inverse_model_view)
+    
+    def rotate(self, dx, dy):
+        self.interaction.trackball.drag(dx, dy)
+
+    def reset_view(self):
+        self.interaction.trackball.animate_to((1.0, 0.0, 0.0, 0.0), Trackball.DISTANCE, (0.0, 0.0))
+        glutPostRedisplay()
+
+    def select_rectangle(self, x0, y0, x1, y1):
+        self.update_camera()
+        self.scene.select_rectangle(x0, y0, x1, y1, self.camera.projection, self.camera.model_view,
+                                    (self.camera.width, self.camera.height))
+        self.force_redraw = True
+
+    def select_lasso(self, points):
+        self.update_camera()
+        self.scene.select_region(points, self.camera.projection, self.camera.model_view,
+                                 (self.camera.width, self.camera.height))
+        self.force_redraw = True
+
+    def region_changed(self):
+        self.force_redraw = True
+
+    def rotate_color(self, forward):
+        self.scene.rotate_selected_color(forward)
+        
+    def scale(self, up):
+        self.scene.scale_selected(up)
+
+    def remove(self):
+        self.scene.remove_selected()
+
+    def toggle_instancing(self):
+        mode = 'immediate' if self.scene.render_mode == 'instanced' else 'instanced'
+        self.scene.set_render_mode(mode)
+        
+    def place(self, shape, x, y):
+        start, direction = self.get_ray(x, y)
+        self.scene.place(shape, start, direction, self.camera.inverse_model_view)
+        
+    def save(self):
+        scenefile.save(self.scene, self.scene_path)
+
+    def toggle_collisions(self):
+        modes = self.scene.COLLISION_MODES
+        self.scene.set_collision_mode(modes[(modes.index(self.scene.collision_mode) + 1) % len(modes)])
+
+    def toggle_profiling(self):
+        PROFILER.enable(not PROFILER.enabled)
+        self.force_redraw = True
+
+    def get_ray(self, x, y):
+        with PROFILER.stage('get_ray'):
+            self.update_camera()
+            return self.camera.get_ray(x, y)